@@ -24,7 +24,7 @@
 import sys
 assert sys.version_info >= (3,5)
 
-import copy
+import collections
 import subprocess
 import urllib.parse
 import time
@@ -32,16 +32,39 @@ import datetime
 import platform
 import threading
 from datetime import datetime
+from datetime import timedelta
 from threading import Thread
 from time import sleep
 import urllib.request
 import os
 import re
 import logging
+import mmap
+import operator
 from logging.handlers import TimedRotatingFileHandler
 import signal
 import argparse
-import psutil
+import array
+import bisect
+import fcntl
+import glob
+import gzip
+import heapq
+import http.client
+import http.server
+import io
+import itertools
+import json
+import math
+import select
+import shlex
+import socket
+import socketserver
+import struct
+import traceback
+
+# For startup timing.
+started = time.time()
 
 min_temp = 40
 max_temp = 80
@@ -67,21 +90,62 @@ C_CYAN = (0,FULLB,FULLB)
 
 C_WHITE = (FULLB,FULLB,FULLB)
 
+# A frame is a list of 64 colors, indexed y*8+x like sense.set_pixels.
+def blank(color=C_BLACK):
+    return [color] * 64
+
+def put(frame, x, y, color):
+    frame[y * 8 + x] = color
+
+class Leds:
+    """Diffing writer for the Sense HAT's 8x8 LED matrix.
+
+    Screens are drawn into an in-memory frame and handed to show(), which
+    compares it with the frame last written and sends only the difference:
+    nothing, a single set_pixel, or one bulk set_pixels.
+    """
+
+    def __init__(self, hat):
+        self.hat = hat
+        self.shown = None
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def show(self, frame):
+        with self.lock:
+            if self.shown is None:
+                diff = range(64)
+            else:
+                diff = [i for i in range(64) if frame[i] != self.shown[i]]
+            if len(diff) == 0:
+                return
+            if len(diff) == 1:
+                i = diff[0]
+                self.hat.set_pixel(i % 8, i // 8, frame[i])
+            else:
+                self.hat.set_pixels(frame)
+            self.writes = self.writes + 1
+            self.shown = list(frame)
+
+    def fill(self, color):
+        self.show(blank(color))
+
+leds = None
+
 def top_exception(exc_type, exc_value, exc_traceback):
     try:
-        if sense:
-            sense.clear(C_RED)
-            sense.set_pixel(3,3,C_YELLOW)
-            sense.set_pixel(3,4,C_GREEN)
-            sense.set_pixel(4,3,C_BLUE)
-            sense.set_pixel(4,4,C_PURPLE)
+        if leds:
+            frame = blank(C_RED)
+            put(frame,3,3,C_YELLOW)
+            put(frame,3,4,C_GREEN)
+            put(frame,4,3,C_BLUE)
+            put(frame,4,4,C_PURPLE)
+            leds.show(frame)
     except:
         print('Ignoring exception on display of error LEDs')
     sys.__excepthook__(exc_type, exc_value, exc_traceback)
     return
 
-sys.excepthook = top_exception
-
 
 parser = argparse.ArgumentParser(description="""Monitor Logger
 
@@ -110,15 +174,58 @@ parser.add_argument("-i", "--ifttt",
                     help="posts metrics to IFTTT using the key stored in env var IFTTT_TOKEN",
                     action="store_true")
 parser.add_argument("--ifttt_period", help="send an IFTTT post every N executions", type=int, default=1)
+parser.add_argument("--webhook", help="also POST samples as JSON batches to this URL", type=str, default=None)
+parser.add_argument("--webhook_period", help="queue a sample for the webhook every N executions", type=int, default=1)
+parser.add_argument("--webhook_queue", help="most undelivered posts to hold for IFTTT or the webhook before dropping the oldest", type=int, default=100)
+parser.add_argument("--rules", help="file of alert rules, one per line: [name:] metric op value [for|avg|min|max 30s|5m|1h] [-> log,webhook,led]; e.g. temp > 75 for 30s, state contains 'U', mem > 90 avg 5m",
+                    type=str, default=None)
+parser.add_argument("--alert_webhook", help="POST alert transitions as JSON batches to this URL (default: the --webhook URL); with --ifttt they also go to the berry_alert event",
+                    type=str, default=None)
+parser.add_argument("--push", help="push samples to a berryspy --listen_push receiver at this host:port", type=str, default=None)
+parser.add_argument("--push_proto", help="transport for --push", choices=['udp', 'tcp'], default='udp')
+parser.add_argument("--push_batch", help="samples per push; a push too large for one 64KB frame is split", type=int, default=5)
+parser.add_argument("--push_name", help="name to push samples under (default: this host's name)", type=str, default=None)
 parser.add_argument("-p", "--period", type=float, default=1,
                     help="seconds to sleep between monitoring")
+parser.add_argument("--adaptive", help="vary the period between --period_slow and --period_fast with thermal/throttle state",
+                    action="store_true")
+parser.add_argument("--period_slow", type=float, default=10,
+                    help="adaptive period while temperature is well below --min_temp and nothing is throttled")
+parser.add_argument("--period_fast", type=float, default=0.1,
+                    help="adaptive period while temperature rises fast or any current throttle flag is set")
+parser.add_argument("--adaptive_rise", type=float, default=0.5,
+                    help="temperature rise (C/s) that switches to --period_fast")
+parser.add_argument("--adaptive_hold", type=float, default=30,
+                    help="seconds to keep --period_fast after the last trigger")
+parser.add_argument("--adaptive_margin", type=float, default=5,
+                    help="degrees below --min_temp at which --period_slow starts")
 parser.add_argument("--min_temp", type=float, default=min_temp, help="Min bar graph temperature")
 parser.add_argument("--max_temp", type=float, default=max_temp, help="Max bar graph temperature")
 parser.add_argument("--min_freq", type=int, default=min_freq, help="Min bar graph frequency")
 parser.add_argument("--max_freq", type=int, default=max_freq, help="Max bar graph frequency")
+parser.add_argument("--sensehat_sensors", help="sample the Sense HAT's humidity, pressure, temperature and accelerometer in the background (requires --sensehat also)",
+                    action="store_true")
+parser.add_argument("--env_rate", help="humidity/pressure/temperature reads per second with --sensehat_sensors", type=float, default=5)
+parser.add_argument("--imu_rate", help="accelerometer reads per second with --sensehat_sensors", type=float, default=50)
+parser.add_argument("--no_splash", help="skip the Sense HAT color-cycle at startup", action="store_true")
 parser.add_argument("--led_rotation", help="rotation of the Sense HAT LEDs (90deg increments)",
                     type=int, default=0)
 
+parser.add_argument("--sampler", help="how to read temperature, arm frequency and throttling (sysfs falls back to vcgencmd per source)",
+                    choices=['sysfs', 'vcgencmd'], default='sysfs')
+parser.add_argument("--burst", help="capture the measured arm clock and throttling at --burst_rate for --burst_window seconds when a throttle flag rises or /burst/trigger is requested (needs the sysfs sampler)",
+                    action="store_true")
+parser.add_argument("--burst_rate", help="burst capture samples per second", type=float, default=1000)
+parser.add_argument("--burst_window", help="burst capture length in seconds", type=float, default=2)
+parser.add_argument("--burst_keep", help="burst captures to keep in memory", type=int, default=10)
+parser.add_argument("--burst_dir", help="also save each burst capture as JSON in this directory", type=str, default=None)
+parser.add_argument("--vcgencmd", help="path to the vcgencmd executable", type=str, default='/opt/vc/bin/vcgencmd')
+parser.add_argument("--vc_counters", help="extra vcgencmd queries (e.g. 'measure_clock core' 'measure_volts core' 'get_mem gpu') collected each tick; clocks, volts and get_mem come from the mailbox with --sampler sysfs, the rest through one helper shell",
+                    nargs='+', default=[])
+parser.add_argument("--collector", help="how to read load, memory, uptime, disk and network counters (proc falls back to psutil, which has no disk/network rates)",
+                    choices=['proc', 'psutil'], default='proc')
+parser.add_argument("--sysfs_root", help="root directory holding sys/, proc/ and dev/vcio for the sysfs sampler and proc collector", type=str, default='/')
+
 parser.add_argument("--power_management",
                     help="allows joystick power control (middle=sudo shutdown, others=sudo reboot)",
                     action="store_true")
@@ -126,10 +233,32 @@ parser.add_argument("--power_management",
 parser.add_argument("--log", help="path to log to", type=str, default=None)
 parser.add_argument("--log_days", help="days of logs to keep", type=int, default=7)
 parser.add_argument("--log_period", help="print/log every N executions", type=int, default=1)
+parser.add_argument("--record", help="directory to append binary sample records to, one file per day (kept for --log_days)", type=str, default=None)
+parser.add_argument("--record_sync", help="seconds between writes+fsyncs of buffered records", type=float, default=60)
+parser.add_argument("--record_read", help="print the records in this --record directory as tab-separated values, then exit", type=str, default=None)
+parser.add_argument("--record_since", help="with --record_read, first unix time to print", type=float, default=None)
+parser.add_argument("--record_until", help="with --record_read, last unix time to print", type=float, default=None)
+
+
+parser.add_argument("--processes", help="track the top N processes by CPU and by resident memory (0 disables)", type=int, default=0)
+parser.add_argument("--processes_refresh", help="executions between re-reads of the process list and resident memory", type=int, default=10)
+
+parser.add_argument("--profile", help="profile the sampling loop with cProfile for N ticks, then print the costliest calls (0 disables)", type=int, default=0)
+parser.add_argument("--profile_out", help="also save the --profile data to this file for pstats", type=str, default=None)
+
+parser.add_argument("--sink_queue", help="samples each output (log, IFTTT, LEDs) may fall behind before the oldest is dropped", type=int, default=4)
 
+parser.add_argument("--history_raw", help="raw samples of history to keep per metric (0 disables history)", type=int, default=3600)
+parser.add_argument("--history_minutes", help="1-minute rollups of history to keep per metric", type=int, default=7*24*60)
+parser.add_argument("--history_hours", help="1-hour rollups of history to keep per metric", type=int, default=90*24)
 
 parser.add_argument("--server", help="run a webserver with monitoring on this IP", type=str, default=None)
 parser.add_argument("--server_port", help="webserver port", type=int, default=8080)
+parser.add_argument("--server_backend", help="webserver implementation: a bounded thread pool with keep-alive, or bottle's single-threaded wsgiref default",
+                    choices=['threaded', 'wsgiref'], default='threaded')
+parser.add_argument("--server_threads", help="most requests the threaded webserver runs at once", type=int, default=8)
+parser.add_argument("--server_streams", help="most /stream and /poll clients the threaded webserver holds open at once, apart from --server_threads", type=int, default=32)
+parser.add_argument("--server_connections", help="most connections (and so threads) the threaded webserver holds open at once; more are refused with 503", type=int, default=64)
 parser.add_argument("--server_controls", help="permit unauthenticated INSECURE access to server controls over http", action='store_true')
 
 # Sets up our logs, and redirects stdout/err to those logs
@@ -159,64 +288,292 @@ def setup_logs(path, days):
     sys.stdout = LoggerStream(logger, logging.INFO)
     return logger
 
-
-args = parser.parse_args()
-
-if args.log:
-    setup_logs(args.log, args.log_days)
-
-min_temp = args.min_temp
-max_temp = args.max_temp
-min_freq = args.min_freq
-max_freq = args.max_freq
+# Binary sample records.  Each day's file starts with a header of
+# (magic, core count, record size); every record after it is the same size:
+# time, uptime, temp, freq, throttle bits, mem, and one load per core.
+RECORD_MAGIC = b'BMR1'
+RECORD_HEADER = struct.Struct('<4sHH')
+RECORD_FIELDS = ('time', 'uptime', 'temp', 'freq', 'throttled', 'mem')
+
+def record_struct(cores):
+    return struct.Struct('<ddfIIf' + 'f' * cores)
+
+# The values of one record, in record_struct order.
+def record_values(t, data):
+    return (t, data['uptime'], data['temp'], data['freq'], data['throttled'], data['mem']) + tuple(data['load'])
+
+class Recorder:
+    """Appends fixed-width sample records to one file per day.
+
+    Records are buffered and written, flushed and fsynced together every
+    `sync` seconds to spare the SD card; files older than `days` are
+    removed as each new day starts.
+    """
+
+    def __init__(self, path, sync, days):
+        self.path = path
+        self.sync_period = sync
+        self.days = days
+        self.buf = bytearray()
+        self.synced = time.time()
+        self.file = None
+        self.day = None
+        self.cores = None
+        self.rec = None
+        os.makedirs(path, exist_ok=True)
+
+    def _open(self, day, cores):
+        self._sync()
+        if self.file:
+            self.file.close()
+        self.cores = cores
+        self.rec = record_struct(cores)
+        header = RECORD_HEADER.pack(RECORD_MAGIC, cores, self.rec.size)
+        n = 0
+        while True:
+            name = os.path.join(self.path, day + ('.{0}'.format(n) if n else '') + '.bmr')
+            self.file = open(name, 'ab')
+            size = self.file.tell()
+            if size < RECORD_HEADER.size:
+                # new, or a header cut short by a crash
+                self.file.truncate(0)
+                self.file.write(header)
+                break
+            with open(name, 'rb') as f:
+                if f.read(RECORD_HEADER.size) == header:
+                    # drop a record cut short by a crash or power loss, so
+                    # the records appended after it stay aligned
+                    self.file.truncate(size - (size - RECORD_HEADER.size) % self.rec.size)
+                    break
+            # same day, different layout (e.g. another board's card)
+            self.file.close()
+            n = n + 1
+        self.day = day
+        self._expire()
+
+    def _expire(self):
+        cutoff = (datetime.now() - timedelta(days=self.days)).strftime('%Y-%m-%d')
+        for name in os.listdir(self.path):
+            if name.endswith('.bmr') and name[:10] < cutoff:
+                os.remove(os.path.join(self.path, name))
+
+    def add(self, t, data):
+        day = datetime.fromtimestamp(t).strftime('%Y-%m-%d')
+        if day != self.day or len(data['load']) != self.cores:
+            self._open(day, len(data['load']))
+        self.buf += self.rec.pack(*record_values(t, data))
+        if t - self.synced >= self.sync_period:
+            self._sync()
+
+    def _sync(self):
+        self.synced = time.time()
+        if self.file and self.buf:
+            self.file.write(self.buf)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buf = bytearray()
+
+    def close(self):
+        self._sync()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class RecordFile:
+    """Read-only, memory-mapped view of one day's records."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            # raises ValueError for an empty file
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, cores, size = RECORD_HEADER.unpack_from(self.mm)
+        if magic != RECORD_MAGIC:
+            self.mm.close()
+            raise ValueError('not a berrymon record file: ' + path)
+        self.rec = record_struct(cores)
+        self.n = (len(self.mm) - RECORD_HEADER.size) // self.rec.size
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        # the time of record i, for bisect
+        return struct.unpack_from('<d', self.mm, RECORD_HEADER.size + i * self.rec.size)[0]
+
+    def record(self, i):
+        v = self.rec.unpack_from(self.mm, RECORD_HEADER.size + i * self.rec.size)
+        return v[:len(RECORD_FIELDS)] + (list(v[len(RECORD_FIELDS):]),)
+
+    def close(self):
+        self.mm.close()
+
+# Yields (time, uptime, temp, freq, throttled, mem, [load, ...]) tuples for
+# the records in a --record directory between since and until.
+def read_records(path, since=None, until=None):
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.bmr'):
+            continue
+        try:
+            rf = RecordFile(os.path.join(path, name))
+        except ValueError:
+            # empty (mmap can't map it) or not ours
+            continue
+        try:
+            if rf.n == 0 or (since is not None and rf[rf.n - 1] < since) or (until is not None and rf[0] > until):
+                continue
+            i = bisect.bisect_left(rf, since) if since is not None else 0
+            while i < rf.n:
+                r = rf.record(i)
+                if until is not None and r[0] > until:
+                    break
+                yield r
+                i = i + 1
+        finally:
+            rf.close()
+
+# Push frames, sent by --push to a berryspy --listen_push receiver: a header
+# of (magic, core count, record size, name length), the sender's name in
+# UTF-8, then records laid out as in the record files.  Over TCP each frame
+# is preceded by its length as a little-endian uint32.
+PUSH_MAGIC = b'BMP1'
+PUSH_HEADER = struct.Struct('<4sHHH')
+PUSH_LENGTH = struct.Struct('<I')
+# the largest UDP payload
+PUSH_MAX = 65507
+
+def pack_push(name, samples):
+    name = name.encode('utf-8')
+    rec = record_struct(len(samples[0][1]['load']))
+    buf = bytearray(PUSH_HEADER.pack(PUSH_MAGIC, len(samples[0][1]['load']), rec.size, len(name)))
+    buf += name
+    for t, data in samples:
+        buf += rec.pack(*record_values(t, data))
+    return bytes(buf)
+
+# The most records with `cores` loads that fit in one frame under `name`.
+def push_capacity(name, cores):
+    return max(1, (PUSH_MAX - PUSH_HEADER.size - len(name.encode('utf-8'))) // record_struct(cores).size)
+
+# Returns (name, [(time, uptime, temp, freq, throttled, mem, [load, ...]), ...]);
+# raises ValueError or struct.error for a malformed frame.
+def unpack_push(frame):
+    magic, cores, size, n = PUSH_HEADER.unpack_from(frame)
+    if magic != PUSH_MAGIC:
+        raise ValueError('not a berrymon push frame')
+    rec = record_struct(cores)
+    body = memoryview(frame)[PUSH_HEADER.size + n:]
+    if size != rec.size or len(frame) < PUSH_HEADER.size + n or len(body) % size:
+        raise ValueError('truncated or mismatched push frame')
+    name = bytes(frame[PUSH_HEADER.size:PUSH_HEADER.size + n]).decode('utf-8')
+    return name, [v[:len(RECORD_FIELDS)] + (list(v[len(RECORD_FIELDS):]),) for v in rec.iter_unpack(body)]
+
+class Pusher:
+    """Pushes samples to a berryspy receiver, `batch` samples at a time.
+
+    Each batch goes out as one frame, or as several if it won't fit in
+    PUSH_MAX, the largest datagram and the largest frame the receiver
+    accepts over TCP.  UDP sends each frame as one datagram; TCP writes it
+    to a persistent connection, reconnecting on the next batch after an
+    error.  Frames that can't be sent are dropped: pushing is for live
+    views, and --record is the durable copy.
+    """
+
+    def __init__(self, addr, proto, batch, name):
+        host, port = addr.rsplit(':', 1)
+        self.addr = (host, int(port))
+        self.proto = proto
+        self.batch = batch
+        self.name = name
+        self.samples = []
+        self.sock = None
+        self.sent = 0
+        self.failures = 0
+
+    def add(self, t, data):
+        self.samples.append((t, data))
+        if len(self.samples) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.samples:
+            return
+        samples, self.samples = self.samples, []
+        per = push_capacity(self.name, len(samples[0][1]['load']))
+        for i in range(0, len(samples), per):
+            if not self._send(pack_push(self.name, samples[i:i + per])):
+                break
+
+    def _send(self, frame):
+        try:
+            if self.sock is None:
+                if self.proto == 'udp':
+                    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    self.sock.connect(self.addr)
+                else:
+                    self.sock = socket.create_connection(self.addr, timeout=5)
+            if self.proto == 'udp':
+                self.sock.send(frame)
+            else:
+                self.sock.sendall(PUSH_LENGTH.pack(len(frame)) + frame)
+            self.sent = self.sent + 1
+            self.failures = 0
+            return True
+        except OSError as e:
+            if self.failures == 0:
+                print('Push to {0}:{1} failed ({2}); dropping frames until it recovers'.format(self.addr[0], self.addr[1], e))
+            self.failures = self.failures + 1
+            if self.sock:
+                self.sock.close()
+                self.sock = None
+            return False
+
+pusher = None
+
+args = None
 
 MIL = 1000000
 
 last_blink = 0
 
-
-sense = None
-if args.sensehat:
-    print('Attempting to load Sense HAT')
-    try:
-        from sense_hat import SenseHat
-        sense = SenseHat()
-        sense.clear(C_BLACK)
-        sleep(0.25)
-        sense.clear(C_RED)
-        sleep(0.25)
-        sense.clear(C_GREEN)
-        sleep(0.25)
-        sense.clear(C_BLUE)
-        sleep(0.25)
-        sense.clear(C_WHITE)
-        sleep(0.25)
-        sense.clear(C_BLACK)
-        sense.set_rotation(args.led_rotation)
-        sense.low_light = True
-    except:
-        print("Failed to load Sense HAT")
-        if args.sensehat_required:
-            raise
-        sense = None
-
 def control_shutdown():
-    if sense:
-        sense.clear(C_BLUE)
+    if leds:
+        leds.fill(C_BLUE)
         sleep(0.5)
-        sense.clear(C_WHITE)
+        leds.fill(C_WHITE)
         sleep(0.5)
     os.system('sudo shutdown -h now')
 
 def control_reboot():
-    if sense:
-        sense.clear(C_RED)
+    if leds:
+        leds.fill(C_RED)
         sleep(0.5)
-        sense.clear(C_GREEN)
+        leds.fill(C_GREEN)
         sleep(0.5)
     os.system('sudo reboot')
 
-if sense:
+# Loads the Sense HAT, plays the splash and hooks up the joystick.  sense
+# and leds are only set once it's ready, so display() skips samples taken
+# while this runs in the background.
+def init_sensehat():
+    global sense, leds
+    print('Attempting to load Sense HAT')
+    try:
+        from sense_hat import SenseHat
+        hat = SenseHat()
+        hat_leds = Leds(hat)
+        if not args.no_splash:
+            for c in (C_BLACK, C_RED, C_GREEN, C_BLUE, C_WHITE):
+                hat_leds.fill(c)
+                sleep(0.25)
+        hat_leds.fill(C_BLACK)
+        hat.set_rotation(args.led_rotation)
+        hat.low_light = True
+    except:
+        print("Failed to load Sense HAT")
+        if args.sensehat_required:
+            raise
+        return
+
     if args.power_management:
         # Define the functions
         def btn_shutdown():
@@ -227,15 +584,459 @@ if sense:
             print('Rebooting system due to button press')
             control_reboot()
 
-        sense.stick.direction_up = btn_reboot
-        sense.stick.direction_down = btn_reboot
-        sense.stick.direction_left = btn_reboot
-        sense.stick.direction_right = btn_reboot
-        sense.stick.direction_middle = btn_shutdown
+        hat.stick.direction_up = btn_reboot
+        hat.stick.direction_down = btn_reboot
+        hat.stick.direction_left = btn_reboot
+        hat.stick.direction_right = btn_reboot
+        hat.stick.direction_middle = btn_shutdown
+
+    sense, leds = hat, hat_leds
+    if args.sensehat_sensors:
+        start_env_sampler(hat)
+
+class EnvSampler:
+    """Reads the Sense HAT's sensors on a thread of its own and decimates them.
+
+    Humidity, pressure and temperature are read `env_rate` times a second
+    and the accelerometer `imu_rate` times, each read being a slow I2C
+    transaction that update() shouldn't wait on.  Every reading folds into
+    a running count/sum/min/max (plus sum of squares for the acceleration
+    magnitude), and take() hands over the aggregates since the last take()
+    and starts new ones, so each tick's cost is independent of the rates.
+    Vibration is the RMS deviation of the acceleration magnitude from its
+    mean over the tick, in g.
+    """
+
+    CHANNELS = ('humidity', 'pressure', 'hat_temp', 'accel')
+
+    def __init__(self, hat, env_rate, imu_rate):
+        self.hat = hat
+        self.env_rate = env_rate
+        self.imu_rate = imu_rate
+        self.lock = threading.Lock()
+        self.acc = self._blank()
+        self.errors = 0
+        t = Thread(target=self.run, args=(), daemon=True)
+        t.start()
 
+    def _blank(self):
+        # channel -> [n, sum, min, max, sum of squares]
+        return dict((c, [0, 0.0, None, None, 0.0]) for c in self.CHANNELS)
+
+    def _fold(self, channel, v):
+        a = self.acc[channel]
+        a[0] = a[0] + 1
+        a[1] = a[1] + v
+        a[2] = v if a[2] is None or v < a[2] else a[2]
+        a[3] = v if a[3] is None or v > a[3] else a[3]
+        a[4] = a[4] + v * v
+
+    def read_env(self):
+        hat = self.hat
+        humidity = hat.get_humidity()
+        pressure = hat.get_pressure()
+        temp = hat.get_temperature()
+        with self.lock:
+            # the sensors read 0 until they have a measurement; the
+            # temperature comes from the humidity sensor
+            if humidity:
+                self._fold('humidity', humidity)
+                self._fold('hat_temp', temp)
+            if pressure:
+                self._fold('pressure', pressure)
+
+    def read_imu(self):
+        a = self.hat.get_accelerometer_raw()
+        g = (a['x'] ** 2 + a['y'] ** 2 + a['z'] ** 2) ** 0.5
+        with self.lock:
+            self._fold('accel', g)
+
+    def run(self):
+        env_due = imu_due = time.monotonic()
+        while True:
+            now = time.monotonic()
+            try:
+                if self.env_rate > 0 and now >= env_due:
+                    self.read_env()
+                    env_due = max(env_due + 1 / self.env_rate, now)
+                if self.imu_rate > 0 and now >= imu_due:
+                    self.read_imu()
+                    imu_due = max(imu_due + 1 / self.imu_rate, now)
+            except Exception:
+                self.errors = self.errors + 1
+                if self.errors == 1:
+                    print('Sense HAT sensor read failed:')
+                    traceback.print_exc()
+                sleep(1)
+                continue
+            s = min(env_due if self.env_rate > 0 else float('inf'),
+                    imu_due if self.imu_rate > 0 else float('inf')) - time.monotonic()
+            if s == float('inf'):
+                return
+            if s > 0:
+                sleep(s)
+
+    def take(self):
+        with self.lock:
+            acc, self.acc = self.acc, self._blank()
+        ret = {}
+        for c in self.CHANNELS:
+            n, total, lo, hi, squares = acc[c]
+            if n:
+                ret[c] = {'mean': total / n, 'min': lo, 'max': hi, 'n': n}
+        if acc['accel'][0]:
+            n, total, squares = acc['accel'][0], acc['accel'][1], acc['accel'][4]
+            ret['vibration'] = max(0, squares / n - (total / n) ** 2) ** 0.5
+        if self.errors:
+            ret['errors'] = self.errors
+        return ret
+
+env = None
+
+def start_env_sampler(hat):
+    global env
+    env = EnvSampler(hat, args.env_rate, args.imu_rate)
+
+
+# VideoCore mailbox property interface, as used by vcgencmd and the
+# raspberrypi firmware driver.
+MBOX_TAG_GET_ARM_MEMORY = 0x00010005
+MBOX_TAG_GET_VC_MEMORY = 0x00010006
+MBOX_TAG_GET_VOLTAGE = 0x00030003
+MBOX_TAG_GET_THROTTLED = 0x00030046
+MBOX_TAG_GET_CLOCK_RATE_MEASURED = 0x00030047
+MBOX_RESPONSE_OK = 0x80000000
+# firmware clock and voltage ids by their vcgencmd measure_clock/measure_volts names
+MBOX_CLOCKS = {'emmc': 1, 'uart': 2, 'arm': 3, 'core': 4, 'v3d': 5, 'h264': 6, 'isp': 7, 'pixel': 9, 'pwm': 10}
+MBOX_VOLTAGES = {'core': 1, 'sdram_c': 2, 'sdram_p': 3, 'sdram_i': 4}
+IOCTL_MBOX_PROPERTY = 0xc0000000 | (struct.calcsize('P') << 16) | (100 << 8)
+
+class SysfsSampler:
+    """Reads temperature, arm frequency and throttling without forking.
+
+    File descriptors are opened once and re-read with os.pread.  A source
+    that is missing or fails to read returns None, so that callers can fall
+    back to vcgencmd for just that value.
+    """
+
+    def __init__(self, root='/'):
+        self.temp_fd = None
+        for path in sorted(glob.glob(os.path.join(root, 'sys/class/thermal/thermal_zone*/temp'))):
+            self.temp_fd = self._open(path)
+            if self.temp_fd is not None:
+                break
+        self.freq_fds = []
+        paths = glob.glob(os.path.join(root, 'sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq'))
+        for path in sorted(paths, key=lambda p: int(re.search(r'cpu(\d+)/cpufreq', p).group(1))):
+            fd = self._open(path)
+            if fd is not None:
+                self.freq_fds.append(fd)
+        self.vcio_fd = self._open(os.path.join(root, 'dev/vcio'), os.O_RDWR)
+        # one buffer, so fill, ioctl and read happen under mbox_lock: burst
+        # capture calls in from its own thread while update() samples
+        self.mbox = array.array('I', [0] * 8)
+        self.mbox_lock = threading.Lock()
+
+    @staticmethod
+    def _open(path, flags=os.O_RDONLY):
+        try:
+            return os.open(path, flags)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _read_int(fd):
+        if fd is None:
+            return None
+        try:
+            return int(os.pread(fd, 32, 0))
+        except (OSError, ValueError):
+            return None
+
+    def temperature(self):
+        # millidegrees C
+        v = self._read_int(self.temp_fd)
+        return None if v is None else v / 1000
+
+    def arm_freq(self):
+        # kHz; the arm cores share one clock, so cpu0 is representative
+        v = self._read_int(self.freq_fds[0]) if self.freq_fds else None
+        return None if v is None else v * 1000
+
+    def throttled(self):
+        return self.mbox_property(MBOX_TAG_GET_THROTTLED)
+
+    # Sends one property tag with `value` as its first request word and
+    # returns response word `word`: 0 for single-word tags, 1 for the tags
+    # that echo an id back first (clock rates, voltages, memory sizes).
+    def mbox_property(self, tag, value=0, word=0):
+        if self.vcio_fd is None:
+            return None
+        m = self.mbox
+        with self.mbox_lock:
+            # total size, request code, tag, value buffer size, tag request code, value x2, end tag
+            m[0], m[1], m[2], m[3], m[4], m[5], m[6], m[7] = 8 * 4, 0, tag, 8, 0, value, 0, 0
+            try:
+                fcntl.ioctl(self.vcio_fd, IOCTL_MBOX_PROPERTY, m, True)
+            except OSError:
+                return None
+            # the tag's own response bit is unset if the firmware doesn't know it
+            if m[1] != MBOX_RESPONSE_OK or not m[4] & MBOX_RESPONSE_OK:
+                return None
+            return m[5 + word]
+
+    def measured_clock(self, clock):
+        # Hz, as the firmware measures it rather than as cpufreq last set it
+        return self.mbox_property(MBOX_TAG_GET_CLOCK_RATE_MEASURED, clock, 1)
+
+    def voltage(self, id):
+        # microvolts
+        return self.mbox_property(MBOX_TAG_GET_VOLTAGE, id, 1)
+
+    def core_freqs(self):
+        # Hz per core, None where a read fails
+        ret = []
+        for fd in self.freq_fds:
+            v = self._read_int(fd)
+            ret.append(None if v is None else v * 1000)
+        return ret
+
+    def close(self):
+        for fd in [self.temp_fd, self.vcio_fd] + self.freq_fds:
+            if fd is not None:
+                os.close(fd)
+        self.temp_fd = self.vcio_fd = None
+        self.freq_fds = []
+
+sampler = None
+
+class ProcCollector:
+    """Reads per-core load, memory, disk and network counters from /proc.
+
+    /proc/stat, /proc/meminfo, /proc/diskstats and /proc/net/dev stay open
+    and are re-read with os.pread each tick; load and rates are deltas
+    against the previous tick's counters, kept in preallocated arrays.
+    The constructor raises OSError if /proc/stat or /proc/meminfo can't be
+    opened, so callers can fall back to psutil.  Load and memory are
+    computed as psutil does: iowait counts as idle, and used memory is
+    MemTotal - MemAvailable.
+    """
+
+    # /proc/net/dev: receive bytes, then transmit bytes 8 columns later
+    NET_RX = 0
+    NET_TX = 8
+    # /proc/diskstats: sectors read and sectors written (always 512 bytes)
+    DISK_READ = 5
+    DISK_WRITE = 9
+
+    def __init__(self, root='/'):
+        self.stat_fd = os.open(os.path.join(root, 'proc/stat'), os.O_RDONLY)
+        self.meminfo_fd = os.open(os.path.join(root, 'proc/meminfo'), os.O_RDONLY)
+        self.diskstats_fd = SysfsSampler._open(os.path.join(root, 'proc/diskstats'))
+        self.netdev_fd = SysfsSampler._open(os.path.join(root, 'proc/net/dev'))
+        # whole disks only: partitions would count the same I/O twice
+        try:
+            self.disks = set(n.encode() for n in os.listdir(os.path.join(root, 'sys/block'))
+                             if not n.startswith(('loop', 'ram', 'zram')))
+        except OSError:
+            self.disks = set()
+        self.sizes = {}
+        self.btime = None
+        # (total, idle) jiffies per core
+        self.cpu_prev = array.array('d')
+        # bytes read, written, received, sent
+        self.io_prev = array.array('d', [0] * 4)
+        self.io_now = array.array('d', [0] * 4)
+        self.io_time = None
+
+    def _read(self, fd):
+        # grows the read until the whole file fits
+        size = self.sizes.get(fd, 4096)
+        while True:
+            b = os.pread(fd, size, 0)
+            if len(b) < size:
+                return b
+            size = size * 2
+            self.sizes[fd] = size
+
+    def collect(self):
+        ret = {}
+        load = []
+        prev = self.cpu_prev
+        for line in self._read(self.stat_fd).split(b'\n'):
+            if line.startswith(b'cpu') and line[3:4] != b' ':
+                f = line.split()
+                i = int(f[0][3:])
+                if 2 * i + 2 > len(prev):
+                    prev.extend([0] * (2 * i + 2 - len(prev)))
+                # user nice system idle iowait irq softirq steal; guest
+                # time is already counted in user
+                total = 0
+                for x in f[1:9]:
+                    total = total + int(x)
+                idle = int(f[4]) + int(f[5])
+                dt = total - prev[2 * i]
+                di = idle - prev[2 * i + 1]
+                prev[2 * i] = total
+                prev[2 * i + 1] = idle
+                load.append(round(100 * (1 - di / dt), 1) if dt > 0 else 0.0)
+            elif self.btime is None and line.startswith(b'btime'):
+                self.btime = int(line.split()[1])
+        ret['load'] = load
+
+        mem = {}
+        for line in self._read(self.meminfo_fd).split(b'\n'):
+            k, _, v = line.partition(b':')
+            if k in (b'MemTotal', b'MemAvailable', b'MemFree', b'Buffers', b'Cached'):
+                mem[k] = int(v.split()[0])
+        avail = mem.get(b'MemAvailable')
+        if avail is None:
+            # kernels before 3.14
+            avail = mem.get(b'MemFree', 0) + mem.get(b'Buffers', 0) + mem.get(b'Cached', 0)
+        total = mem.get(b'MemTotal')
+        ret['mem'] = round(100 * (total - avail) / total, 1) if total else None
+
+        ret['uptime'] = time.time() - self.btime if self.btime else None
+
+        io = self.io_now
+        io[0] = io[1] = io[2] = io[3] = 0
+        if self.diskstats_fd is not None:
+            for line in self._read(self.diskstats_fd).split(b'\n'):
+                f = line.split()
+                if len(f) > self.DISK_WRITE and f[2] in self.disks:
+                    io[0] = io[0] + int(f[self.DISK_READ]) * 512
+                    io[1] = io[1] + int(f[self.DISK_WRITE]) * 512
+        if self.netdev_fd is not None:
+            for line in self._read(self.netdev_fd).split(b'\n')[2:]:
+                name, _, counters = line.partition(b':')
+                f = counters.split()
+                if len(f) > self.NET_TX and name.strip() != b'lo':
+                    io[2] = io[2] + int(f[self.NET_RX])
+                    io[3] = io[3] + int(f[self.NET_TX])
+        now = time.monotonic()
+        if self.io_time is not None and now > self.io_time:
+            dt = now - self.io_time
+            # a counter that went backwards (32-bit wrap, device removed)
+            # reads as idle for one tick
+            rates = [max(0, io[i] - self.io_prev[i]) / dt for i in range(4)]
+            if self.diskstats_fd is not None:
+                ret['disk_read'] = rates[0]
+                ret['disk_write'] = rates[1]
+            if self.netdev_fd is not None:
+                ret['net_rx'] = rates[2]
+                ret['net_tx'] = rates[3]
+        self.io_time = now
+        self.io_prev, self.io_now = io, self.io_prev
+        return ret
+
+    def close(self):
+        for fd in (self.stat_fd, self.meminfo_fd, self.diskstats_fd, self.netdev_fd):
+            if fd is not None:
+                os.close(fd)
+
+proc_collector = None
+
+class BurstCapture:
+    """Samples the arm clock and throttle bits at a high rate for a short window.
+
+    Reads only through the mailbox, never vcgencmd, so the capture doesn't
+    distort what it measures.  The clock is the firmware's measured rate,
+    not cpufreq's scaling_cur_freq, which only reports the last frequency
+    requested and so misses firmware capping under throttling.  Samples go
+    into buffers allocated once up front; each finished capture is kept
+    (the newest `keep` of them) as an event with a summary and a copy of
+    its samples.
+    """
+
+    def __init__(self, sampler, rate, window, keep, save_dir=None):
+        self.sampler = sampler
+        self.rate = rate
+        self.size = max(1, int(rate * window))
+        self.t = array.array('d', bytes(8 * self.size))
+        self.freq = array.array('I', bytes(4 * self.size))
+        self.bits = array.array('I', bytes(4 * self.size))
+        self.events = collections.deque(maxlen=keep)
+        self.save_dir = save_dir
+        self.lock = threading.Lock()
+        self.running = False
+        self.count = 0
+
+    # Starts a capture in the background; False if one is already running.
+    def trigger(self, reason):
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+        t = Thread(target=self.capture, args=(reason,), daemon=True)
+        t.start()
+        return True
+
+    def capture(self, reason):
+        try:
+            event, samples = self._capture(reason)
+            self.events.append((event, samples))
+            print('Burst capture {0} ({1}): {2}'.format(event['id'], reason, event['summary']))
+            if self.save_dir:
+                os.makedirs(self.save_dir, exist_ok=True)
+                with open(os.path.join(self.save_dir, 'burst-{0}-{1}.json'.format(int(event['time']), event['id'])), 'w') as f:
+                    json.dump(dict(event, samples=samples), f)
+        finally:
+            with self.lock:
+                self.running = False
+
+    def _capture(self, reason):
+        measured_clock, throttled = self.sampler.measured_clock, self.sampler.throttled
+        arm = MBOX_CLOCKS['arm']
+        t, freq, bits = self.t, self.freq, self.bits
+        step = 1 / self.rate
+        start = time.time()
+        t0 = time.perf_counter()
+        due = t0
+        for i in range(self.size):
+            now = time.perf_counter()
+            t[i] = now - t0
+            freq[i] = measured_clock(arm) or 0
+            bits[i] = throttled() or 0
+            due = due + step
+            s = due - time.perf_counter()
+            if s > 0:
+                sleep(s)
+        n = self.size
+        flags = {}
+        for name, b in THROTTLE_FLAGS:
+            # seconds the current-state flag was set
+            flags[name] = sum(t[i + 1] - t[i] for i in range(n - 1) if bits[i] & (1 << b))
+        self.count = self.count + 1
+        event = {
+            'id': self.count,
+            'time': start,
+            'reason': reason,
+            'samples': n,
+            'summary': {
+                'rate': (n - 1) / t[n - 1] if n > 1 and t[n - 1] else None,
+                'freq_min': min(freq),
+                'freq_max': max(freq),
+                'flag_seconds': flags,
+            },
+        }
+        samples = {'t': t.tolist(), 'freq': freq.tolist(), 'throttled': bits.tolist()}
+        return event, samples
+
+    def list(self):
+        return [e for e, _ in self.events]
+
+    def get(self, id):
+        for e, samples in self.events:
+            if e['id'] == id:
+                return dict(e, samples=samples)
+        return None
+
+burst = None
+
+vcgencmd_path = '/opt/vc/bin/vcgencmd'
 
 def vcgencmd(args):
-    v = ["/opt/vc/bin/vcgencmd"]
+    v = [vcgencmd_path]
     v.extend(args)
     proc = subprocess.run(v, stdout=subprocess.PIPE, universal_newlines=True)
     return proc.stdout
@@ -243,22 +1044,145 @@ def vcgencmd(args):
 def vcgencmd_clean(args):
     return vcgencmd(args).strip()
 
-def vcgencmd_parsed(args,meatre):
-    r = vcgencmd_clean(args)
+# results, if given, is a dict from VcgencmdBatch.collect() to parse
+# instead of running vcgencmd again.
+def vcgencmd_parsed(args,meatre,results=None):
+    if results is None:
+        r = vcgencmd_clean(args)
+    else:
+        r = results.get(' '.join(args), '').strip()
     m = re.fullmatch(meatre, r)
     if m is None:
         return None
     return m.group('val')
 
+class VcgencmdBatch:
+    """Collects a fixed list of vcgencmd queries per tick, forking nothing.
+
+    Clock (measure_clock), voltage (measure_volts) and memory split
+    (get_mem) queries are answered through the sysfs sampler's VideoCore
+    mailbox and formatted as vcgencmd would print them.  Anything else, or
+    a mailbox read that fails, goes through one helper shell: it is started
+    once and kept on a pipe, and each tick writes the batch and reads back
+    the replies, split on a marker line, until `timeout` seconds pass.  A
+    helper that misses the deadline is killed and restarted next tick.
+    """
+
+    MARK = '--berrymon-end--'
+
+    def __init__(self, path, queries, sampler=None, timeout=2):
+        self.path = path
+        self.queries = [q.split() for q in queries]
+        self.sampler = sampler
+        self.timeout = timeout
+        self.readers = [self._mailbox(q) for q in self.queries]
+        self.proc = None
+
+    def _mailbox(self, q):
+        # a function reading q's reply from the mailbox, or None
+        s = self.sampler
+        if s is None or s.vcio_fd is None:
+            return None
+        if q[0] == 'measure_clock' and len(q) == 2 and q[1] in MBOX_CLOCKS:
+            clock = MBOX_CLOCKS[q[1]]
+            def read():
+                v = s.measured_clock(clock)
+                return None if v is None else 'frequency({0})={1}\n'.format(clock, v)
+            return read
+        if q[0] == 'measure_volts' and len(q) <= 2 and (q[1:] or ['core'])[0] in MBOX_VOLTAGES:
+            id = MBOX_VOLTAGES[(q[1:] or ['core'])[0]]
+            def read():
+                v = s.voltage(id)
+                return None if v is None else 'volt={0:.4f}V\n'.format(v / 1000000)
+            return read
+        if q[0] == 'get_mem' and len(q) == 2 and q[1] in ('arm', 'gpu'):
+            tag = MBOX_TAG_GET_ARM_MEMORY if q[1] == 'arm' else MBOX_TAG_GET_VC_MEMORY
+            def read():
+                # base address, then size in bytes
+                v = s.mbox_property(tag, 0, 1)
+                return None if v is None else '{0}={1}M\n'.format(q[1], v // (1024 * 1024))
+            return read
+        return None
+
+    def _start(self):
+        self.proc = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+    def collect(self):
+        ret = {}
+        shell = []
+        for q, read in zip(self.queries, self.readers):
+            v = read() if read else None
+            if v is None:
+                shell.append(q)
+            else:
+                ret[' '.join(q)] = v
+        if shell:
+            ret.update(self._run(shell))
+        return ret
+
+    def _run(self, queries):
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+        script = ''.join('{0} {1} 2>&1; echo {2}\n'.format(
+            shlex.quote(self.path), ' '.join(shlex.quote(a) for a in q), self.MARK) for q in queries)
+        mark = (self.MARK + '\n').encode()
+        ret = {}
+        try:
+            self.proc.stdin.write(script.encode())
+            fd = self.proc.stdout.fileno()
+            deadline = time.monotonic() + self.timeout
+            out = b''
+            while out.count(mark) < len(queries):
+                s = deadline - time.monotonic()
+                if s <= 0 or not select.select([fd], [], [], s)[0]:
+                    raise TimeoutError('no reply within {0}s'.format(self.timeout))
+                b = os.read(fd, 4096)
+                if not b:
+                    raise EOFError('vcgencmd helper shell exited')
+                out = out + b
+            for q, reply in zip(queries, out.split(mark)):
+                ret[' '.join(q)] = reply.decode('utf-8', 'replace')
+        except (OSError, ValueError, EOFError) as e:
+            print('vcgencmd helper failed ({0}); restarting it next tick'.format(e))
+            self.close()
+        return ret
+
+    def close(self):
+        if self.proc:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+vc_batch = None
+
+def vc_counter_value(q, results):
+    v = vcgencmd_parsed(q, '[^=]*=(?P<val>-?[.0-9]+)[A-Za-z]*', results)
+    if v is None:
+        return None
+    return float(v) if '.' in v else int(v)
+
 def temperature():
-    return vcgencmd_parsed(['measure_temp'], 'temp=(?P<val>[.0-9]+).+')
+    v = sampler.temperature() if sampler else None
+    if v is None:
+        return vcgencmd_parsed(['measure_temp'], 'temp=(?P<val>[.0-9]+).+')
+    return v
 
 def clock_freq(name):
-    return vcgencmd_parsed(['measure_clock', name], '[^=]+=(?P<val>[.0-9]+)')
-
-def throttle_state():
-    h = vcgencmd_parsed(['get_throttled'], '[^=]+=0x(?P<val>.+)')
-    v = int(h, 16)
+    v = sampler.arm_freq() if sampler and name == 'arm' else None
+    if v is None:
+        return vcgencmd_parsed(['measure_clock', name], '[^=]+=(?P<val>[.0-9]+)')
+    return v
+
+def throttle_bits():
+    v = sampler.throttled() if sampler else None
+    if v is None:
+        h = vcgencmd_parsed(['get_throttled'], '[^=]+=0x(?P<val>.+)')
+        v = int(h, 16)
+    return v
+
+def throttle_state(v=None):
+    if v is None:
+        v = throttle_bits()
     ret = ''
 
     # lower-case letters indicate past-tense;
@@ -302,101 +1226,938 @@ def throttle_state():
 
     return ret
 
+class WebhookDelivery:
+    """Delivers posts to one URL from a single worker thread.
+
+    The HTTP(S) connection stays open between posts.  Posts that pile up
+    while one is in flight, or while the endpoint is down, are coalesced
+    into the next request: a generic webhook gets them all as one JSON
+    {key: [...]} body, while an IFTTT event (which only takes
+    value1..value3) gets the latest.  At most `cap` posts wait; beyond that
+    the oldest are dropped.  Failed requests are retried with exponential
+    backoff up to `max_backoff` seconds.
+    """
+
+    def __init__(self, url, ifttt=False, cap=100, max_backoff=300, key='samples'):
+        u = urllib.parse.urlsplit(url)
+        self.https = u.scheme == 'https'
+        self.host = u.netloc
+        self.path = (u.path or '/') + ('?' + u.query if u.query else '')
+        self.ifttt = ifttt
+        self.key = key
+        self.max_backoff = max_backoff
+        self.conn = None
+        self.queue = collections.deque(maxlen=cap)
+        self.ready = threading.Condition()
+        self.sent = 0
+        self.dropped = 0
+        self.failures = 0
+        t = Thread(target=self.run, args=(), daemon=True)
+        t.start()
+
+    def post(self, item):
+        with self.ready:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped = self.dropped + 1
+            self.queue.append(item)
+            self.ready.notify()
+
+    def run(self):
+        backoff = 0
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.queue)
+                batch = list(self.queue)
+                self.queue.clear()
+            try:
+                self.send(batch)
+                self.sent = self.sent + len(batch)
+                backoff = 0
+            except (OSError, http.client.HTTPException) as e:
+                self.failures = self.failures + 1
+                if self.conn:
+                    self.conn.close()
+                    self.conn = None
+                backoff = min(self.max_backoff, backoff * 2 or 1)
+                print('Post to {0} failed ({1}); retrying in {2}s'.format(self.host, e, backoff))
+                with self.ready:
+                    # put the batch back in front of anything newer; the
+                    # capped deque drops the oldest if that overflows it
+                    pending = batch + list(self.queue)
+                    self.dropped = self.dropped + max(0, len(pending) - self.queue.maxlen)
+                    self.queue.clear()
+                    self.queue.extend(pending)
+                sleep(backoff)
+
+    def send(self, batch):
+        if self.ifttt:
+            body = urllib.parse.urlencode(batch[-1])
+            ctype = 'application/x-www-form-urlencoded'
+        else:
+            body = json.dumps({self.key: batch})
+            ctype = 'application/json'
+        if self.conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self.conn = cls(self.host, timeout=30)
+        self.conn.request('POST', self.path, body.encode('utf-8'), {'Content-Type': ctype})
+        resp = self.conn.getresponse()
+        resp.read()
+        if resp.status == 429 or resp.status >= 500:
+            raise http.client.HTTPException('HTTP {0} {1}'.format(resp.status, resp.reason))
+        if resp.status >= 400:
+            # retrying won't help
+            print('Post to {0} rejected: HTTP {1} {2}'.format(self.host, resp.status, resp.reason))
+
+ifttt_delivery = None
+webhook_delivery = None
+
 def ifttt_report(v1, v2, v3):
-    if not (args.ifttt and 'IFTTT_TOKEN' in os.environ):
+    if not ifttt_delivery:
         return
+    ifttt_delivery.post({'value1' : v1,
+                         'value2' : v2,
+                         'value3' : v3 })
 
-    def ifttt_report_impl():
-        url = 'https://maker.ifttt.com/trigger/berry_metrics/with/key/' + os.environ['IFTTT_TOKEN']
-        values = {'value1' : v1,
-                'value2' : v2,
-                'value3' : v3 }
-        form = urllib.parse.urlencode(values)
-        data = form.encode('utf-8')
-        req = urllib.request.Request(url, data)
-        with urllib.request.urlopen(req) as resp:
-            _ = resp.read()
-
-    t = Thread(target=ifttt_report_impl, args=())
-    t.start()
+def parse_duration(v):
+    m = re.fullmatch(r'([.0-9]+)([smhd]?)', v)
+    if m is None:
+        raise ValueError('bad duration: ' + v)
+    return float(m.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+
+# [name:] metric op value [for|avg|min|max duration] [-> sink,...]
+RULE_RE = re.compile(r"""(?:(?P<name>[\w.-]+)\s*:\s*)?(?P<metric>[\w~]+)\s*"""
+                     r"""(?P<op>>=|<=|==|!=|>|<|not\s+contains\b|contains\b)\s*"""
+                     r"""(?P<value>'[^']*'|"[^"]*"|[-+]?[.0-9]+(?:[eE][-+]?[0-9]+)?)"""
+                     r"""(?:\s+(?P<window>for|avg|min|max)\s+(?P<dur>[.0-9]+[smhd]?))?"""
+                     r"""(?:\s*->\s*(?P<sinks>[\w,\s]+))?""")
+
+RULE_OPS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    'contains': lambda a, b: b in str(a),
+    'not contains': lambda a, b: b not in str(a),
+}
 
-def drawbar(val, vmin, vmax, x, color):
+RULE_SINKS = ('log', 'webhook', 'led')
+
+# The sample keys a rule can test, as they stand when rules are evaluated:
+# numbers (lists of numbers compare by their greatest), or text that takes
+# ==, != and contains (lists of names, like top_cpu, are searched as text).
+# vc_* counters from --vc_counters are numbers.
+RULE_NUMBERS = ('temp', 'freq', 'throttled', 'mem', 'uptime', 'load', 'freqs',
+                'disk_read', 'disk_write', 'net_rx', 'net_tx', '_period')
+RULE_TEXT = ('state', 'top_cpu', 'top_rss', '~name', '~machine', '~dist', '~release', '~system', '~version')
+
+def rule_metric_kind(metric):
+    if metric in RULE_NUMBERS or metric.startswith('vc_'):
+        return 'number'
+    if metric in RULE_TEXT:
+        return 'text'
+    return None
+
+class Rule:
+    """One compiled alert rule, with the running state of its window.
+
+    `for D` holds only once the condition has been true for D seconds.
+    `avg|min|max D` compare the mean, least or greatest value of the
+    samples in the last D seconds, once D seconds have been seen: the mean
+    from a running sum and the min/max from a monotonic deque, so each
+    sample costs amortized O(1) whatever the window.  List metrics (load)
+    are compared by their greatest element.  The metric and the comparison
+    are checked against RULE_NUMBERS and RULE_TEXT when the rule is built,
+    so a rule can't fail on a sample later.
+    """
+
+    def __init__(self, text):
+        m = RULE_RE.fullmatch(text)
+        if m is None:
+            raise ValueError('bad rule: ' + text)
+        self.text = text
+        self.metric = m.group('metric')
+        self.op = ' '.join(m.group('op').split())
+        self.test = RULE_OPS[self.op]
+        value = m.group('value')
+        if value[0] in '\'"':
+            self.value = value[1:-1]
+        else:
+            self.value = float(value)
+        self.window = m.group('window')
+        self.dur = parse_duration(m.group('dur')) if self.window else 0
+        self.sinks = [x.strip() for x in (m.group('sinks') or 'log').split(',') if x.strip()]
+        self.name = m.group('name') or text.split('->')[0].strip()
+        self.kind = rule_metric_kind(self.metric)
+        if self.kind is None:
+            raise ValueError('unknown metric {0} (expected one of {1} or vc_*): {2}'.format(
+                self.metric, ', '.join(RULE_NUMBERS + RULE_TEXT), text))
+        if ('contains' in self.op) != isinstance(self.value, str) and self.op not in ('==', '!='):
+            raise ValueError('contains takes a quoted string and comparisons a number: ' + text)
+        if isinstance(self.value, str) != (self.kind == 'text'):
+            raise ValueError('{0} is {1}, so it takes {2}: {3}'.format(
+                self.metric, 'text' if self.kind == 'text' else 'a number',
+                '==, != or contains and a quoted string' if self.kind == 'text' else 'a numeric comparison', text))
+        if self.window in ('avg', 'min', 'max') and (isinstance(self.value, str) or self.dur <= 0):
+            raise ValueError('avg/min/max need a numeric value and a duration: ' + text)
+        for x in self.sinks:
+            if x not in RULE_SINKS:
+                raise ValueError('unknown alert sink {0} (expected {1}): {2}'.format(x, ', '.join(RULE_SINKS), text))
+        self.firing = False
+        self.last = None
+        self.since = None
+        self.start = None
+        self.samples = collections.deque()
+        self.total = 0.0
+
+    def aggregate(self, t, v):
+        q = self.samples
+        if self.start is None:
+            self.start = t
+        if self.window == 'avg':
+            q.append((t, v))
+            self.total = self.total + v
+            while q[0][0] <= t - self.dur:
+                self.total = self.total - q.popleft()[1]
+            if len(q) == 1:
+                # shed rounding error whenever the window restarts
+                self.total = v
+            ret = self.total / len(q)
+        else:
+            # the front of q is the window's min (or max); anything behind
+            # a newer, more extreme value can never be it
+            if self.window == 'max':
+                while q and q[-1][1] <= v:
+                    q.pop()
+            else:
+                while q and q[-1][1] >= v:
+                    q.pop()
+            q.append((t, v))
+            while q[0][0] <= t - self.dur:
+                q.popleft()
+            ret = q[0][1]
+        if t - self.start < self.dur:
+            return None
+        return ret
+
+    # Returns whether the rule is firing after this sample, and whether that
+    # changed.
+    def evaluate(self, t, data):
+        v = data.get(self.metric)
+        if self.kind == 'text':
+            if v is not None and not isinstance(v, str):
+                v = str(v)
+        elif isinstance(v, list):
+            v = max((x for x in v if x is not None), default=None)
+        if v is None:
+            return self.firing, False
+        if self.window in ('avg', 'min', 'max'):
+            v = self.aggregate(t, float(v))
+            if v is None:
+                return self.firing, False
+        ok = self.test(v, self.value)
+        if self.window == 'for':
+            if not ok:
+                self.since = None
+            elif self.since is None:
+                self.since = t
+            ok = ok and t - self.since >= self.dur
+        changed = ok != self.firing
+        self.firing = ok
+        self.last = v
+        return ok, changed
+
+class Rules:
+    """Alert rules read from a file, one per line; blank and # lines are skipped.
+
+    Rules are evaluated on every sample, but only notify their sinks when
+    they start or stop firing.
+    """
+
+    def __init__(self, path):
+        self.rules = []
+        names = set()
+        with open(path, 'r') as f:
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    r = Rule(line)
+                except ValueError as e:
+                    raise ValueError('{0}:{1}: {2}'.format(path, n, e))
+                if r.name in names:
+                    raise ValueError('{0}:{1}: duplicate rule name {2}'.format(path, n, r.name))
+                names.add(r.name)
+                self.rules.append(r)
+
+    # Returns the names of the rules firing after sample `data` at time t.
+    def evaluate(self, t, data):
+        firing = []
+        for r in self.rules:
+            ok, changed = r.evaluate(t, data)
+            if changed:
+                alert_report(r, t)
+            if ok:
+                firing.append(r.name)
+        return firing
+
+    # Whether any of the firing rules named shows on the LEDs.
+    def led(self, firing):
+        return any(r.name in firing and 'led' in r.sinks for r in self.rules)
+
+rules = None
+alert_ifttt_delivery = None
+alert_webhook_delivery = None
+
+def alert_report(rule, t):
+    state = 'firing' if rule.firing else 'resolved'
+    if 'log' in rule.sinks:
+        print('Alert {0} {1}: {2} = {3} ({4})'.format(rule.name, state, rule.metric, rule.last, rule.text))
+    if 'webhook' in rule.sinks:
+        if alert_ifttt_delivery:
+            alert_ifttt_delivery.post({'value1': rule.name,
+                                       'value2': state,
+                                       'value3': rule.last})
+        if alert_webhook_delivery:
+            alert_webhook_delivery.post({'alert': rule.name, 'state': state, 'time': t,
+                                         'metric': rule.metric, 'value': rule.last, 'rule': rule.text})
+
+def drawbar(frame, val, vmin, vmax, x, color):
     lin = (val - vmin) / (vmax - vmin)
     mlin = int(max(0,min(8,round(lin * 8,0))))
     for y in range(0, 8):
         if y < mlin:
-            sense.set_pixel(x,y,color)
+            put(frame,x,y,color)
         else:
-            sense.set_pixel(x,y,C_BLACK)
+            put(frame,x,y,C_BLACK)
     if mlin == 0:
-        sense.set_pixel(x,0,C_RED)
+        put(frame,x,0,C_RED)
 
-def display(temp, freq, state):
+def display(temp, freq, state, alert=False):
     global last_blink
-    if not sense:
+    if not leds:
         return
     def display_impl(blink):
+        frame = blank()
         if blink:
-            sense.set_pixel(0,0,C_DIM)
-            sense.set_pixel(0,1,C_BLACK)
+            put(frame,0,0,C_DIM)
+            put(frame,0,1,C_BLACK)
         else:
-            sense.set_pixel(0,0,C_BLACK)
-            sense.set_pixel(0,1,C_DIM)
-        drawbar(temp, min_temp, max_temp, 2, C_GREEN)
-        drawbar(freq, min_freq, max_freq, 4, C_BLUE)
+            put(frame,0,0,C_BLACK)
+            put(frame,0,1,C_DIM)
+        drawbar(frame, temp, min_temp, max_temp, 2, C_GREEN)
+        drawbar(frame, freq, min_freq, max_freq, 4, C_BLUE)
 
-        sense.set_pixel(7,0,C_RED if ('U' in state) else C_BLACK)
-        sense.set_pixel(7,1,C_GREEN if ('C' in state) else C_BLACK)
-        sense.set_pixel(7,2,C_BLUE if ('T' in state) else C_BLACK)
+        put(frame,7,0,C_RED if ('U' in state) else C_BLACK)
+        put(frame,7,1,C_GREEN if ('C' in state) else C_BLACK)
+        put(frame,7,2,C_BLUE if ('T' in state) else C_BLACK)
 
-        sense.set_pixel(7,5,C_RED if ('u' in state) else C_BLACK)
-        sense.set_pixel(7,6,C_GREEN if ('c' in state) else C_BLACK)
-        sense.set_pixel(7,7,C_BLUE if ('t' in state) else C_BLACK)
+        put(frame,7,3,C_YELLOW if alert else C_BLACK)
+        put(frame,7,4,C_YELLOW if alert else C_BLACK)
+
+        put(frame,7,5,C_RED if ('u' in state) else C_BLACK)
+        put(frame,7,6,C_GREEN if ('c' in state) else C_BLACK)
+        put(frame,7,7,C_BLUE if ('t' in state) else C_BLACK)
+        leds.show(frame)
 
     #t = Thread(target=display_impl, args=(last_blink < 1,))
     #t.start()
     display_impl(last_blink<1)
     last_blink = 1 - last_blink
 
-printon = 0
-ifttton = 0
-
-data = {
-    '~name': platform.node(),
-    '~machine': platform.machine(),
-    '~dist': platform.dist(),
-    '~release': platform.release(),
-    '~system': platform.system(),
-    '~version': platform.version(),
-    '_now': 0
-}
+class Ring:
+    """Preallocated ring buffer of timestamped rows of float columns."""
+
+    def __init__(self, size, cols):
+        self.size = size
+        self.t = array.array('d', bytes(8 * size))
+        self.cols = [array.array('f', bytes(4 * size)) for _ in range(cols)]
+        # total rows ever appended; the live rows are [start(), n)
+        self.n = 0
+
+    def append(self, t, *vals):
+        i = self.n % self.size
+        self.t[i] = t
+        for c, v in zip(self.cols, vals):
+            c[i] = v
+        self.n = self.n + 1
+
+    def start(self):
+        return max(0, self.n - self.size)
+
+    def oldest(self):
+        return self.t[self.start() % self.size] if self.n else None
+
+    def __getitem__(self, i):
+        return self.t[i % self.size]
+
+    def find(self, t):
+        # first live row at or after t; rows are appended in time order
+        return bisect.bisect_left(self, t, self.start(), self.n)
+
+    def find_after(self, t):
+        # first live row strictly after t
+        return bisect.bisect_right(self, t, self.start(), self.n)
+
+    def row(self, i):
+        i = i % self.size
+        return (self.t[i],) + tuple(c[i] for c in self.cols)
+
+class MetricHistory:
+    """Raw samples plus 1-minute and 1-hour min/max/mean rollups of one metric.
+
+    Bitmask metrics (bits=True) roll up as AND/OR of the samples, with the
+    fraction of non-zero samples as the mean.
+    """
+
+    def __init__(self, raw, minutes, hours, bits=False):
+        self.bits = bits
+        self.raw = Ring(raw, 1)
+        self.rollups = [(60, Ring(minutes, 3), [None, 0, 0, 0, 0]),
+                        (3600, Ring(hours, 3), [None, 0, 0, 0, 0])]
+
+    def add(self, t, v):
+        self.raw.append(t, v)
+        if self.bits:
+            v = int(v)
+        for width, ring, acc in self.rollups:
+            bucket = t - t % width
+            if acc[0] != bucket:
+                if acc[1]:
+                    ring.append(acc[0], acc[2], acc[3], acc[4] / acc[1])
+                acc[:] = [bucket, 0, v, v, 0]
+            self._combine(acc, v, v, (1 if v else 0) if self.bits else v)
+
+    def _combine(self, acc, lo, hi, mean):
+        # acc is [bucket, count, min, max, sum of means]
+        if self.bits:
+            acc[2], acc[3] = acc[2] & lo, acc[3] | hi
+        else:
+            acc[2], acc[3] = min(acc[2], lo), max(acc[3], hi)
+        acc[1], acc[4] = acc[1] + 1, acc[4] + mean
+
+    def tier(self, since, step):
+        # coarsest tier no coarser than step that still reaches back to
+        # since (or has never wrapped); otherwise the coarsest tier at all
+        tiers = [(1, self.raw, None)] + self.rollups
+        best = None
+        for tier in tiers:
+            width, ring, _ = tier
+            if ring.n <= ring.size or ring.oldest() <= since:
+                if best is None or width <= max(step, 1):
+                    best = tier
+        return best or tiers[-1]
+
+    def query(self, since, step):
+        width, ring, pending = self.tier(since, step)
+        ret = {'tier': width, 't': [], 'min': [], 'max': [], 'mean': []}
+        if pending is None:
+            first = ring.find(since)
+        else:
+            # rollup rows are bucket starts; keep buckets that overlap since
+            first = ring.find_after(since - width)
+        rows = (ring.row(i) for i in range(first, ring.n))
+        if pending is not None and pending[1]:
+            # the bucket still being accumulated
+            rows = itertools.chain(rows, [(pending[0], pending[2], pending[3], pending[4] / pending[1])])
+        acc = [None, 0, 0, 0, 0]
+        for row in rows:
+            if pending is None:
+                t, lo, hi, mean = row[0], row[1], row[1], row[1]
+            else:
+                t, lo, hi, mean = row
+            if self.bits:
+                lo, hi = int(lo), int(hi)
+                if pending is None:
+                    mean = 1 if lo else 0
+            b = t - t % step if step > 0 else t
+            if b != acc[0]:
+                self._emit(ret, acc)
+                acc[:] = [b, 0, lo, hi, 0]
+            self._combine(acc, lo, hi, mean)
+        self._emit(ret, acc)
+        return ret
+
+    @staticmethod
+    def _emit(ret, acc):
+        if acc[1]:
+            ret['t'].append(acc[0])
+            ret['min'].append(acc[2])
+            ret['max'].append(acc[3])
+            ret['mean'].append(acc[4] / acc[1])
+
+class History:
+    """Per-metric in-memory time series fed once per update()."""
+
+    BITS = ('throttled',)
+
+    def __init__(self, raw, minutes, hours):
+        self.sizes = (raw, minutes, hours)
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _add(self, name, t, v):
+        # a source that failed to read this tick leaves a gap
+        if v is None:
+            return
+        h = self.metrics.get(name)
+        if h is None:
+            h = MetricHistory(*self.sizes, bits=name in self.BITS)
+            self.metrics[name] = h
+        h.add(t, v)
+
+    def add(self, t, sample):
+        with self.lock:
+            for name in ('temp', 'freq', 'mem', 'throttled'):
+                self._add(name, t, sample[name])
+            for i, v in enumerate(sample['load']):
+                self._add('load' + str(i), t, v)
+            for name in ('disk_read', 'disk_write', 'net_rx', 'net_tx'):
+                if name in sample:
+                    self._add(name, t, sample[name])
+            for name, v in sample.get('env', {}).items():
+                if name in EnvSampler.CHANNELS:
+                    self._add(name, t, v['mean'])
+                elif name == 'vibration':
+                    self._add(name, t, v)
+            if '_period' in sample:
+                self._add('period', t, sample['_period'])
+
+    def query(self, metric, since, step):
+        with self.lock:
+            h = self.metrics.get(metric)
+            if h is None:
+                return None
+            ret = h.query(since, step)
+        ret['metric'] = metric
+        return ret
+
+history = None
+
+class ProcessCollector:
+    """Top processes by CPU and by resident memory, sampled incrementally.
+
+    Sampling runs on a thread of its own: collect() wakes it and returns
+    the top lists it finished for the previous tick, so update() never
+    walks the process table.  Each process's /proc/<pid>/stat stays open
+    and is re-read with os.pread for its CPU time and resident memory, the
+    only per-process read on most ticks.  Where it can't be opened (no
+    procfs, out of file descriptors) psutil is used instead: cpu_percent()
+    each tick, and memory, which moves slowly, only on refresh.  Every
+    `refresh` ticks the PID list is re-read and names are looked up for
+    new processes only.  The top N come from a heap, not a full sort.
+    """
+
+    try:
+        CLK_TCK = os.sysconf('SC_CLK_TCK')
+        PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        CLK_TCK, PAGE_SIZE = 100, 4096
+
+    def __init__(self, n, refresh):
+        self.n = n
+        self.refresh = refresh
+        # pid -> [Process, name, rss, stat fd, cpu ticks, monotonic time]
+        self.procs = {}
+        self.tick = 0
+        self.top = {'cpu': [], 'rss': []}
+        self.due = threading.Event()
+        t = Thread(target=self.run, args=(), daemon=True)
+        t.start()
+
+    @staticmethod
+    def _open_stat(pid):
+        return SysfsSampler._open('/proc/{0}/stat'.format(pid))
+
+    @classmethod
+    def _stat(cls, fd):
+        # (utime + stime, rss bytes); the name in parentheses may hold
+        # spaces, so fields are counted from after its closing parenthesis
+        # (state is field 3, utime 14, stime 15, rss pages 24)
+        b = os.pread(fd, 1024, 0)
+        f = b[b.rindex(b')') + 2:].split(None, 22)
+        return int(f[11]) + int(f[12]), int(f[21]) * cls.PAGE_SIZE
+
+    def _drop(self, pid):
+        fd = self.procs.pop(pid)[3]
+        if fd is not None:
+            os.close(fd)
+
+    def _refresh(self):
+        import psutil
+        pids = set(psutil.pids())
+        for pid in list(self.procs):
+            if pid not in pids:
+                self._drop(pid)
+        for pid, row in list(self.procs.items()):
+            if row[3] is not None:
+                continue
+            try:
+                row[2] = row[0].memory_info().rss
+            except psutil.NoSuchProcess:
+                self._drop(pid)
+            except psutil.Error:
+                pass
+        for pid in pids.difference(self.procs):
+            fd = None
+            try:
+                p = psutil.Process(pid)
+                with p.oneshot():
+                    fd = self._open_stat(pid)
+                    # the first read only primes the CPU counters
+                    if fd is None:
+                        p.cpu_percent(None)
+                        ticks, rss = 0, p.memory_info().rss
+                    else:
+                        ticks, rss = self._stat(fd)
+                    self.procs[pid] = [p, p.name(), rss, fd, ticks, time.monotonic()]
+            except (psutil.Error, OSError, ValueError):
+                if fd is not None:
+                    os.close(fd)
+
+    def _collect(self):
+        import psutil
+        if self.tick % self.refresh == 0:
+            self._refresh()
+        self.tick = self.tick + 1
+        rows = []
+        for pid, row in list(self.procs.items()):
+            p, name, fd = row[0], row[1], row[3]
+            try:
+                if fd is None:
+                    cpu = p.cpu_percent(None)
+                else:
+                    (ticks, row[2]), now = self._stat(fd), time.monotonic()
+                    # percent of one core, as psutil reports it
+                    cpu = 100 * (ticks - row[4]) / self.CLK_TCK / (now - row[5]) if now > row[5] else 0.0
+                    row[4], row[5] = ticks, now
+                rows.append((cpu, row[2], pid, name))
+            except (psutil.NoSuchProcess, OSError, ValueError):
+                # a stat file reads ESRCH once its process has exited
+                self._drop(pid)
+            except psutil.Error:
+                pass
+        return {
+            'cpu': [[pid, name, cpu] for cpu, _, pid, name in heapq.nlargest(self.n, rows, key=lambda r: r[0])],
+            'rss': [[pid, name, rss] for _, rss, pid, name in heapq.nlargest(self.n, rows, key=lambda r: r[1])],
+        }
+
+    def run(self):
+        while True:
+            self.due.wait()
+            self.due.clear()
+            try:
+                self.top = self._collect()
+            except Exception:
+                print('Process sampling failed:')
+                traceback.print_exc()
+
+    def collect(self):
+        self.due.set()
+        return self.top
+
+processes = None
+
+class Stats:
+    """berrymon's own costs: per-stage latency histograms and loop counters.
+
+    Each stage (a collector, a sink, an HTTP handler...) gets a histogram
+    with fixed bucket bounds, so observing is a bisect and a few additions
+    whatever the traffic.  The loop counts ticks that overran their
+    period and scheduled ticks it skipped as a result; sample_self()
+    reads our resident memory and CPU use since its previous call.
+    """
+
+    # upper bounds in seconds, as Prometheus `le` buckets; the last bucket
+    # is everything slower
+    BUCKETS = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # stage -> [bucket counts, count, sum, max]
+        self.stages = {}
+        self.overruns = 0
+        self.skipped = 0
+        self.rss = None
+        self.cpu = None
+        self.statm_fd = SysfsSampler._open('/proc/self/statm')
+        self.cpu_ref = (time.monotonic(), time.process_time())
+
+    def observe(self, stage, seconds):
+        i = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            h = self.stages.get(stage)
+            if h is None:
+                h = self.stages[stage] = [array.array('L', [0] * (len(self.BUCKETS) + 1)), 0, 0.0, 0.0]
+            h[0][i] = h[0][i] + 1
+            h[1] = h[1] + 1
+            h[2] = h[2] + seconds
+            if seconds > h[3]:
+                h[3] = seconds
+
+    def sample_self(self):
+        if self.statm_fd is not None:
+            try:
+                self.rss = int(os.pread(self.statm_fd, 128, 0).split()[1]) * mmap.PAGESIZE
+            except (OSError, ValueError, IndexError):
+                self.rss = None
+        now, cpu = time.monotonic(), time.process_time()
+        if now > self.cpu_ref[0]:
+            # of one core, across all our threads
+            self.cpu = round(100 * (cpu - self.cpu_ref[1]) / (now - self.cpu_ref[0]), 1)
+        self.cpu_ref = (now, cpu)
+
+    # Compact per-stage figures (seconds) for each sample's data['_stats'].
+    def summary(self):
+        with self.lock:
+            stages = dict((name, {'n': h[1], 'mean': h[2] / h[1], 'max': h[3]}) for name, h in self.stages.items())
+        return {'stages': stages, 'overruns': self.overruns, 'skipped': self.skipped, 'rss': self.rss, 'cpu': self.cpu}
+
+    # Everything, including the bucket counts, for /debug/stats.
+    def report(self):
+        with self.lock:
+            stages = dict((name, {'counts': h[0].tolist(), 'n': h[1], 'sum': h[2], 'max': h[3]}) for name, h in self.stages.items())
+        return {'buckets': list(self.BUCKETS), 'stages': stages,
+                'overruns': self.overruns, 'skipped': self.skipped, 'rss': self.rss, 'cpu': self.cpu}
+
+stats = None
+
+# Calls fn(*args, **kwargs), adding its run time to `stage`.
+def timed(stage, fn, *args, **kwargs):
+    if not stats:
+        return fn(*args, **kwargs)
+    t0 = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        stats.observe(stage, time.perf_counter() - t0)
+
+class Sink:
+    """Runs one consumer of published snapshots on its own worker thread.
+
+    Snapshots wait in a bounded queue; once it is full the oldest waiting
+    one is dropped, so a slow sink loses samples rather than delaying the
+    sampling loop.  A sample handled more than a period after it was
+    published counts as late.
+    """
+
+    def __init__(self, name, fn, size):
+        self.name = name
+        self.fn = fn
+        self.queue = collections.deque(maxlen=size)
+        self.ready = threading.Condition()
+        self.dropped = 0
+        self.late = 0
+        self.stopping = False
+        self.thread = Thread(target=self.run, args=(), daemon=True)
+        self.thread.start()
+
+    def publish(self, snap):
+        with self.ready:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped = self.dropped + 1
+            self.queue.append((time.time(), snap))
+            self.ready.notify()
+
+    def run(self):
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.queue or self.stopping)
+                if not self.queue:
+                    return
+                when, snap = self.queue.popleft()
+            if time.time() - when > current_period():
+                self.late = self.late + 1
+            try:
+                timed('sink.' + self.name, self.fn, snap)
+            except Exception:
+                print('Sink {0} failed:'.format(self.name))
+                traceback.print_exc()
+
+    def stop(self, timeout):
+        # finishes what is queued, waiting at most timeout seconds
+        with self.ready:
+            self.stopping = True
+            self.ready.notify()
+        self.thread.join(timeout)
+
+    def stats(self):
+        return {'dropped': self.dropped, 'late': self.late}
+
+class AdaptiveScheduler:
+    """Chooses the sampling period from the latest temperature and throttling.
+
+    Fast while any current (upper-case) throttle flag is set or temperature
+    climbs faster than `rise` C/s, and for `hold` seconds after; slow once
+    temperature drops below `cool`, until it climbs 2C back above it;
+    otherwise normal.  The hold time and the 2C band keep it from flapping.
+    """
+
+    def __init__(self, normal, slow, fast, rise, hold, cool):
+        self.normal = normal
+        self.slow = slow
+        self.fast = fast
+        self.rise = rise
+        self.hold = hold
+        self.cool = cool
+        self.ref = None
+        self.rate = 0
+        self.fast_until = 0
+        self.period = normal
+
+    def next_period(self, t, temp, bits):
+        # measure the rise over at least a second; faster samples are mostly
+        # sensor quantization
+        if self.ref is None:
+            self.ref = (t, temp)
+        elif t - self.ref[0] >= 1:
+            self.rate = (temp - self.ref[1]) / (t - self.ref[0])
+            self.ref = (t, temp)
+        if bits & 0x7 or self.rate > self.rise:
+            self.fast_until = t + self.hold
+        if t < self.fast_until:
+            self.period = self.fast
+        elif temp < self.cool or (self.period == self.slow and temp < self.cool + 2):
+            self.period = self.slow
+        else:
+            self.period = self.normal
+        return self.period
+
+scheduler = None
+
+# The period until the next sample.
+def current_period():
+    return scheduler.period if scheduler else args.period
+
+# Published to by oneshot(); filled in by main().
+sinks = []
+
+# Static platform info, probed once in the background by probe_platform()
+# and shared by every snapshot taken after that.
+PLATFORM = {}
+
+def probe_platform():
+    global PLATFORM
+    PLATFORM = {
+        '~name': platform.node(),
+        '~machine': platform.machine(),
+        '~dist': platform.dist(),
+        '~release': platform.release(),
+        '~system': platform.system(),
+        '~version': platform.version(),
+    }
+
+# The latest published sample.  update() builds a fresh data dict and swaps
+# in a new Snapshot; nothing mutates a Snapshot or its data once published,
+# so readers on any thread take a reference and share it without copying.
+# delta holds just the entries that changed since the previous snapshot,
+# less SELF_KEYS.
+Snapshot = collections.namedtuple('Snapshot', ['seq', 'last', 'data', 'delta'])
+
+# berrymon's own cost figures, which change on every tick: they stay in
+# each snapshot's data and in /debug/stats, but are left out of deltas and
+# webhook posts, which they would otherwise bloat with every sample.
+SELF_KEYS = ('_stats', '_sinks')
+
+def changed(prev, data):
+    return {k: v for k, v in data.items() if k not in SELF_KEYS and prev.get(k) != v}
+
+snapshot = Snapshot(0, None, {'_now': 0}, {})
+
+# Notified whenever update() publishes a new snapshot.
+published = threading.Condition()
+
+# Blocks until a snapshot newer than seq `after` is published, or timeout.
+def wait_snapshot(after, timeout):
+    with published:
+        published.wait_for(lambda: snapshot.seq > after, timeout)
+        return snapshot
+
+def psutil_counters():
+    import psutil
+    return {'load': psutil.cpu_percent(percpu=True),
+            'mem': psutil.virtual_memory().percent,
+            'uptime': time.time() - psutil.boot_time()}
 
 def update():
-    global printon, ifttton, data, last
-    data2 = copy.deepcopy(data)
-    data2['temp'] = float(temperature())
-    data2['freq'] = int(clock_freq('arm'))
-    data2['state'] = throttle_state()
-    data2['load'] = psutil.cpu_percent(percpu=True)
-    data2['mem'] = psutil.virtual_memory().percent
-    data2['uptime'] = time.time() - psutil.boot_time()
-    data = data2
+    timed('update', update_impl)
+
+def update_impl():
+    global snapshot
+    data2 = dict(PLATFORM)
+    data2['temp'] = float(timed('temperature', temperature))
+    data2['freq'] = int(timed('clock_freq', clock_freq, 'arm'))
+    data2['throttled'] = timed('throttle', throttle_bits)
+    data2['state'] = throttle_state(data2['throttled'])
+    if proc_collector:
+        data2.update(timed('proc', proc_collector.collect))
+    else:
+        data2.update(timed('psutil', psutil_counters))
+    if sampler and len(sampler.freq_fds) > 1:
+        data2['freqs'] = timed('core_freqs', sampler.core_freqs)
+    if env:
+        data2['env'] = env.take()
+    if processes:
+        top = timed('processes', processes.collect)
+        data2['top_cpu'] = top['cpu']
+        data2['top_rss'] = top['rss']
+    if vc_batch:
+        vc = timed('vcgencmd', vc_batch.collect)
+        for q in vc_batch.queries:
+            data2['vc_' + '_'.join(q)] = vc_counter_value(q, vc)
+    # a newly raised throttle flag, current or sticky, since the last sample
+    prev_bits = snapshot.data.get('throttled')
+    if burst and prev_bits is not None and (data2['throttled'] & ~prev_bits) & 0xF000F:
+        burst.trigger('throttled 0x{0:x}'.format(data2['throttled']))
+    if scheduler:
+        data2['_period'] = scheduler.next_period(time.time(), data2['temp'], data2['throttled'])
+    if rules:
+        data2['_alerts'] = timed('rules', rules.evaluate, time.time(), data2)
+    if stats:
+        stats.sample_self()
+        data2['_stats'] = stats.summary()
     last = datetime.now()
+    data2['_now'] = last.strftime('%Y-%m-%d %H:%M:%S.%f %Z')
+    if sinks:
+        data2['_sinks'] = dict((sink.name, sink.stats()) for sink in sinks)
+    delta = changed(snapshot.data, data2)
+    with published:
+        snapshot = Snapshot(snapshot.seq + 1, last, data2, delta)
+        published.notify_all()
+    if history:
+        timed('history', history.add, time.time(), data2)
+
+def log_sample(s):
+    data = s.data
+    if s.seq % args.log_period == 0:
+        ts = data['_now']
+        print('{0} {1:>8.2f} U  {2:>5.1f} C   {3:>8.2f} MHz   {4:8s}  L {5}  M {6}'.format(ts, data['uptime'], data['temp'], data['freq']/MIL, data['state'], data['load'], data['mem']))
+
+def ifttt_sample(s):
+    if s.seq % args.ifttt_period == 0:
+        ifttt_report(s.data['temp'], s.data['freq'], s.data['state'])
+
+def webhook_sample(s):
+    if s.seq % args.webhook_period == 0:
+        webhook_delivery.post(dict((k, v) for k, v in s.data.items() if not k.startswith('~') and k not in SELF_KEYS))
 
-update()
+def display_sample(s):
+    alert = bool(rules) and rules.led(s.data.get('_alerts', ()))
+    display(s.data['temp'], s.data['freq'], s.data['state'], alert)
 
+recorder = None
+
+# Samples once and hands the result to every sink without waiting on them.
 def oneshot():
-    global printon, ifttton, data, last
+    t0 = time.perf_counter()
     update()
-
-    if printon % args.log_period == 0:
-        ts = last.strftime('%Y-%m-%d %H:%M:%S.%f %Z')
-        print('{0} {1:>8.2f} U  {2:>5.1f} C   {3:>8.2f} MHz   {4:8s}  L {5}  M {6}'.format(ts, data['uptime'], data['temp'], data['freq']/MIL, data['state'], data['load'], data['mem']))
-    printon = printon + 1
-    if ifttton % args.ifttt_period == 0:
-        ifttt_report(data['temp'], data['freq'], data['state'])
-    ifttton = ifttton + 1
-    display(data['temp'], data['freq'], data['state'])
+    s = snapshot
+    for sink in sinks:
+        sink.publish(s)
+    if stats:
+        stats.observe('oneshot', time.perf_counter() - t0)
 
 
 muststop = False
@@ -405,74 +2166,641 @@ def stop(sig, frame):
     print('SIGTERM captured')
     muststop = True
 
-signal.signal(signal.SIGTERM, stop)
-
 def loop():
+    profile = None
+    if args.profile > 0:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    ticks = 0
     when = time.time()
-    period = args.period
     while not muststop:
         oneshot()
+        ticks = ticks + 1
+        if profile and ticks == args.profile:
+            profile.disable()
+            dump_profile(profile)
+            profile = None
+        period = current_period()
         when = when + period
         # Reduce sleep drift.
         s = when - time.time()
         if s > 0:
             sleep(s)
         else:
+            if stats:
+                stats.overruns = stats.overruns + 1
+                stats.skipped = stats.skipped + 1 + int(-s / period)
             sleep(period)
             # Skip missed triggers
             when = time.time()
     print('Exitting')
-    if sense:
-        sense.clear(C_YELLOW)
+    for sink in sinks:
+        sink.stop(1)
+    if recorder:
+        recorder.close()
+    if pusher:
+        pusher.flush()
+    if leds:
+        leds.fill(C_YELLOW)
         sleep(0.1)
-        sense.clear(C_BLACK)
-
-if args.server:
-    def run_server():
-        sys.path.append('./third_party/bottle/')
-        from bottle import route, run, request, response, redirect, abort
-
-        @route('/')
-        def main():
-            ts = last.strftime('%Y-%m-%d %H:%M:%S.%f %Z')
-            ret = copy.deepcopy(data)
-            ret['_now'] = ts
-            if request.query.refresh:
-                response.set_header('Refresh', request.query.refresh)
-            if request.query.format == 'json':
-                return ret
-            vs = []
-            if args.server_controls:
-                vs.append("""<tr><td class='Controls'>Controls</td><td>
-                <a target=_blank href='/power/shutdown'>Shutdown</a> | <a target=_blank href='/power/reboot'>Reboot</a></td></tr>
-                """)
-            for key, value in sorted(ret.items()):
-                vs.append('<tr><td>{0}</td><td>{1}</td></tr>'.format(key, value))
-            return '<table>' + ''.join(vs) + '</table>'
-
-        @route('/power/shutdown')
-        def power_shutdown():
-            if args.server_controls:
-                control_shutdown()
-                redirect('/')
-                return
-            abort(code=403)
-        
-        @route('/power/reboot')
-        def power_reboot():
-            if args.server_controls:
-                control_reboot()
-                redirect('/')
+        leds.fill(C_BLACK)
+
+# Prints the profile's costliest calls, and saves it for pstats/snakeviz
+# with --profile_out.
+def dump_profile(profile):
+    import pstats
+    print('Profile of the first {0} ticks (sampling thread only):'.format(args.profile))
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(30)
+    print(out.getvalue())
+    if args.profile_out:
+        profile.dump_stats(args.profile_out)
+        print('Profile saved to {0}'.format(args.profile_out))
+
+class RenderCache:
+    """Response bodies rendered at most once per snapshot.
+
+    Bodies are keyed by name and dropped as soon as a newer snapshot is
+    asked for, so every reader of one sample shares a single rendering (and
+    a single gzip of it).  ETags combine the process start time with the
+    snapshot seq so they never repeat across restarts.
+    """
+
+    # bodies smaller than this aren't worth compressing
+    MIN_GZIP = 256
+
+    def __init__(self):
+        self.epoch = '{0:x}'.format(int(time.time()))
+        self.seq = None
+        self.bodies = {}
+        self.lock = threading.Lock()
+
+    def etag(self, snap, name, gz):
+        return '"{0}-{1}-{2}{3}"'.format(self.epoch, snap.seq, name, '-gz' if gz else '')
+
+    def get(self, snap, name, render, gz=False):
+        # returns (body, gzipped)
+        with self.lock:
+            if self.seq != snap.seq:
+                self.seq, self.bodies = snap.seq, {}
+            body = self.bodies.get(name)
+            if body is None:
+                body = render(snap.data)
+                if not isinstance(body, bytes):
+                    body = body.encode('utf-8')
+                self.bodies[name] = body
+            if not gz or len(body) < self.MIN_GZIP:
+                return body, False
+            zbody = self.bodies.get((name, 'gz'))
+            if zbody is None:
+                zbody = gzip.compress(body, 6)
+                self.bodies[(name, 'gz')] = zbody
+            return zbody, True
+
+responses = RenderCache()
+
+# Throttle bits reported by get_throttled, as Prometheus label values.
+THROTTLE_FLAGS = (('under_voltage', 0), ('frequency_capped', 1), ('throttled', 2))
+
+# Renders a sample in the Prometheus text exposition format.
+def render_metrics(data):
+    out = []
+
+    def gauge(name, help, samples):
+        out.append('# HELP {0} {1}\n# TYPE {0} gauge\n'.format(name, help))
+        for labels, v in samples:
+            if v is not None:
+                out.append('{0}{1} {2}\n'.format(name, labels, v))
+
+    gauge('berrymon_temperature_celsius', 'SoC temperature.', [('', data['temp'])])
+    gauge('berrymon_arm_frequency_hertz', 'Arm core clock frequency.', [('', data['freq'])])
+    gauge('berrymon_cpu_load_percent', 'Per-core CPU utilization.',
+          [('{{cpu="{0}"}}'.format(i), v) for i, v in enumerate(data['load'])])
+    gauge('berrymon_memory_used_percent', 'Virtual memory in use.', [('', data['mem'])])
+    gauge('berrymon_uptime_seconds', 'Seconds since boot.', [('', data['uptime'])])
+    if 'freqs' in data:
+        gauge('berrymon_core_frequency_hertz', 'Per-core clock frequency.',
+              [('{{cpu="{0}"}}'.format(i), v) for i, v in enumerate(data['freqs'])])
+    if 'disk_read' in data:
+        gauge('berrymon_disk_bytes_per_second', 'Whole-disk I/O rate.',
+              [('{direction="read"}', data['disk_read']), ('{direction="write"}', data['disk_write'])])
+    if 'net_rx' in data:
+        gauge('berrymon_network_bytes_per_second', 'Network I/O rate, excluding loopback.',
+              [('{direction="receive"}', data['net_rx']), ('{direction="transmit"}', data['net_tx'])])
+    e = data.get('env', {})
+    for key, name, help in (('humidity', 'berrymon_humidity_percent', 'Sense HAT relative humidity, mean over the sample.'),
+                            ('pressure', 'berrymon_pressure_millibars', 'Sense HAT air pressure, mean over the sample.'),
+                            ('hat_temp', 'berrymon_sensehat_temperature_celsius', 'Sense HAT temperature, mean over the sample.'),
+                            ('accel', 'berrymon_acceleration_g', 'Sense HAT acceleration magnitude, mean over the sample.')):
+        if key in e:
+            gauge(name, help, [('', e[key]['mean'])])
+    if 'vibration' in e:
+        gauge('berrymon_vibration_rms_g', 'Sense HAT acceleration magnitude RMS deviation over the sample.', [('', e['vibration'])])
+    bits = data['throttled']
+    gauge('berrymon_throttle_active', 'Whether a throttling condition holds now.',
+          [('{{flag="{0}"}}'.format(f), (bits >> b) & 1) for f, b in THROTTLE_FLAGS])
+    gauge('berrymon_throttle_occurred', 'Whether a throttling condition has held since boot.',
+          [('{{flag="{0}"}}'.format(f), (bits >> (b + 16)) & 1) for f, b in THROTTLE_FLAGS])
+    vc = [(k[3:], v) for k, v in sorted(data.items()) if k.startswith('vc_')]
+    if vc:
+        gauge('berrymon_vcgencmd_value', 'Values from --vc_counters queries.',
+              [('{{query="{0}"}}'.format(q), v) for q, v in vc])
+    if rules:
+        firing = data.get('_alerts', ())
+        gauge('berrymon_alert_firing', 'Whether each --rules alert is firing.',
+              [('{{alert="{0}"}}'.format(r.name.replace('\\', '\\\\').replace('"', '\\"')), int(r.name in firing))
+               for r in rules.rules])
+    if stats:
+        r = stats.report()
+        out.append('# HELP berrymon_stage_seconds Time spent in each stage of sampling, publishing and serving.\n'
+                   '# TYPE berrymon_stage_seconds histogram\n')
+        for stage, h in sorted(r['stages'].items()):
+            n = 0
+            for le, c in zip(r['buckets'] + ['+Inf'], h['counts']):
+                n = n + c
+                out.append('berrymon_stage_seconds_bucket{{stage="{0}",le="{1}"}} {2}\n'.format(stage, le, n))
+            out.append('berrymon_stage_seconds_sum{{stage="{0}"}} {1}\n'.format(stage, h['sum']))
+            out.append('berrymon_stage_seconds_count{{stage="{0}"}} {1}\n'.format(stage, h['n']))
+        out.append('# HELP berrymon_tick_overruns_total Samples that took longer than the period.\n'
+                   '# TYPE berrymon_tick_overruns_total counter\n'
+                   'berrymon_tick_overruns_total {0}\n'.format(r['overruns']))
+        out.append('# HELP berrymon_ticks_skipped_total Scheduled samples skipped after overruns.\n'
+                   '# TYPE berrymon_ticks_skipped_total counter\n'
+                   'berrymon_ticks_skipped_total {0}\n'.format(r['skipped']))
+        gauge('berrymon_process_resident_bytes', "berrymon's resident memory.", [('', r['rss'])])
+        gauge('berrymon_process_cpu_percent', "berrymon's CPU use over the last sample, of one core.", [('', r['cpu'])])
+    return ''.join(out)
+
+class KeepAliveWSGIHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the server's WSGI app over HTTP/1.1 with keep-alive.
+
+    Responses without a Content-Length are sent chunked (or, to HTTP/1.0
+    clients, by closing the connection) so streaming bodies work too.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # an idle keep-alive connection is closed after this long
+    timeout = 15
+
+    def run_wsgi(self):
+        path, _, query = self.path.partition('?')
+        length = int(self.headers.get('Content-Length') or 0)
+        env = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote(path, 'iso-8859-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            # read the body up front so an unread body can't corrupt the next request
+            'wsgi.input': io.BytesIO(self.rfile.read(length)),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for k, v in self.headers.items():
+            k = 'HTTP_' + k.upper().replace('-', '_')
+            if k not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                env[k] = env[k] + ',' + v if k in env else v
+
+        state = {'sent': False, 'chunked': False, 'body': True}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and state['sent']:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state['status'], state['headers'] = status, headers
+            return write
+
+        def send_headers():
+            code, _, reason = state['status'].partition(' ')
+            code = int(code)
+            headers = state['headers']
+            state['body'] = self.command != 'HEAD' and code >= 200 and code not in (204, 304)
+            self.send_response(code, reason)
+            for k, v in headers:
+                self.send_header(k, v)
+            close = self.server.crowded()
+            if state['body'] and not any(k.lower() == 'content-length' for k, _ in headers):
+                if self.request_version == 'HTTP/1.1':
+                    state['chunked'] = True
+                    self.send_header('Transfer-Encoding', 'chunked')
+                else:
+                    close = True
+            if close:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            state['sent'] = True
+
+        def write(chunk):
+            if not state['sent']:
+                send_headers()
+            if not chunk or not state['body']:
                 return
-            abort(code=403)
+            if state['chunked']:
+                chunk = b'%x\r\n' % len(chunk) + chunk + b'\r\n'
+            self.wfile.write(chunk)
+
+        # streams have their own, non-blocking cap
+        stream = env['PATH_INFO'] in self.server.stream_paths
+        if not self.server.acquire(stream):
+            self.send_error(503, 'Too many open streams')
+            return
+        try:
+            result = self.server.app(env, start_response)
+            try:
+                for chunk in result:
+                    write(chunk)
+                if not state['sent']:
+                    send_headers()
+                if state['chunked']:
+                    self.wfile.write(b'0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            self.server.release(stream)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = run_wsgi
+
+class BoundedThreadingWSGIServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Threaded WSGI server running at most `workers` requests at once.
+
+    Every connection gets a thread, but only takes one of the `workers`
+    slots while a request on it runs, so idle keep-alive connections never
+    hold up accept() or anyone else's request; a burst of requests waits
+    for a slot instead.  While more connections are open than there are
+    workers, responses ask clients to close theirs, so idle connections
+    (and their threads) can't pile up.
+
+    Requests for `stream_paths` (SSE, long-poll) never take those slots:
+    up to `streams` of them run on their own threads, and beyond that
+    they are refused with 503 at once.
+
+    Open connections, and so threads, are capped at `connections`: a
+    connection accepted past that is sent a 503 and closed without ever
+    getting a thread.
+    """
+
+    daemon_threads = True
+
+    REFUSED = b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+    def __init__(self, address, app, workers, streams=0, stream_paths=(), connections=None):
+        super().__init__(address, KeepAliveWSGIHandler)
+        self.app = app
+        self.workers = workers
+        # default: room for every worker and stream, plus as many idle keep-alives
+        self.max_connections = connections or 2 * workers + streams
+        self.slots = threading.BoundedSemaphore(workers)
+        self.streams = streams
+        self.stream_paths = frozenset(stream_paths)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.streaming = 0
+
+    def acquire(self, stream):
+        if not stream:
+            self.slots.acquire()
+            return True
+        with self.lock:
+            if self.streaming >= self.streams:
+                return False
+            self.streaming = self.streaming + 1
+            return True
+
+    def release(self, stream):
+        if not stream:
+            self.slots.release()
+            return
+        with self.lock:
+            self.streaming = self.streaming - 1
+
+    def crowded(self):
+        return self.connections - self.streaming > self.workers
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            full = self.connections >= self.max_connections
+            if not full:
+                self.connections = self.connections + 1
+        if full:
+            self.refuse(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except:
+            with self.lock:
+                self.connections = self.connections - 1
+            raise
 
-        def launch():
+    def refuse(self, request):
+        # runs on the accept thread, so never block on a slow client
+        try:
+            request.setblocking(False)
+            request.send(self.REFUSED)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.lock:
+                self.connections = self.connections - 1
+
+def run_server():
+    # prefers the bottle vendored alongside this file
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'third_party', 'bottle'))
+    from bottle import route, run, request, response, redirect, abort, default_app, install
+
+    # Times every handler into the stats, as http.<handler name>.  Streaming
+    # handlers are timed until they return their generator.
+    def timing(callback):
+        stage = 'http.' + callback.__name__
+        def wrapper(*a, **ka):
+            return timed(stage, callback, *a, **ka)
+        return wrapper
+    install(timing)
+
+    # Serves the current snapshot rendered by render(data), reusing the
+    # cached body (and honouring If-None-Match) until the next sample.
+    def cached_response(name, content_type, render):
+        s = snapshot
+        gz = 'gzip' in request.get_header('Accept-Encoding', '')
+        body, gz = responses.get(s, name, render, gz)
+        etag = responses.etag(s, name, gz)
+        response.set_header('ETag', etag)
+        response.set_header('Vary', 'Accept-Encoding')
+        inm = request.get_header('If-None-Match', '')
+        if inm == '*' or etag in [t.strip() for t in inm.split(',')]:
+            response.status = 304
+            return b''
+        response.content_type = content_type
+        if gz:
+            response.set_header('Content-Encoding', 'gzip')
+        return body
+
+    def render_html(ret):
+        vs = []
+        if args.server_controls:
+            vs.append("""<tr><td class='Controls'>Controls</td><td>
+            <a target=_blank href='/power/shutdown'>Shutdown</a> | <a target=_blank href='/power/reboot'>Reboot</a></td></tr>
+            """)
+        for key, value in sorted(ret.items()):
+            vs.append('<tr><td>{0}</td><td>{1}</td></tr>'.format(key, value))
+        return '<table>' + ''.join(vs) + '</table>'
+
+    @route('/')
+    def main():
+        if request.query.refresh:
+            response.set_header('Refresh', request.query.refresh)
+        if request.query.format == 'json':
+            return cached_response('json', 'application/json', json.dumps)
+        return cached_response('html', 'text/html; charset=UTF-8', render_html)
+
+    def render_event(s, name):
+        def render(data):
+            return 'id: {0}\ndata: {1}\n\n'.format(s.seq, json.dumps(s.delta if name == 'delta' else data))
+        return render
+
+    def check_streaming():
+        # every open stream or poll holds a thread until it ends; the
+        # threaded server caps them apart from other requests
+        if args.server_backend != 'threaded':
+            abort(code=503, text='Streaming requires --server_backend threaded')
+
+    # Server-Sent Events: one event per sample, carrying only the changed
+    # entries unless the client missed a sample or just connected.
+    @route('/stream')
+    def stream():
+        check_streaming()
+        try:
+            after = int(request.get_header('Last-Event-ID') or request.query.after or 0)
+        except ValueError:
+            abort(code=400, text='Last-Event-ID and after must be integers')
+        response.content_type = 'text/event-stream'
+        response.set_header('Cache-Control', 'no-cache')
+
+        def events():
+            seq = after
+            while not muststop:
+                s = wait_snapshot(seq, 15)
+                if s.seq == seq:
+                    # a comment line; also notices clients that went away
+                    yield b': keepalive\n\n'
+                    continue
+                name = 'delta' if seq and s.seq == seq + 1 else 'full'
+                yield responses.get(s, 'event-' + name, render_event(s, name))[0]
+                seq = s.seq
+        return events()
+
+    # Long-poll: waits for a sample newer than ?after=<seq>.
+    @route('/poll')
+    def poll():
+        check_streaming()
+        try:
+            after = int(request.query.after or 0)
+        except ValueError:
+            abort(code=400, text='after must be an integer')
+        s = wait_snapshot(after, 30)
+        if s.seq == after:
+            response.status = 204
+            return b''
+        delta = bool(after) and s.seq == after + 1
+        return {'seq': s.seq, 'delta': delta, 'data': s.delta if delta else s.data}
+
+    @route('/metrics')
+    def metrics():
+        return cached_response('metrics', 'text/plain; version=0.0.4; charset=utf-8', render_metrics)
+
+    # Per-stage latency histograms (bucket upper bounds in seconds), loop
+    # counters and sink queues; see Stats and Sink.
+    @route('/debug/stats')
+    def debug_stats():
+        ret = stats.report()
+        ret['sinks'] = dict((sink.name, sink.stats()) for sink in sinks)
+        return ret
+
+    @route('/burst')
+    def burst_list():
+        if not burst:
+            abort(code=404, text='Burst capture is disabled')
+        return {'running': burst.running, 'events': burst.list()}
+
+    @route('/burst/trigger')
+    def burst_trigger():
+        if not burst:
+            abort(code=404, text='Burst capture is disabled')
+        if not burst.trigger('http'):
+            abort(code=409, text='A burst capture is already running')
+        response.status = 202
+        return {'running': True}
+
+    @route('/burst/<id:int>')
+    def burst_get(id):
+        ret = burst.get(id) if burst else None
+        if ret is None:
+            abort(code=404, text='No such burst capture')
+        return ret
+
+    # [pid, name, value] rows, busiest first
+    @route('/processes')
+    def processes_route():
+        if not processes:
+            abort(code=404, text='Process tracking is disabled; see --processes')
+        return cached_response('processes', 'application/json',
+                               lambda d: json.dumps({'cpu': d['top_cpu'], 'rss': d['top_rss']}))
+
+    @route('/history')
+    def history_query():
+        if not history:
+            abort(code=404, text='History is disabled')
+        try:
+            since = float(request.query.since or 0)
+            step = float(request.query.step or 0)
+        except ValueError:
+            abort(code=400, text='since and step must be numbers')
+        if not (math.isfinite(since) and math.isfinite(step)):
+            abort(code=400, text='since and step must be finite')
+        # a negative since is relative to now
+        if since < 0:
+            since = time.time() + since
+        ret = history.query(request.query.metric or 'temp', since, step)
+        if ret is None:
+            abort(code=404, text='Unknown metric')
+        return ret
+
+    @route('/power/shutdown')
+    def power_shutdown():
+        if args.server_controls:
+            control_shutdown()
+            redirect('/')
+            return
+        abort(code=403)
+    
+    @route('/power/reboot')
+    def power_reboot():
+        if args.server_controls:
+            control_reboot()
+            redirect('/')
+            return
+        abort(code=403)
+
+    def launch():
+        if args.server_backend == 'threaded':
+            print('Serving on http://{0}:{1}/ with {2} threads and {3} streams, {4:.3f}s after start'.format(
+                args.server, args.server_port, args.server_threads, args.server_streams, time.time() - started))
+            BoundedThreadingWSGIServer((args.server, args.server_port), default_app(), args.server_threads,
+                                       args.server_streams, ('/stream', '/poll'), args.server_connections).serve_forever()
+        else:
             run(host=args.server, port=args.server_port)
-        
-        t = Thread(target=launch, args=())
-        t.start()
-        
+    
+    t = Thread(target=launch, args=())
+    t.start()
 
-    run_server()
 
-loop()
+def main(argv=None):
+    global args, min_temp, max_temp, min_freq, max_freq, vcgencmd_path
+    global sampler, burst, vc_batch, ifttt_delivery, webhook_delivery, history, processes, scheduler, recorder
+    global rules, alert_ifttt_delivery, alert_webhook_delivery, pusher, proc_collector, stats
+    sys.excepthook = top_exception
+    args = parser.parse_args(argv)
+
+    if args.record_read:
+        print('\t'.join(RECORD_FIELDS + ('load',)))
+        for r in read_records(args.record_read, args.record_since, args.record_until):
+            print('\t'.join(str(v) for v in r))
+        return
+
+    if args.log:
+        setup_logs(args.log, args.log_days)
+
+    min_temp = args.min_temp
+    max_temp = args.max_temp
+    min_freq = args.min_freq
+    max_freq = args.max_freq
+
+    stats = Stats()
+
+    # Slow probes run in the background rather than delaying the first sample.
+    t = Thread(target=probe_platform, args=(), daemon=True)
+    t.start()
+    if args.sensehat:
+        if args.sensehat_required:
+            init_sensehat()
+        else:
+            t = Thread(target=init_sensehat, args=(), daemon=True)
+            t.start()
+
+    vcgencmd_path = args.vcgencmd
+    if args.sampler == 'sysfs':
+        sampler = SysfsSampler(args.sysfs_root)
+    if args.collector == 'proc':
+        try:
+            proc_collector = ProcCollector(args.sysfs_root)
+        except OSError as e:
+            print('Falling back to psutil: {0}'.format(e))
+    if args.burst:
+        if sampler and sampler.measured_clock(MBOX_CLOCKS['arm']) is not None and sampler.throttled() is not None:
+            burst = BurstCapture(sampler, args.burst_rate, args.burst_window, args.burst_keep, args.burst_dir)
+        else:
+            print('Burst capture needs --sampler sysfs with /dev/vcio available; disabled')
+    if args.vc_counters:
+        vc_batch = VcgencmdBatch(args.vcgencmd, args.vc_counters, sampler)
+    if args.ifttt and 'IFTTT_TOKEN' in os.environ:
+        ifttt_delivery = WebhookDelivery('https://maker.ifttt.com/trigger/berry_metrics/with/key/' + os.environ['IFTTT_TOKEN'],
+                                         ifttt=True, cap=args.webhook_queue)
+    if args.webhook:
+        webhook_delivery = WebhookDelivery(args.webhook, cap=args.webhook_queue)
+    if args.rules:
+        rules = Rules(args.rules)
+        if args.ifttt and 'IFTTT_TOKEN' in os.environ:
+            alert_ifttt_delivery = WebhookDelivery('https://maker.ifttt.com/trigger/berry_alert/with/key/' + os.environ['IFTTT_TOKEN'],
+                                                   ifttt=True, cap=args.webhook_queue)
+        if args.alert_webhook or args.webhook:
+            alert_webhook_delivery = WebhookDelivery(args.alert_webhook or args.webhook, cap=args.webhook_queue, key='alerts')
+    if args.history_raw > 0:
+        history = History(args.history_raw, args.history_minutes, args.history_hours)
+    if args.processes > 0:
+        processes = ProcessCollector(args.processes, args.processes_refresh)
+    if args.adaptive:
+        scheduler = AdaptiveScheduler(args.period, args.period_slow, args.period_fast,
+                                      args.adaptive_rise, args.adaptive_hold, args.min_temp - args.adaptive_margin)
+
+    update()
+    print('First sample {0:.3f}s after start'.format(time.time() - started))
+
+    sinks.append(Sink('log', log_sample, args.sink_queue))
+    if args.ifttt:
+        sinks.append(Sink('ifttt', ifttt_sample, args.sink_queue))
+    if args.record:
+        recorder = Recorder(args.record, args.record_sync, args.log_days)
+        sinks.append(Sink('record', lambda s: recorder.add(s.last.timestamp(), s.data), args.sink_queue))
+    if webhook_delivery:
+        sinks.append(Sink('webhook', webhook_sample, args.sink_queue))
+    if args.push:
+        pusher = Pusher(args.push, args.push_proto, args.push_batch, args.push_name or platform.node())
+        sinks.append(Sink('push', lambda s: pusher.add(s.last.timestamp(), s.data), args.sink_queue))
+    if args.sensehat:
+        sinks.append(Sink('display', display_sample, args.sink_queue))
+
+    signal.signal(signal.SIGTERM, stop)
+
+    if args.server:
+        run_server()
+
+    loop()
+
+if __name__ == '__main__':
+    main()
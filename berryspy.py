@@ -41,6 +41,20 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 import signal
 import argparse
+import array
+import asyncio
+import concurrent.futures
+import gzip
+import html
+import http.client
+import itertools
+import json
+import math
+import mmap
+import socket
+import struct
+
+from berrymon import BoundedThreadingWSGIServer, PUSH_LENGTH, PUSH_MAX, parse_duration, throttle_state, unpack_push
 
 
 parser = argparse.ArgumentParser(description="""Monitor Logger Spy
@@ -60,8 +74,25 @@ to ensure safety - measurements may be out of date or wrong.
                                  """)
 parser.add_argument("--server", help="run a webserver with monitoring on this IP", type=str, default="0.0.0.0")
 parser.add_argument("--server_port", help="webserver port", type=int, default=8080)
+parser.add_argument("--server_threads", help="most requests the webserver runs at once; each may wait up to --scrape_deadline on the fleet", type=int, default=16)
+parser.add_argument("--server_connections", help="most connections (and so threads) the webserver holds open at once; more are refused with 503", type=int, default=64)
 
 parser.add_argument("--default_hosts", help="hosts to connect to if none specified by user", nargs='+', default=[])
+parser.add_argument("--scrape_ttl", help="seconds to reuse a host's scraped metrics before scraping it again", type=float, default=5)
+parser.add_argument("--scrape_timeout", help="seconds to wait on each host's scrape", type=float, default=3)
+parser.add_argument("--scrape_threads", help="hosts scraped at once", type=int, default=32)
+parser.add_argument("--scrape_deadline", help="seconds a page waits on the whole fleet before showing stale data for slow hosts", type=float, default=2)
+parser.add_argument("--scrape_max_backoff", help="most seconds to wait before retrying a failing host", type=float, default=300)
+
+parser.add_argument("--listen_push", help="receive samples pushed by berrymon --push on this host:port, over both UDP and TCP", type=str, default=None)
+parser.add_argument("--push_stale", help="seconds without new data after which a pushing or federated host shows as stale", type=float, default=30)
+parser.add_argument("--site", help="name that other berryspy instances list this one's hosts under (default: this host's name)", type=str, default=None)
+parser.add_argument("--sites", help="downstream berryspy instances (host:port) whose fleets to merge in, as site/host, with one request per site per --scrape_ttl",
+                    nargs='+', default=[])
+
+parser.add_argument("--fleet_store", help="directory to record every --default_hosts sample in, enabling /fleet/query", type=str, default=None)
+parser.add_argument("--fleet_raw_hours", help="hours of raw samples to keep before compacting them to 1-minute means", type=int, default=24)
+parser.add_argument("--fleet_days", help="days of fleet history to keep", type=int, default=30)
 
 parser.add_argument("--log", help="path to log to", type=str, default=None)
 parser.add_argument("--log_days", help="days of logs to keep", type=int, default=7)
@@ -96,26 +127,646 @@ def setup_logs(path, days):
     return logger
 
 
-args = parser.parse_args()
+args = None
+
+class HostState:
+    """What the fleet collector knows about one host."""
+
+    __slots__ = ('conn', 'etag', 'data', 'error', 'scraped', 'latency', 'failures', 'retry_at', 'inflight', 'pushed',
+                 'changed', 'site', 'remote')
+
+    def __init__(self):
+        self.conn = None
+        self.etag = None
+        self.data = None
+        self.error = None
+        self.scraped = 0
+        self.latency = None
+        self.failures = 0
+        self.retry_at = 0
+        self.inflight = None
+        # fed by a PushReceiver rather than scraped
+        self.pushed = False
+        # the collector's seq when data or error last changed
+        self.changed = 0
+        # for a host merged from a downstream site: that site's address,
+        # and the report it gave
+        self.site = None
+        self.remote = None
+
+class SiteState:
+    """What the fleet collector knows about one downstream berryspy."""
+
+    __slots__ = ('conn', 'name', 'epoch', 'seq', 'error', 'scraped', 'failures', 'retry_at', 'inflight')
+
+    def __init__(self):
+        self.conn = None
+        self.name = None
+        self.epoch = None
+        self.seq = 0
+        self.error = None
+        self.scraped = 0
+        self.failures = 0
+        self.retry_at = 0
+        self.inflight = None
+
+class FleetCollector:
+    """Scrapes berrymon's JSON from every host on behalf of every viewer.
+
+    All due hosts are scraped concurrently, each over its own keep-alive
+    connection with at most one scrape in flight, and results are reused
+    for `ttl` seconds, so a host sees one request per interval however many
+    people are watching.  A collection waits at most `deadline` seconds:
+    hosts that miss it report their last known data flagged stale and
+    finish in the background.  A failing host is retried after an
+    exponentially growing backoff capped at `max_backoff` seconds.
+
+    Hosts that push their samples (see ingest()) are never scraped, and
+    show as stale once nothing has arrived for `push_stale` seconds.
+
+    Every change to a host's data bumps `seq`, so state() can hand another
+    berryspy just the hosts that changed since the seq it last saw; `epoch`
+    changes when this process restarts and seq starts over.  Downstream
+    `sites` are fetched that way each `ttl`, alongside the hosts, and
+    their hosts merged in as site/host.
+    """
+
+    def __init__(self, timeout, ttl, threads, deadline, max_backoff, push_stale, site=None, sites=()):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.deadline = deadline
+        self.max_backoff = max_backoff
+        self.push_stale = push_stale
+        self.site = site
+        self.sites = dict((addr, SiteState()) for addr in sites)
+        self.seq = 0
+        self.epoch = '{0:x}'.format(int(time.time() * 1000))
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.lock = threading.Lock()
+        self.hosts = {}
+        # a FleetStore to record fresh samples in, if any
+        self.store = None
+
+    def _fetch(self, host, st, path, headers):
+        # returns the response and its decompressed body over st's
+        # keep-alive connection
+        if st.conn is None:
+            st.conn = http.client.HTTPConnection(host, timeout=self.timeout)
+        headers['Accept-Encoding'] = 'gzip'
+        try:
+            st.conn.request('GET', path, headers=headers)
+            resp = st.conn.getresponse()
+            body = resp.read()
+        except (OSError, http.client.HTTPException):
+            st.conn.close()
+            st.conn = None
+            raise
+        if resp.status not in (200, 304):
+            raise http.client.HTTPException('HTTP {0} {1}'.format(resp.status, resp.reason))
+        if resp.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return resp, body
+
+    def _get(self, host, st):
+        headers = {}
+        if st.etag and st.data is not None:
+            headers['If-None-Match'] = st.etag
+        resp, body = self._fetch(host, st, '/?format=json', headers)
+        if resp.status == 304:
+            return st.data
+        st.etag = resp.getheader('ETag')
+        return json.loads(body.decode('utf-8'))
+
+    def _scrape(self, host, st):
+        start = time.time()
+        try:
+            prev = st.data
+            data = self._get(host, st)
+            error = None
+            if self.store and data is not prev:
+                self.store.add(host, time.time(), data)
+        except Exception as e:
+            data = None
+            error = str(e) or type(e).__name__
+        end = time.time()
+        with self.lock:
+            try:
+                st.latency = end - start
+                st.scraped = end
+                if data is not st.data or error != st.error:
+                    self.seq = self.seq + 1
+                    st.changed = self.seq
+                if error is None:
+                    st.data, st.error, st.failures, st.retry_at = data, None, 0, 0
+                else:
+                    st.error = error
+                    st.failures = st.failures + 1
+                    st.retry_at = end + self.backoff(st.failures)
+            finally:
+                # whatever happens, the host can be scraped again
+                st.inflight = None
+
+    def backoff(self, failures):
+        # the exponent is capped so a long outage can't overflow a float
+        return min(self.max_backoff, self.ttl * 2 ** min(failures, 20))
+
+    def _scrape_site(self, addr, site):
+        try:
+            path = '/fleet/state?since={0}&epoch={1}'.format(site.seq, urllib.parse.quote(site.epoch or ''))
+            state = json.loads(self._fetch(addr, site, path, {})[1].decode('utf-8'))
+            error = None
+        except Exception as e:
+            state = None
+            error = str(e) or type(e).__name__
+        end = time.time()
+        fresh = []
+        with self.lock:
+            try:
+                self._merge_site(addr, site, state, error, end, fresh)
+            finally:
+                site.inflight = None
+        if self.store:
+            for key, t, data in fresh:
+                self.store.add(key, t, data)
+
+    def _merge_site(self, addr, site, state, error, end, fresh):
+        # callers hold self.lock; appends (key, time, data) to fresh for
+        # each host with a new sample
+        site.scraped = end
+        if error is not None:
+            site.error = error
+            site.failures = site.failures + 1
+            site.retry_at = end + self.backoff(site.failures)
+            return
+        site.error, site.failures, site.retry_at = None, 0, 0
+        name = state['site'] or addr
+        if state['full'] or name != site.name:
+            # everything we had from the site is superseded
+            for key in [k for k, st in self.hosts.items() if st.site == addr]:
+                del self.hosts[key]
+        site.name, site.epoch, site.seq = name, state['epoch'], state['seq']
+        self.seq = self.seq + 1
+        for h, rep in state['hosts'].items():
+            key = name + '/' + h
+            st = self.hosts.get(key)
+            if st is None:
+                st = self.hosts[key] = HostState()
+                st.site = addr
+            if 'data' in rep and (st.remote is None or st.remote.get('scraped') != rep.get('scraped')):
+                fresh.append((key, rep.get('scraped') or end, rep['data']))
+            st.remote = rep
+            st.scraped = rep.get('scraped') or 0
+            st.changed = self.seq
+
+    def collect(self, hosts):
+        now = time.time()
+        futures = []
+        with self.lock:
+            for addr, site in self.sites.items():
+                if site.inflight is None and now - site.scraped >= self.ttl and now >= site.retry_at:
+                    site.inflight = self.pool.submit(self._scrape_site, addr, site)
+                if site.inflight is not None:
+                    futures.append(site.inflight)
+            for h in hosts:
+                st = self.hosts.get(h)
+                if st is None:
+                    st = self.hosts[h] = HostState()
+                # site/host names are merged from downstream sites, not scraped
+                if (not st.pushed and '/' not in h and st.inflight is None and
+                        now - st.scraped >= self.ttl and now >= st.retry_at):
+                    st.inflight = self.pool.submit(self._scrape, h, st)
+                if st.inflight is not None:
+                    futures.append(st.inflight)
+        if futures:
+            concurrent.futures.wait(futures, timeout=self.deadline)
+        with self.lock:
+            return dict((h, self.report(self.hosts[h])) for h in hosts)
+
+    def ingest(self, host, t, data):
+        with self.lock:
+            st = self.hosts.get(host)
+            if st is None:
+                st = self.hosts[host] = HostState()
+            st.pushed = True
+            # frames may arrive out of order over UDP
+            if t >= st.scraped:
+                st.data, st.scraped = data, t
+                self.seq = self.seq + 1
+                st.changed = self.seq
+        if self.store:
+            self.store.add(host, t, data)
+
+    # Hosts that push or come from downstream sites, rather than being
+    # scraped here.
+    def fed_hosts(self):
+        with self.lock:
+            return sorted(h for h, st in self.hosts.items() if st.pushed or st.site is not None)
+
+    # The hosts changed since seq `since`, or all of them if `epoch` isn't
+    # ours (a first request, or we restarted).
+    def state(self, since, epoch):
+        with self.lock:
+            full = epoch != self.epoch
+            hosts = dict((h, self.report(st)) for h, st in self.hosts.items()
+                         if (st.data is not None or st.error is not None or st.remote is not None) and
+                         (full or st.changed > since))
+            return {'site': self.site, 'epoch': self.epoch, 'seq': self.seq, 'full': full, 'hosts': hosts}
+
+    def report(self, st):
+        if st.remote is not None:
+            site = self.sites[st.site]
+            ret = dict(st.remote)
+            ret['stale'] = bool(ret.get('stale') or site.error is not None or
+                                time.time() - st.scraped > self.push_stale)
+            if site.error is not None:
+                ret['site_error'] = site.error
+            return ret
+        # stale: the data is not from a successful scrape this round, or
+        # a pushing host has gone quiet
+        ret = {'stale': st.inflight is not None or st.error is not None or
+                        (st.pushed and time.time() - st.scraped > self.push_stale),
+               'latency': st.latency,
+               'scraped': st.scraped or None}
+        if st.data is not None:
+            ret['data'] = st.data
+        if st.error is not None:
+            ret['error'] = st.error
+            ret['failures'] = st.failures
+        return ret
+
+# Numeric series recorded per host, and how to pull each from berrymon's JSON.
+FLEET_METRICS = {
+    'temp': lambda d: d['temp'],
+    'freq': lambda d: d['freq'],
+    'mem': lambda d: d['mem'],
+    'uptime': lambda d: d['uptime'],
+    'load': lambda d: sum(d['load']) / len(d['load']),
+    'throttled': lambda d: d['throttled'],
+}
+
+def percentile(values, p):
+    # nearest-rank on a sorted list: the smallest value with at least p% of
+    # the values at or below it
+    if not values:
+        return None
+    return values[max(0, min(len(values) - 1, math.ceil(p * len(values) / 100) - 1))]
+
+class FleetStore:
+    """Append-only on-disk history of every host's metrics.
+
+    Each metric is a directory of segment files holding fixed-size records
+    (ms offset from the segment start, host id, float32 value).  Raw
+    samples go to hourly r<start>.seg segments; once older than raw_hours
+    these are compacted into daily m<start>.seg segments of per-host
+    1-minute means, which are deleted after `days`.  Samples are buffered
+    in memory and appended once per flush(), and queries mmap only the
+    segments that overlap their window, splitting each into one array per
+    field (see columns()) that min/max/sum/sorted then run over in C.
+    """
+
+    RECORD = struct.Struct('<IHf')
+    # offset and array type of each RECORD field
+    FIELDS = ((0, 'I'), (4, 'H'), (6, 'f'))
+    RAW_SPAN = 3600
+    MINUTE_SPAN = 86400
+
+    def __init__(self, path, raw_hours, days):
+        self.path = path
+        self.raw_hours = raw_hours
+        self.days = days
+        self.lock = threading.Lock()
+        self.pending = {}
+        os.makedirs(path, exist_ok=True)
+        for m in FLEET_METRICS:
+            os.makedirs(os.path.join(path, m), exist_ok=True)
+        self.hosts_path = os.path.join(path, 'hosts.json')
+        self.host_ids = {}
+        if os.path.exists(self.hosts_path):
+            with open(self.hosts_path) as f:
+                self.host_ids = json.load(f)
+        self.host_names = dict((v, k) for k, v in self.host_ids.items())
+
+    def host_id(self, host):
+        # callers hold self.lock
+        i = self.host_ids.get(host)
+        if i is None:
+            i = len(self.host_ids)
+            self.host_ids[host] = i
+            self.host_names[i] = host
+            with open(self.hosts_path + '.tmp', 'w') as f:
+                json.dump(self.host_ids, f)
+            os.replace(self.hosts_path + '.tmp', self.hosts_path)
+        return i
+
+    def add(self, host, t, data):
+        with self.lock:
+            hid = self.host_id(host)
+            start = int(t) - int(t) % self.RAW_SPAN
+            for metric, get in FLEET_METRICS.items():
+                try:
+                    v = float(get(data))
+                except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                    continue
+                buf = self.pending.setdefault((metric, start), bytearray())
+                buf += self.RECORD.pack(int((t - start) * 1000), hid, v)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for (metric, start), buf in pending.items():
+            with open(os.path.join(self.path, metric, 'r{0}.seg'.format(start)), 'ab') as f:
+                f.write(buf)
+
+    def segments(self, metric):
+        # (kind, start, span, path) for each segment, oldest first
+        ret = []
+        d = os.path.join(self.path, metric)
+        for name in os.listdir(d):
+            m = re.fullmatch(r'([rm])(\d+)\.seg', name)
+            if m:
+                span = self.RAW_SPAN if m.group(1) == 'r' else self.MINUTE_SPAN
+                ret.append((m.group(1), int(m.group(2)), span, os.path.join(d, name)))
+        return sorted(ret, key=lambda s: s[1])
+
+    def columns(self, path):
+        # A segment's (ms, host id, value) fields as three arrays.  Each
+        # byte of a field is gathered with one strided slice of the mmap,
+        # so no Python code runs per record.
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                n = size // self.RECORD.size
+                if n == 0:
+                    return array.array('I'), array.array('H'), array.array('f')
+                with mmap.mmap(f.fileno(), n * self.RECORD.size, access=mmap.ACCESS_READ) as mm:
+                    return tuple(self._field(mm, n, offset, code) for offset, code in self.FIELDS)
+        except FileNotFoundError:
+            # compacted away under us
+            return array.array('I'), array.array('H'), array.array('f')
+
+    def _field(self, mm, n, offset, code):
+        a = array.array(code)
+        width = a.itemsize
+        out = bytearray(n * width)
+        for i in range(width):
+            out[i::width] = mm[offset + i::self.RECORD.size]
+        a.frombytes(out)
+        if sys.byteorder == 'big':
+            a.byteswap()
+        return a
 
-if args.log:
-    setup_logs(args.log, args.log_days)
+    def query(self, metric, agg, window, by_host=False, now=None):
+        if metric not in FLEET_METRICS:
+            raise ValueError('unknown metric: ' + metric)
+        aggregate = self.aggregator(agg)
+        if now is None:
+            now = time.time()
+        since = now - window
+        values = array.array('f')
+        hosts = array.array('H')
+        for kind, start, span, path in self.segments(metric):
+            if start + span <= since:
+                continue
+            ms, hids, vs = self.columns(path)
+            if start < since:
+                # only the oldest segments straddle the window's start
+                cutoff = (since - start) * 1000
+                keep = [m >= cutoff for m in ms]
+                vs = array.array('f', itertools.compress(vs, keep))
+                hids = array.array('H', itertools.compress(hids, keep))
+            values += vs
+            hosts += hids
+        ret = {'metric': metric, 'agg': agg, 'window': window}
+        if by_host:
+            groups = {}
+            for h, v in zip(hosts, values):
+                g = groups.get(h)
+                if g is None:
+                    g = groups[h] = []
+                g.append(v)
+            ret['hosts'] = dict((self.host_names.get(h, str(h)), aggregate(vs)) for h, vs in groups.items())
+        else:
+            ret['value'] = aggregate(values)
+        return ret
+
+    @staticmethod
+    def aggregator(agg):
+        if agg == 'count':
+            return len
+        if agg in ('min', 'max'):
+            f = min if agg == 'min' else max
+            return lambda vs: f(vs) if vs else None
+        if agg == 'mean':
+            return lambda vs: sum(vs) / len(vs) if vs else None
+        m = re.fullmatch(r'p([.0-9]+)', agg)
+        if m:
+            p = float(m.group(1))
+            return lambda vs: percentile(sorted(vs), p)
+        raise ValueError('unknown agg: ' + agg)
+
+    def compact(self, now=None):
+        if now is None:
+            now = time.time()
+        raw_cutoff = now - self.raw_hours * 3600
+        keep_cutoff = now - self.days * 86400
+        for metric in FLEET_METRICS:
+            for kind, start, span, path in self.segments(metric):
+                if start + span <= keep_cutoff:
+                    os.remove(path)
+                elif kind == 'r' and start + span <= raw_cutoff:
+                    self.compact_segment(metric, start, path)
+
+    def compact_segment(self, metric, start, path):
+        sums = {}
+        for ms, hid, v in self.RECORD.iter_unpack(self.read_records(path)):
+            key = (hid, ms // 60000)
+            acc = sums.get(key)
+            if acc is None:
+                sums[key] = [v, 1]
+            else:
+                acc[0] = acc[0] + v
+                acc[1] = acc[1] + 1
+        day = start - start % self.MINUTE_SPAN
+        buf = bytearray()
+        for (hid, minute), (total, n) in sorted(sums.items(), key=lambda kv: (kv[0][1], kv[0][0])):
+            buf += self.RECORD.pack((start - day) * 1000 + minute * 60000, hid, total / n)
+        with open(os.path.join(self.path, metric, 'm{0}.seg'.format(day)), 'ab') as f:
+            f.write(buf)
+        os.remove(path)
+
+    def read_records(self, path):
+        with open(path, 'rb') as f:
+            b = f.read()
+        return b[:len(b) - len(b) % self.RECORD.size]
+
+# The JSON berrymon would serve for a pushed record, as far as it goes.
+def push_sample(r):
+    t, uptime, temp, freq, throttled, mem, load = r
+    return {'temp': round(temp, 3),
+            'freq': freq,
+            'throttled': throttled,
+            'state': throttle_state(throttled),
+            'load': [round(v, 1) for v in load],
+            'mem': round(mem, 1),
+            'uptime': uptime,
+            '_now': datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f ')}
+
+class PushDatagram(asyncio.DatagramProtocol):
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, addr):
+        self.receiver.ingest(data)
+
+class PushStream(asyncio.Protocol):
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.buf = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buf += data
+        while len(self.buf) >= PUSH_LENGTH.size:
+            n = PUSH_LENGTH.unpack_from(self.buf)[0]
+            if n > PUSH_MAX:
+                self.receiver.bad = self.receiver.bad + 1
+                self.transport.close()
+                return
+            if len(self.buf) < PUSH_LENGTH.size + n:
+                return
+            self.receiver.ingest(bytes(self.buf[PUSH_LENGTH.size:PUSH_LENGTH.size + n]))
+            del self.buf[:PUSH_LENGTH.size + n]
+
+class PushReceiver:
+    """Receives frames pushed by berrymon --push and feeds them to a FleetCollector.
+
+    One asyncio loop on its own thread serves a UDP socket and a TCP
+    listener on the same port, so any number of boards share one socket
+    (plus one connection each over TCP) and one thread.
+    """
+
+    def __init__(self, fleet, addr):
+        self.fleet = fleet
+        self.frames = 0
+        self.bad = 0
+        host, port = addr.rsplit(':', 1)
+        self.loop = asyncio.new_event_loop()
+        transport, _ = self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+            lambda: PushDatagram(self), local_addr=(host, int(port))))
+        # room for a burst of datagrams from a large fleet
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: PushStream(self), host, int(port)))
+        t = Thread(target=self.loop.run_forever, args=(), daemon=True)
+        t.start()
+
+    def ingest(self, frame):
+        try:
+            name, records = unpack_push(frame)
+        except (ValueError, struct.error):
+            self.bad = self.bad + 1
+            return
+        self.frames = self.frames + 1
+        for r in records:
+            self.fleet.ingest(name, r[0], push_sample(r))
+
+# Filled in by main().
+fleet = None
+store = None
+receiver = None
+
+# Scrapes --default_hosts every --scrape_ttl so history keeps accruing
+# whether or not anyone is watching.
+def record_fleet():
+    compacted = 0
+    while True:
+        start = time.time()
+        fleet.collect(args.default_hosts)
+        store.flush()
+        if start - compacted >= 3600:
+            store.compact()
+            compacted = start
+        s = args.scrape_ttl - (time.time() - start)
+        if s > 0:
+            sleep(s)
 
 def run_server():
-    sys.path.append('./third_party/bottle/')
-    from bottle import route, run, request, response
+    # prefers the bottle vendored alongside this file
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'third_party', 'bottle'))
+    from bottle import route, request, response, abort, default_app
 
+    def query_hosts():
+        hosts = request.query.hosts.split(',')
+        if len(hosts) == 0 or hosts[0] == '':
+            hosts = args.default_hosts
+        return hosts
+
+    # One merged view of every host, scraped here rather than by the browser.
     @route('/')
-    @route('/simple')
     def main():
+        hosts = query_hosts()
+        fed = fleet.fed_hosts()
+        if not request.query.hosts:
+            hosts = hosts + [h for h in fed if h not in hosts]
+        # only configured, pushed and site hosts are scraped from here, so a
+        # viewer's ?hosts= can't point the server at arbitrary addresses
+        known = set(args.default_hosts).union(fed)
+        results = fleet.collect([h for h in hosts if h in known])
+        for h in hosts:
+            if h not in known:
+                results[h] = {'stale': True, 'error': 'not scraped: not in --default_hosts, pushed or from --sites'}
+        if request.query.refresh:
+            response.set_header('Refresh', request.query.refresh)
+        if request.query.format == 'json':
+            return results
+        # host names come from the viewer's ?hosts=, and errors and values
+        # from the hosts themselves
+        def cell(tag, v):
+            return '<{0}>{1}</{0}>'.format(tag, html.escape(str(v)))
+        keys = sorted(set(k for r in results.values() for k in r.get('data', {})))
+        vs = ['<tr><th></th>' + ''.join(cell('th', h) for h in hosts) + '</tr>']
+        for key in ('error', 'stale', 'latency'):
+            vs.append('<tr>' + cell('td', key) + ''.join(cell('td', results[h].get(key, '')) for h in hosts) + '</tr>')
+        for key in keys:
+            vs.append('<tr>' + cell('td', key) + ''.join(cell('td', results[h].get('data', {}).get(key, '')) for h in hosts) + '</tr>')
+        return '<table>' + ''.join(vs) + '</table>'
+
+    # e.g. /fleet/query?metric=temp&agg=p95&window=1h[&by=host]
+    @route('/fleet/query')
+    def fleet_query():
+        if not store:
+            abort(code=404, text='Fleet history is disabled; see --fleet_store')
+        try:
+            return store.query(request.query.metric or 'temp', request.query.agg or 'mean',
+                               parse_duration(request.query.window or '1h'), request.query.by == 'host')
+        except ValueError as e:
+            abort(code=400, text=str(e))
+
+    # Incremental fleet state for an upstream berryspy (see --sites):
+    # /fleet/state?since=<seq>&epoch=<epoch> from its last response.
+    @route('/fleet/state')
+    def fleet_state():
+        fleet.collect(args.default_hosts)
+        try:
+            since = int(request.query.since or 0)
+        except ValueError:
+            abort(code=400, text='since must be an integer')
+        body = json.dumps(fleet.state(since, request.query.epoch), separators=(',', ':')).encode('utf-8')
+        response.content_type = 'application/json'
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            response.set_header('Content-Encoding', 'gzip')
+        return body
+
+    # Browser-side view: one iframe per host, each polling its host directly.
+    @route('/simple')
+    def simple():
         refms = 0
         if request.query.refresh:
             refms = int(request.query.refresh) * 1000
-        if request.query.format == 'json':
-            return ret
-        hosts = request.query.hosts.split(',')
-        if len(hosts) == 0 or hosts[0] == '':
-            hosts = args.default_hosts
+        hosts = query_hosts()
         vs = []
         refset = "<script>refms={0};</script>".format(refms)
         style = refset + """<script src="https://ajax.googleapis.com/ajax/libs/jquery/3.3.1/jquery.min.js"></script>
@@ -136,14 +787,39 @@ var refresh = function(){$('iframe').each(function() {
 if ( refms >0){setInterval(refresh, refms );}
 </script>"""
         for h in hosts:
-            vs.append('<div style="display:inline-block"><h4>{0}</h4><iframe src="http://{0}"></iframe></div>'.format(h))
+            vs.append('<div style="display:inline-block"><h4>{0}</h4><iframe src="http://{0}"></iframe></div>'.format(html.escape(h)))
         return style + '' + ''.join(vs) + ''
 
+    # berrymon's threaded server, so viewers and upstream sites waiting on
+    # the fleet don't queue behind each other
     def launch():
-        run(host=args.server, port=args.server_port)
+        print('Serving on http://{0}:{1}/ with {2} threads'.format(args.server, args.server_port, args.server_threads))
+        BoundedThreadingWSGIServer((args.server, args.server_port), default_app(), args.server_threads,
+                                   connections=args.server_connections).serve_forever()
     
     launch()
     
 
-run_server()
+def main(argv=None):
+    global args, fleet, store, receiver
+    args = parser.parse_args(argv)
+
+    if args.log:
+        setup_logs(args.log, args.log_days)
+
+    fleet = FleetCollector(args.scrape_timeout, args.scrape_ttl, args.scrape_threads, args.scrape_deadline, args.scrape_max_backoff,
+                           args.push_stale, args.site or platform.node(), args.sites)
+
+    if args.fleet_store:
+        store = FleetStore(args.fleet_store, args.fleet_raw_hours, args.fleet_days)
+        fleet.store = store
+        t = Thread(target=record_fleet, args=(), daemon=True)
+        t.start()
+
+    if args.listen_push:
+        receiver = PushReceiver(fleet, args.listen_push)
+
+    run_server()
 
+if __name__ == '__main__':
+    main()
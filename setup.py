@@ -15,6 +15,10 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/madvay/berrymon",
     packages=setuptools.find_packages(),
+    py_modules=["berrymon"],
+    entry_points={
+        "console_scripts": ["berrymon=berrymon:main"],
+    },
     classifiers=(
         "Programming Language :: Python :: 3.5",
         "Topic :: Home Automation",
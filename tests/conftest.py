@@ -0,0 +1,152 @@
+import datetime
+import http.server
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import pytest
+
+# berrymon.py and berryspy.py are top-level scripts, not a package.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def free_port():
+    # free for TCP; in practice the same number is free for UDP too
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def http_stub():
+    """Starts local HTTP stand-ins: http_stub(handle) -> 'host:port'.
+
+    handle(request_handler) answers each request; it may sleep, fail or
+    inspect the request.  Servers are shut down after the test.
+    """
+    servers = []
+
+    def start(handle):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                handle(self)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        server = StubServer(('127.0.0.1', 0), Handler)
+        servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return '127.0.0.1:{0}'.format(server.server_address[1])
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def reply(handler, status, body, headers=()):
+    handler.send_response(status)
+    for k, v in headers:
+        handler.send_header(k, v)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def wait_for(cond, timeout=3.0):
+    until = time.time() + timeout
+    while time.time() < until:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class Routes:
+    """Runs a script's run_server() on a free port, on a fresh bottle app.
+
+    The script's BoundedThreadingWSGIServer is swapped for one that is
+    shut down again by stop(), and the bottle app dropped.
+    """
+
+    def __init__(self, monkeypatch, module):
+        sys.path.append(os.path.join(ROOT, 'third_party', 'bottle'))
+        self.bottle = pytest.importorskip('bottle')
+        self.monkeypatch = monkeypatch
+        self.module = module
+        self.servers = servers = []
+
+        class Server(module.BoundedThreadingWSGIServer):
+            def __init__(self, *a, **kw):
+                super().__init__(*a, **kw)
+                servers.append(self)
+        monkeypatch.setattr(module, 'BoundedThreadingWSGIServer', Server)
+        self.bottle.app.push()
+
+    def start(self, flags):
+        port = free_port()
+        flags = ['--server', '127.0.0.1', '--server_port', str(port)] + list(flags)
+        self.monkeypatch.setattr(self.module, 'args', self.module.parser.parse_args(flags))
+        # berryspy's run_server() serves on the calling thread
+        threading.Thread(target=self.module.run_server, daemon=True).start()
+        assert wait_for(lambda: self.servers)
+        return '127.0.0.1:{0}'.format(port)
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.bottle.app.pop()
+
+
+@pytest.fixture
+def berrymon_server(monkeypatch):
+    """Serves berrymon's routes on a free port: berrymon_server(*flags) -> 'host:port'.
+
+    Nothing is sampled: tests publish snapshots with publish().
+    """
+    import berrymon
+    routes = Routes(monkeypatch, berrymon)
+    monkeypatch.setattr(berrymon, 'snapshot', berrymon.Snapshot(0, None, {'_now': 0}, {}))
+    monkeypatch.setattr(berrymon, 'responses', berrymon.RenderCache())
+    yield lambda *flags: routes.start(flags)
+    # ends open streams at their next sample or keepalive
+    monkeypatch.setattr(berrymon, 'muststop', True)
+    routes.stop()
+
+
+@pytest.fixture
+def berryspy_server(monkeypatch):
+    """Serves berryspy's routes on a free port: berryspy_server(fleet, *flags) -> 'host:port'."""
+    import berryspy
+    routes = Routes(monkeypatch, berryspy)
+
+    def start(fleet, *flags):
+        monkeypatch.setattr(berryspy, 'fleet', fleet)
+        monkeypatch.setattr(berryspy, 'store', None)
+        return routes.start(flags)
+    yield start
+    routes.stop()
+
+
+def publish(data):
+    """Publishes data as berrymon's next snapshot, as update() does."""
+    import berrymon
+    with berrymon.published:
+        prev = berrymon.snapshot
+        berrymon.snapshot = berrymon.Snapshot(prev.seq + 1, datetime.datetime.now(), data, berrymon.changed(prev.data, data))
+        berrymon.published.notify_all()
+    return berrymon.snapshot
@@ -0,0 +1,48 @@
+from berrymon import AdaptiveScheduler
+
+
+def scheduler():
+    # normal 1s, slow 5s, fast 0.2s; fast on 0.5C/s, held 30s; slow below 50C
+    return AdaptiveScheduler(1, 5, 0.2, 0.5, 30, 50)
+
+
+def run(s, samples):
+    # samples: (t, temp, throttle bits); returns the period after each
+    return [s.next_period(t, temp, bits) for t, temp, bits in samples]
+
+
+def test_cool_board_slows_down_with_a_2c_band():
+    s = scheduler()
+    temps = [45, 49, 51, 52.5, 51, 49.9]
+    assert run(s, [(t * 10, temp, 0) for t, temp in enumerate(temps)]) == [5, 5, 5, 1, 1, 5]
+
+
+def test_current_throttle_flag_goes_fast_and_holds():
+    s = scheduler()
+    assert run(s, [(0, 60, 0), (1, 60, 0x4), (2, 60, 0)]) == [1, 0.2, 0.2]
+    # held for 30s after the flag was last seen, then back to normal
+    assert run(s, [(30.9, 60, 0), (31, 60, 0), (40, 60, 0)]) == [0.2, 1, 1]
+
+
+def test_sticky_flags_alone_stay_normal():
+    s = scheduler()
+    assert run(s, [(0, 60, 0x50000), (10, 60, 0x50000)]) == [1, 1]
+
+
+def test_fast_rise_goes_fast_and_recovers():
+    s = scheduler()
+    assert run(s, [(0, 60, 0), (1, 61, 0)]) == [1, 0.2]
+    # steady again: the rate drops at once, but the hold keeps it fast
+    assert run(s, [(2, 61, 0), (20, 61, 0), (31.5, 61, 0)]) == [0.2, 0.2, 1]
+
+
+def test_rise_is_measured_over_at_least_a_second():
+    s = scheduler()
+    # a 2C jump within 0.5s is quantization noise until a second has passed
+    assert run(s, [(0, 60, 0), (0.2, 62, 0), (0.5, 60, 0), (1.0, 60.2, 0)]) == [1, 1, 1, 1]
+
+
+def test_throttled_cool_board_is_fast_not_slow():
+    s = scheduler()
+    assert run(s, [(0, 40, 0x1), (10, 40, 0x1)]) == [0.2, 0.2]
+    assert run(s, [(45, 40, 0)]) == [5]
@@ -0,0 +1,61 @@
+import json
+
+from conftest import wait_for
+
+import berrymon
+from berrymon import BurstCapture
+
+
+class CappedFirmware:
+    """Mailbox-only sampler: the firmware caps the arm clock while under-voltage is set.
+
+    There is deliberately no arm_freq(): cpufreq would keep reporting the
+    requested 1.5GHz throughout.
+    """
+
+    def __init__(self, capped_reads):
+        self.capped_reads = capped_reads
+        self.reads = 0
+        self.clocks = []
+
+    def measured_clock(self, clock):
+        self.clocks.append(clock)
+        self.reads = self.reads + 1
+        return 600000000 if self.reads in self.capped_reads else 1500000000
+
+    def throttled(self):
+        return 0x50005 if self.reads in self.capped_reads else 0x50000
+
+
+def test_capture_records_the_measured_clock(tmp_path):
+    fw = CappedFirmware(capped_reads=range(20, 40))
+    burst = BurstCapture(fw, 1000, 0.1, 2, str(tmp_path))
+    assert burst.trigger('test')
+    assert wait_for(lambda: burst.list() and not burst.running)
+    event = burst.get(1)
+    assert set(fw.clocks) == {berrymon.MBOX_CLOCKS['arm']}
+    assert burst.list()[0]['samples'] == 100
+    assert event['summary']['freq_min'] == 600000000
+    assert event['summary']['freq_max'] == 1500000000
+    assert event['samples']['freq'].count(600000000) == 20
+    assert event['summary']['flag_seconds']['under_voltage'] > 0
+    saved = json.loads(next(tmp_path.iterdir()).read_text())
+    assert saved['samples']['freq'] == event['samples']['freq']
+
+
+def test_failed_reads_record_zero():
+    class Silent(CappedFirmware):
+        def measured_clock(self, clock):
+            return None
+    burst = BurstCapture(Silent(()), 1000, 0.01, 1)
+    event, samples = burst._capture('test')
+    assert samples['freq'] == [0] * 10
+    assert event['summary']['freq_max'] == 0
+
+
+def test_only_one_capture_runs_at_a_time():
+    burst = BurstCapture(CappedFirmware(()), 100, 0.5, 1)
+    assert burst.trigger('first')
+    assert not burst.trigger('second')
+    assert wait_for(lambda: not burst.running)
+    assert [e['reason'] for e in burst.list()] == ['first']
@@ -0,0 +1,104 @@
+import math
+
+import pytest
+
+from conftest import wait_for
+
+from berrymon import EnvSampler
+
+
+class SyntheticSenseHat:
+    """Sense HAT sensors following known signals, one step per read."""
+
+    def __init__(self, humidity=None, pressure=None, temp=None, accel=None):
+        self.humidity = humidity or (lambda i: 40.0)
+        self.pressure = pressure or (lambda i: 1013.0)
+        self.temp = temp or (lambda i: 30.0)
+        self.accel = accel or (lambda i: (0.0, 0.0, 1.0))
+        self.env_reads = 0
+        self.imu_reads = 0
+
+    def get_humidity(self):
+        return self.humidity(self.env_reads)
+
+    def get_pressure(self):
+        return self.pressure(self.env_reads)
+
+    def get_temperature(self):
+        v = self.temp(self.env_reads)
+        self.env_reads = self.env_reads + 1
+        return v
+
+    def get_accelerometer_raw(self):
+        x, y, z = self.accel(self.imu_reads)
+        self.imu_reads = self.imu_reads + 1
+        return {'x': x, 'y': y, 'z': z}
+
+
+def idle_sampler(hat):
+    # rates of 0 stop the thread at once, so reads are driven by the test
+    return EnvSampler(hat, 0, 0)
+
+
+def test_take_aggregates_since_the_last_take():
+    hat = SyntheticSenseHat(humidity=lambda i: 40.0 + i, temp=lambda i: 30.0 - i)
+    env = idle_sampler(hat)
+    for _ in range(5):
+        env.read_env()
+    got = env.take()
+    assert got['humidity'] == {'mean': 42.0, 'min': 40.0, 'max': 44.0, 'n': 5}
+    assert got['hat_temp']['min'] == 26.0
+    assert got['pressure']['n'] == 5
+    assert 'accel' not in got and 'vibration' not in got
+    # a take() starts new aggregates
+    assert env.take() == {}
+
+
+def test_sensors_reading_zero_are_skipped():
+    hat = SyntheticSenseHat(humidity=lambda i: 0.0 if i < 1 else 40.0, pressure=lambda i: 0.0 if i < 2 else 1000.0)
+    env = idle_sampler(hat)
+    for _ in range(4):
+        env.read_env()
+    got = env.take()
+    assert got['humidity']['n'] == 3
+    assert got['pressure']['n'] == 2
+    # the temperature is read from the humidity sensor
+    assert got['hat_temp']['n'] == 3
+
+
+def test_vibration_is_rms_deviation_of_magnitude():
+    # magnitude alternates 0.9g / 1.1g: mean 1g, RMS deviation 0.1g
+    hat = SyntheticSenseHat(accel=lambda i: (0.0, 0.0, 0.9 if i % 2 else 1.1))
+    env = idle_sampler(hat)
+    for _ in range(100):
+        env.read_imu()
+    got = env.take()
+    assert got['accel']['mean'] == pytest.approx(1.0)
+    assert got['vibration'] == pytest.approx(0.1)
+
+
+def test_still_board_has_no_vibration():
+    s = 1 / math.sqrt(3)
+    env = idle_sampler(SyntheticSenseHat(accel=lambda i: (s, s, s)))
+    for _ in range(50):
+        env.read_imu()
+    assert env.take()['vibration'] == pytest.approx(0.0, abs=1e-6)
+
+
+def test_thread_reads_at_the_configured_rates():
+    hat = SyntheticSenseHat()
+    env = EnvSampler(hat, 20, 200)
+    assert wait_for(lambda: hat.imu_reads >= 100, timeout=3)
+    got = env.take()
+    assert got['accel']['n'] >= 50
+    # the environment sensors are read about a tenth as often
+    assert got['humidity']['n'] < got['accel']['n'] / 4
+
+
+def test_failing_reads_are_counted():
+    class Broken(SyntheticSenseHat):
+        def get_accelerometer_raw(self):
+            raise OSError('I2C timeout')
+    env = EnvSampler(Broken(), 0, 100)
+    assert wait_for(lambda: env.errors >= 1)
+    assert env.take()['errors'] >= 1
@@ -0,0 +1,296 @@
+import http.client
+import json
+import time
+import urllib.parse
+
+from conftest import free_port, reply
+
+import berryspy
+from berryspy import FleetCollector
+
+
+def berrymon_json(temp=45.0):
+    return {'temp': temp, 'freq': 600000000, 'throttled': 0, 'state': '------',
+            'load': [1.0, 2.0], 'mem': 10.0, 'uptime': 100.0}
+
+
+def ok_host(http_stub, temp=45.0, etag='"1"'):
+    hits = []
+
+    def handle(h):
+        hits.append(h.headers.get('If-None-Match'))
+        if h.headers.get('If-None-Match') == etag:
+            reply(h, 304, b'', [('ETag', etag)])
+        else:
+            reply(h, 200, json.dumps(berrymon_json(temp)).encode(), [('ETag', etag)])
+    return http_stub(handle), hits
+
+
+def slow_host(http_stub, delay):
+    def handle(h):
+        time.sleep(delay)
+        reply(h, 200, json.dumps(berrymon_json()).encode())
+    return http_stub(handle)
+
+
+def dead_host():
+    # nothing listens on a port we just released
+    return '127.0.0.1:{0}'.format(free_port())
+
+
+def collector(**kw):
+    opts = dict(timeout=2.0, ttl=0.0, threads=8, deadline=0.5, max_backoff=60.0, push_stale=30.0, site=None, sites=())
+    opts.update(kw)
+    return FleetCollector(opts['timeout'], opts['ttl'], opts['threads'], opts['deadline'],
+                          opts['max_backoff'], opts['push_stale'], opts['site'], opts['sites'])
+
+
+def test_partial_results_within_deadline(http_stub):
+    ok, _ = ok_host(http_stub)
+    slow = slow_host(http_stub, 1.5)
+    dead = dead_host()
+    fleet = collector(deadline=0.4)
+
+    start = time.time()
+    results = fleet.collect([ok, slow, dead])
+    elapsed = time.time() - start
+
+    assert elapsed < 1.0
+    assert results[ok]['stale'] is False
+    assert results[ok]['data']['temp'] == 45.0
+    assert results[ok]['latency'] is not None
+    assert results[slow]['stale'] is True
+    assert 'data' not in results[slow]
+    assert results[dead]['stale'] is True
+    assert results[dead]['failures'] == 1
+
+
+def test_slow_host_finishes_in_background(http_stub):
+    slow = slow_host(http_stub, 0.5)
+    fleet = collector(deadline=0.1)
+    assert fleet.collect([slow])[slow]['stale'] is True
+    time.sleep(0.8)
+    fleet.ttl = 60
+    results = fleet.collect([slow])
+    assert results[slow]['stale'] is False
+    assert results[slow]['data']['temp'] == 45.0
+    assert results[slow]['latency'] >= 0.5
+
+
+def test_ttl_reuses_results_and_revalidates_with_etag(http_stub):
+    ok, hits = ok_host(http_stub)
+    fleet = collector(ttl=60.0)
+    for _ in range(5):
+        fleet.collect([ok])
+    assert len(hits) == 1
+
+    fleet.ttl = 0
+    fleet.collect([ok])
+    assert hits == [None, '"1"']
+    assert fleet.collect([ok])[ok]['data']['temp'] == 45.0
+
+
+def test_dead_host_backs_off_exponentially(http_stub):
+    dead = dead_host()
+    fleet = collector(ttl=1.0, max_backoff=5.0)
+    st = berryspy.HostState()
+    delays = []
+    for _ in range(5):
+        fleet._scrape(dead, st)
+        delays.append(round(st.retry_at - st.scraped, 3))
+    assert delays == [2.0, 4.0, 5.0, 5.0, 5.0]
+    # not retried before its backoff expires
+    fleet.hosts[dead] = st
+    fleet.collect([dead])
+    assert st.inflight is None
+    assert st.failures == 5
+
+
+def test_long_outage_does_not_wedge_the_host(http_stub):
+    dead = dead_host()
+    fleet = collector(ttl=5.0, max_backoff=300.0)
+    st = berryspy.HostState()
+    # about 85 hours of failures at the 300s cap
+    st.failures = 1100
+    fleet._scrape(dead, st)
+    assert st.inflight is None
+    assert st.retry_at - st.scraped == 300.0
+
+    # once the host is back, the next scrape recovers it
+    ok, _ = ok_host(http_stub)
+    fleet._scrape(ok, st)
+    assert st.error is None
+    assert st.failures == 0
+    assert st.data['temp'] == 45.0
+
+
+def test_state_reports_only_changed_hosts(http_stub):
+    a, _ = ok_host(http_stub, temp=40.0, etag='"a"')
+    b, _ = ok_host(http_stub, temp=50.0, etag='"b"')
+    fleet = collector()
+    fleet.collect([a, b])
+
+    full = fleet.state(0, None)
+    assert full['full'] is True
+    assert set(full['hosts']) == {a, b}
+
+    # a 304 from both leaves nothing new to send
+    fleet.collect([a, b])
+    again = fleet.state(full['seq'], full['epoch'])
+    assert again['full'] is False
+    assert again['hosts'] == {}
+
+    fleet.ingest('pushed', time.time(), berrymon_json(60.0))
+    pushed = fleet.state(again['seq'], again['epoch'])
+    assert list(pushed['hosts']) == ['pushed']
+    assert fleet.fed_hosts() == ['pushed']
+
+
+def site(http_stub, downstream):
+    """Serves /fleet/state from downstream[0], a FleetCollector that can be swapped."""
+    paths = []
+
+    def handle(h):
+        paths.append(h.path)
+        q = urllib.parse.parse_qs(urllib.parse.urlsplit(h.path).query)
+        state = downstream[0].state(int(q.get('since', ['0'])[0]), q.get('epoch', [''])[0])
+        reply(h, 200, json.dumps(state).encode())
+    return http_stub(handle), paths
+
+
+class Recorded:
+    def __init__(self):
+        self.samples = []
+
+    def add(self, host, t, data):
+        self.samples.append((host, data['temp']))
+
+
+def test_sites_merge_as_site_slash_host(http_stub):
+    edge = collector(site='edge')
+    edge.ingest('a', time.time(), berrymon_json(40.0))
+    edge.ingest('b', time.time(), berrymon_json(50.0))
+    addr, paths = site(http_stub, [edge])
+    fleet = collector(sites=[addr])
+    fleet.store = Recorded()
+
+    fleet.collect([])
+    results = fleet.collect(['edge/a', 'edge/b'])
+    assert results['edge/a']['data']['temp'] == 40.0
+    assert results['edge/b']['data']['temp'] == 50.0
+    assert results['edge/a']['stale'] is False
+    assert fleet.fed_hosts() == ['edge/a', 'edge/b']
+    assert sorted(fleet.store.samples) == [('edge/a', 40.0), ('edge/b', 50.0)]
+    # the first request asks for everything
+    assert paths[0] == '/fleet/state?since=0&epoch='
+
+
+def test_sites_are_fetched_incrementally(http_stub):
+    edge = collector(site='edge')
+    edge.ingest('a', time.time(), berrymon_json(40.0))
+    edge.ingest('b', time.time(), berrymon_json(50.0))
+    addr, paths = site(http_stub, [edge])
+    fleet = collector(sites=[addr])
+    fleet.store = Recorded()
+    fleet.collect([])
+
+    edge.ingest('b', time.time() + 1, berrymon_json(55.0))
+    fleet.collect([])
+    # only b was sent again, and a is still there
+    assert paths[1] == '/fleet/state?since={0}&epoch={1}'.format(edge.seq - 1, edge.epoch)
+    results = fleet.collect(['edge/a', 'edge/b'])
+    assert results['edge/a']['data']['temp'] == 40.0
+    assert results['edge/b']['data']['temp'] == 55.0
+    assert fleet.store.samples[-1] == ('edge/b', 55.0)
+
+    # merged hosts are passed on again to a site further up
+    up = fleet.state(0, None)
+    assert set(up['hosts']) == {'edge/a', 'edge/b'}
+    assert fleet.state(up['seq'], up['epoch'])['hosts'] == {}
+
+
+def test_restarted_site_replaces_its_hosts(http_stub):
+    edge = collector(site='edge')
+    edge.ingest('a', time.time(), berrymon_json(40.0))
+    edge.ingest('b', time.time(), berrymon_json(50.0))
+    downstream = [edge]
+    addr, _ = site(http_stub, downstream)
+    fleet = collector(sites=[addr])
+    fleet.collect([])
+
+    # a new process: a new epoch, and b is gone
+    restarted = collector(site='edge')
+    restarted.epoch = edge.epoch + '0'
+    restarted.ingest('a', time.time(), berrymon_json(42.0))
+    downstream[0] = restarted
+    fleet.collect([])
+    assert fleet.fed_hosts() == ['edge/a']
+    assert fleet.collect(['edge/a'])['edge/a']['data']['temp'] == 42.0
+
+
+def test_unnamed_site_is_listed_under_its_address(http_stub):
+    edge = collector()
+    edge.ingest('a', time.time(), berrymon_json(40.0))
+    addr, _ = site(http_stub, [edge])
+    fleet = collector(sites=[addr])
+    fleet.collect([])
+    assert fleet.fed_hosts() == [addr + '/a']
+
+
+def test_unreachable_site_marks_its_hosts_stale(http_stub):
+    edge = collector(site='edge')
+    edge.ingest('a', time.time(), berrymon_json(40.0))
+    up = [True]
+
+    def handle(h):
+        if not up[0]:
+            reply(h, 503, b'')
+            return
+        q = urllib.parse.parse_qs(urllib.parse.urlsplit(h.path).query)
+        reply(h, 200, json.dumps(edge.state(int(q['since'][0]), q.get('epoch', [''])[0])).encode())
+    addr = http_stub(handle)
+    fleet = collector(sites=[addr], max_backoff=0.0)
+    fleet.collect([])
+
+    up[0] = False
+    fleet.collect([])
+    ret = fleet.collect(['edge/a'])['edge/a']
+    assert ret['stale'] is True
+    assert 'HTTP 503' in ret['site_error']
+    # the last data is kept while the site is down
+    assert ret['data']['temp'] == 40.0
+
+    up[0] = True
+    fleet.collect([])
+    ret = fleet.collect(['edge/a'])['edge/a']
+    assert ret['stale'] is False and 'site_error' not in ret
+
+
+def get(server, path):
+    conn = http.client.HTTPConnection(server, timeout=5)
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    return resp.status, resp.read().decode()
+
+
+def test_merged_table_escapes_names_and_values(berryspy_server):
+    fleet = collector()
+    fleet.ingest('pi<b>', time.time(), dict(berrymon_json(), state='<script>x</script>'))
+    server = berryspy_server(fleet)
+    status, body = get(server, '/')
+    assert status == 200
+    assert '<th>pi&lt;b&gt;</th>' in body
+    assert '&lt;script&gt;x&lt;/script&gt;' in body and '<script>' not in body
+
+    # a viewer's unknown host is listed with an error, not scraped
+    status, body = get(server, '/?hosts=' + urllib.parse.quote('<img src=x>'))
+    assert '<th>&lt;img src=x&gt;</th>' in body
+    assert 'not scraped' in body and '<img' not in body
+
+
+def test_simple_view_escapes_host_names(berryspy_server):
+    server = berryspy_server(collector())
+    status, body = get(server, '/simple?hosts=' + urllib.parse.quote('"><script>x</script>'))
+    assert status == 200
+    assert '<script>x' not in body
+    assert 'src="http://&quot;&gt;&lt;script&gt;' in body
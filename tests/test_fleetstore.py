@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from berryspy import FleetStore, percentile
+
+# an hour boundary, so segment starts are easy to predict
+T0 = 1700002800
+
+
+@pytest.mark.parametrize('values, p, expected', [
+    (list(range(1, 101)), 95, 95),
+    (list(range(1, 101)), 99, 99),
+    (list(range(1, 101)), 7, 7),
+    (list(range(1, 101)), 100, 100),
+    (list(range(1, 101)), 0, 1),
+    (list(range(1, 21)), 95, 19),
+    (list(range(100)), 95, 94),
+    ([5], 50, 5),
+    ([], 50, None),
+])
+def test_percentile_is_nearest_rank(values, p, expected):
+    assert percentile(values, p) == expected
+
+
+def sample(temp, load=(10.0, 30.0)):
+    return {'temp': temp, 'freq': 1500000000, 'mem': 20.0, 'uptime': 100.0, 'load': list(load), 'throttled': 0}
+
+
+def segments(store, metric='temp'):
+    return [(kind, start) for kind, start, _, _ in store.segments(metric)]
+
+
+def test_queries_aggregate_across_hosts(tmp_path):
+    store = FleetStore(str(tmp_path), 2, 7)
+    for i in range(100):
+        store.add('pi{0}'.format(i % 4), T0 + i, sample(float(i)))
+    store.flush()
+    now = T0 + 100
+    assert store.query('temp', 'count', 3600, now=now)['value'] == 100
+    assert store.query('temp', 'max', 3600, now=now)['value'] == 99.0
+    assert store.query('temp', 'mean', 3600, now=now)['value'] == pytest.approx(49.5)
+    assert store.query('temp', 'p95', 3600, now=now)['value'] == 94.0
+    # only the last 10 seconds
+    assert store.query('temp', 'min', 10, now=now)['value'] == 90.0
+    # load is the mean across cores
+    assert store.query('load', 'max', 3600, now=now)['value'] == 20.0
+
+
+def test_queries_by_host(tmp_path):
+    store = FleetStore(str(tmp_path), 2, 7)
+    for i in range(100):
+        store.add('pi{0}'.format(i % 4), T0 + i, sample(float(i)))
+    store.flush()
+    ret = store.query('temp', 'max', 3600, by_host=True, now=T0 + 100)
+    assert ret['hosts'] == {'pi0': 96.0, 'pi1': 97.0, 'pi2': 98.0, 'pi3': 99.0}
+
+
+def test_bad_queries_raise_value_error(tmp_path):
+    store = FleetStore(str(tmp_path), 2, 7)
+    with pytest.raises(ValueError):
+        store.query('nope', 'max', 60)
+    with pytest.raises(ValueError):
+        store.query('temp', 'median', 60)
+
+
+def test_samples_rotate_into_hourly_segments(tmp_path):
+    store = FleetStore(str(tmp_path), 2, 7)
+    for h in range(3):
+        store.add('pi', T0 + h * 3600 + 5, sample(40.0 + h))
+    store.flush()
+    assert segments(store) == [('r', T0), ('r', T0 + 3600), ('r', T0 + 7200)]
+    # a window reaching back into the first hour includes it
+    assert store.query('temp', 'min', 3 * 3600, now=T0 + 7300)['value'] == 40.0
+    assert store.query('temp', 'min', 3600, now=T0 + 7300)['value'] == 42.0
+
+
+def test_compaction_keeps_minute_means_then_expires(tmp_path):
+    store = FleetStore(str(tmp_path), 1, 2)
+    # two samples in each of two minutes of the first hour
+    for t, v in ((0, 10.0), (30, 20.0), (60, 30.0), (90, 50.0)):
+        store.add('pi', T0 + t, sample(v))
+    store.add('pi', T0 + 3600 * 3, sample(60.0))
+    store.flush()
+
+    store.compact(now=T0 + 3600 * 3 + 10)
+    day = T0 - T0 % 86400
+    assert ('m', day) in segments(store)
+    assert ('r', T0) not in segments(store)
+    # the raw hour still being written isn't compacted
+    assert ('r', T0 + 3600 * 3) in segments(store)
+    ret = store.query('temp', 'count', 4 * 3600, now=T0 + 3600 * 3 + 10)
+    assert ret['value'] == 3
+    assert store.query('temp', 'max', 4 * 3600, now=T0 + 3600 * 3 + 10)['value'] == 60.0
+    assert store.query('temp', 'min', 4 * 3600, now=T0 + 3600 * 3 + 10)['value'] == 15.0
+
+    store.compact(now=day + 86400 * 4)
+    assert not any(kind == 'm' for kind, _ in segments(store))
+
+
+def test_host_ids_survive_a_restart(tmp_path):
+    store = FleetStore(str(tmp_path), 2, 7)
+    store.add('a', T0, sample(1.0))
+    store.add('b', T0, sample(2.0))
+    store.flush()
+    again = FleetStore(str(tmp_path), 2, 7)
+    again.add('c', T0 + 1, sample(3.0))
+    again.flush()
+    assert again.query('temp', 'max', 3600, by_host=True, now=T0 + 2)['hosts'] == {'a': 1.0, 'b': 2.0, 'c': 3.0}
+
+
+def test_torn_trailing_record_is_ignored(tmp_path):
+    store = FleetStore(str(tmp_path), 2, 7)
+    store.add('pi', T0, sample(41.0))
+    store.flush()
+    path = store.segments('temp')[0][3]
+    with open(path, 'ab') as f:
+        f.write(b'\x01\x02\x03')
+    assert os.path.getsize(path) % FleetStore.RECORD.size
+    assert store.query('temp', 'count', 3600, now=T0 + 1)['value'] == 1
@@ -0,0 +1,142 @@
+import http.client
+import json
+import time
+
+import pytest
+
+import berrymon
+from berrymon import History, MetricHistory, Ring
+
+# a whole hour, so minute and hour buckets are easy to predict
+T0 = 1700002800
+
+
+def test_ring_wraps_and_finds_rows():
+    r = Ring(4, 1)
+    assert r.oldest() is None
+    for t in range(6):
+        r.append(T0 + t, t * 10)
+    # rows 0 and 1 were overwritten
+    assert r.start() == 2 and r.n == 6
+    assert r.oldest() == T0 + 2
+    assert r.row(r.find(T0)) == (T0 + 2, 20.0)
+    assert r.row(r.find(T0 + 3)) == (T0 + 3, 30.0)
+    assert r.row(r.find_after(T0 + 3)) == (T0 + 4, 40.0)
+    assert r.find(T0 + 10) == r.n
+
+
+def test_raw_query_returns_samples():
+    h = MetricHistory(100, 10, 10)
+    for t in range(5):
+        h.add(T0 + t, 40.0 + t)
+    ret = h.query(T0 + 2, 0)
+    assert ret['tier'] == 1
+    assert ret['t'] == [T0 + 2, T0 + 3, T0 + 4]
+    assert ret['min'] == ret['max'] == ret['mean'] == [42.0, 43.0, 44.0]
+
+
+def test_minute_rollups_include_the_open_bucket():
+    h = MetricHistory(1000, 10, 10)
+    # minute 0: 0..59, minute 1: 100..159, minute 2 (still open): 200..229
+    for t in range(150):
+        h.add(T0 + t, (t // 60) * 100 + t % 60)
+    ret = h.query(T0, 60)
+    assert ret['tier'] == 60
+    assert ret['t'] == [T0, T0 + 60, T0 + 120]
+    assert ret['min'] == [0, 100, 200]
+    assert ret['max'] == [59, 159, 229]
+    assert ret['mean'] == pytest.approx([29.5, 129.5, 214.5])
+
+
+def test_coarser_steps_combine_rollup_rows():
+    h = MetricHistory(1000, 10, 10)
+    for t in range(0, 300, 10):
+        h.add(T0 + t, t)
+    ret = h.query(T0, 120)
+    assert ret['t'] == [T0, T0 + 120, T0 + 240]
+    assert ret['min'] == [0, 120, 240]
+    assert ret['max'] == [110, 230, 290]
+    # means of the minute means
+    assert ret['mean'] == pytest.approx([55, 175, 265])
+
+
+def test_falls_back_to_rollups_once_raw_has_wrapped():
+    h = MetricHistory(30, 10, 10)
+    for t in range(120):
+        h.add(T0 + t, t)
+    # raw only reaches back to T0 + 90, so a query from T0 uses minutes
+    ret = h.query(T0, 0)
+    assert ret['tier'] == 60
+    assert ret['min'] == [0, 60]
+    # a recent one still gets raw samples
+    assert h.query(T0 + 100, 0)['tier'] == 1
+
+
+def test_bitmask_rollups_and_or_and_count():
+    h = MetricHistory(100, 10, 10, bits=True)
+    for t, bits in enumerate([0x50000, 0x50005, 0x50000, 0x50001]):
+        h.add(T0 + t, bits)
+    ret = h.query(T0, 60)
+    assert ret['min'] == [0x50000]
+    assert ret['max'] == [0x50005]
+    # the fraction of samples with any bit set
+    assert ret['mean'] == [1.0]
+    h = MetricHistory(100, 10, 10, bits=True)
+    for t, bits in enumerate([0, 4, 0, 0]):
+        h.add(T0 + t, bits)
+    assert h.query(T0, 60)['mean'] == [0.25]
+
+
+def test_history_keeps_each_metric():
+    hist = History(100, 10, 10)
+    hist.add(T0, {'temp': 45.0, 'freq': 600000000, 'mem': 20.0, 'throttled': 0, 'load': [1.0, 2.0],
+                  'disk_read': 512.0, 'env': {'humidity': {'mean': 40.0}, 'vibration': 0.01}, '_period': 0.5})
+    for metric, value in (('temp', 45.0), ('load1', 2.0), ('disk_read', 512.0), ('humidity', 40.0),
+                          ('vibration', 0.01), ('period', 0.5)):
+        assert hist.query(metric, T0, 0)['mean'] == [pytest.approx(value)]
+    assert hist.query('net_rx', T0, 0) is None
+
+
+def test_values_that_failed_to_read_leave_gaps():
+    hist = History(100, 10, 10)
+    hist.add(T0, {'temp': 45.0, 'freq': 1, 'mem': None, 'throttled': 0, 'load': [None, 2.0]})
+    hist.add(T0 + 1, {'temp': 46.0, 'freq': 1, 'mem': 30.0, 'throttled': 0, 'load': [1.0, 2.0]})
+    assert hist.query('mem', T0, 0)['t'] == [T0 + 1]
+    assert hist.query('load0', T0, 0)['t'] == [T0 + 1]
+    assert hist.query('load1', T0, 0)['t'] == [T0, T0 + 1]
+
+
+def get(server, path):
+    conn = http.client.HTTPConnection(server, timeout=5)
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    return resp.status, resp.read()
+
+
+@pytest.mark.parametrize('query', ['since=abc', 'step=1m', 'since=nan', 'step=inf', 'since=-inf'])
+def test_route_rejects_bad_numbers(berrymon_server, monkeypatch, query):
+    monkeypatch.setattr(berrymon, 'history', History(100, 10, 10))
+    status, _ = get(berrymon_server(), '/history?' + query)
+    assert status == 400
+
+
+def test_route(berrymon_server, monkeypatch):
+    hist = History(100, 10, 10)
+    now = time.time()
+    # every 10s up to 10s ago
+    for t in range(10):
+        hist.add(now - 100 + 10 * t, {'temp': 40.0 + t, 'freq': 1, 'mem': 1.0, 'throttled': 0, 'load': []})
+    monkeypatch.setattr(berrymon, 'history', hist)
+    server = berrymon_server()
+    status, body = get(server, '/history?metric=temp&since=-55')
+    ret = json.loads(body.decode())
+    assert status == 200
+    assert ret['metric'] == 'temp'
+    # a negative since is relative to now
+    assert ret['mean'] == pytest.approx([45.0, 46.0, 47.0, 48.0, 49.0])
+    assert get(server, '/history?metric=nope')[0] == 404
+
+
+def test_route_without_history_is_404(berrymon_server, monkeypatch):
+    monkeypatch.setattr(berrymon, 'history', None)
+    assert get(berrymon_server(), '/history')[0] == 404
@@ -0,0 +1,114 @@
+import threading
+
+import berrymon
+from berrymon import C_BLACK, C_BLUE, C_GREEN, C_RED, Leds, blank, put
+
+
+class FakeSenseHat:
+    """Counts LED writes and keeps the 8x8 matrix they would produce."""
+
+    def __init__(self):
+        self.pixels = [None] * 64
+        self.set_pixel_calls = 0
+        self.set_pixels_calls = 0
+
+    def set_pixel(self, x, y, color):
+        self.set_pixel_calls = self.set_pixel_calls + 1
+        self.pixels[y * 8 + x] = color
+
+    def set_pixels(self, frame):
+        assert len(frame) == 64
+        self.set_pixels_calls = self.set_pixels_calls + 1
+        self.pixels = list(frame)
+
+    def bus_writes(self):
+        return self.set_pixel_calls + self.set_pixels_calls
+
+
+def test_first_frame_is_written_in_bulk():
+    hat = FakeSenseHat()
+    leds = Leds(hat)
+    leds.show(blank())
+    assert hat.set_pixels_calls == 1
+    assert hat.pixels == blank()
+    assert leds.writes == 1
+
+
+def test_unchanged_frame_writes_nothing():
+    hat = FakeSenseHat()
+    leds = Leds(hat)
+    for _ in range(10):
+        leds.fill(C_BLUE)
+    assert hat.bus_writes() == 1
+    assert leds.writes == 1
+
+
+def test_single_pixel_change_uses_set_pixel():
+    hat = FakeSenseHat()
+    leds = Leds(hat)
+    frame = blank()
+    leds.show(frame)
+    put(frame, 3, 5, C_RED)
+    leds.show(frame)
+    assert hat.set_pixel_calls == 1
+    assert hat.set_pixels_calls == 1
+    assert hat.pixels[5 * 8 + 3] == C_RED
+
+
+def test_several_changes_use_one_bulk_write():
+    hat = FakeSenseHat()
+    leds = Leds(hat)
+    frame = blank()
+    leds.show(frame)
+    put(frame, 0, 0, C_RED)
+    put(frame, 7, 7, C_GREEN)
+    leds.show(frame)
+    assert hat.set_pixel_calls == 0
+    assert hat.set_pixels_calls == 2
+    assert hat.pixels == frame
+
+
+def test_caller_mutating_its_frame_is_still_diffed():
+    hat = FakeSenseHat()
+    leds = Leds(hat)
+    frame = blank()
+    leds.show(frame)
+    # show() must keep its own copy of what's on the matrix
+    put(frame, 1, 1, C_RED)
+    leds.show(frame)
+    assert hat.pixels[9] == C_RED
+    assert leds.writes == 2
+
+
+def test_concurrent_writers_leave_matrix_matching_last_shown():
+    hat = FakeSenseHat()
+    leds = Leds(hat)
+
+    def paint(color):
+        for _ in range(200):
+            leds.fill(color)
+            leds.fill(C_BLACK)
+    threads = [threading.Thread(target=paint, args=(c,)) for c in (C_RED, C_GREEN, C_BLUE)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert hat.pixels == leds.shown
+
+
+def test_steady_display_writes_only_the_blinker(monkeypatch):
+    hat = FakeSenseHat()
+    monkeypatch.setattr(berrymon, 'leds', Leds(hat))
+    monkeypatch.setattr(berrymon, 'last_blink', 0, raising=False)
+    for _ in range(6):
+        berrymon.display(60.0, 1000000000, '------')
+    # one bulk write per tick for the two blinker pixels, and nothing else redrawn
+    assert hat.set_pixels_calls == 6
+    assert hat.set_pixel_calls == 0
+    assert hat.pixels[7 * 8 + 2] == C_BLACK
+    assert hat.pixels[2] == C_GREEN
+
+    before = hat.bus_writes()
+    berrymon.display(60.0, 1000000000, '------', alert=True)
+    assert hat.bus_writes() == before + 1
+    assert hat.pixels[3 * 8 + 7] == berrymon.C_YELLOW
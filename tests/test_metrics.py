@@ -0,0 +1,114 @@
+import http.client
+import re
+
+from conftest import publish
+
+import berrymon
+from berrymon import Rules, Stats, render_metrics
+
+SAMPLE = re.compile(r'([a-z_]+)(?:\{(.*)\})? (\S+)$')
+
+
+def sample(**kw):
+    data = {'temp': 48.3, 'freq': 600000000, 'throttled': 0x50005, 'state': 'UT----',
+            'load': [10.0, 20.5], 'mem': 33.1, 'uptime': 1234.5}
+    data.update(kw)
+    return data
+
+
+def parse(text):
+    """{name: {labels: value}}, checking every family has HELP and TYPE before its samples."""
+    families = {}
+    typed = set()
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            typed.add(line.split()[2])
+            continue
+        m = SAMPLE.match(line)
+        assert m, line
+        name, labels, value = m.groups()
+        family = re.sub(r'_(bucket|sum|count)$', '', name) if name not in typed else name
+        assert family in typed, line
+        families.setdefault(name, {})[labels or ''] = float(value)
+    return families
+
+
+def test_gauges_and_labels(monkeypatch):
+    monkeypatch.setattr(berrymon, 'rules', None)
+    monkeypatch.setattr(berrymon, 'stats', None)
+    m = parse(render_metrics(sample(freqs=[600000000, 1500000000], disk_read=512.0, disk_write=0.0,
+                                    net_rx=10.0, net_tx=20.0, vc_measure_volts_core=1.2)))
+    assert m['berrymon_temperature_celsius'] == {'': 48.3}
+    assert m['berrymon_arm_frequency_hertz'] == {'': 600000000}
+    assert m['berrymon_cpu_load_percent'] == {'cpu="0"': 10.0, 'cpu="1"': 20.5}
+    assert m['berrymon_core_frequency_hertz']['cpu="1"'] == 1500000000
+    assert m['berrymon_disk_bytes_per_second'] == {'direction="read"': 512.0, 'direction="write"': 0.0}
+    assert m['berrymon_network_bytes_per_second']['direction="transmit"'] == 20.0
+    assert m['berrymon_vcgencmd_value'] == {'query="measure_volts_core"': 1.2}
+    # 0x50005: under-voltage and throttled now, and both since boot
+    assert m['berrymon_throttle_active'] == {'flag="under_voltage"': 1, 'flag="frequency_capped"': 0, 'flag="throttled"': 1}
+    assert m['berrymon_throttle_occurred'] == {'flag="under_voltage"': 1, 'flag="frequency_capped"': 0, 'flag="throttled"': 1}
+
+
+def test_missing_values_and_optional_families_are_left_out(monkeypatch):
+    monkeypatch.setattr(berrymon, 'rules', None)
+    monkeypatch.setattr(berrymon, 'stats', None)
+    text = render_metrics(sample(mem=None, load=[None, 5.0]))
+    m = parse(text)
+    assert 'berrymon_memory_used_percent' not in m
+    assert m['berrymon_cpu_load_percent'] == {'cpu="1"': 5.0}
+    for name in ('core_frequency', 'disk_bytes', 'network_bytes', 'vcgencmd', 'alert_firing', 'stage_seconds'):
+        assert 'berrymon_' + name not in text
+
+
+def test_env_means(monkeypatch):
+    monkeypatch.setattr(berrymon, 'rules', None)
+    monkeypatch.setattr(berrymon, 'stats', None)
+    env = {'humidity': {'mean': 40.0}, 'hat_temp': {'mean': 30.5}, 'vibration': 0.01}
+    m = parse(render_metrics(sample(env=env)))
+    assert m['berrymon_humidity_percent'] == {'': 40.0}
+    assert m['berrymon_sensehat_temperature_celsius'] == {'': 30.5}
+    assert m['berrymon_vibration_rms_g'] == {'': 0.01}
+    assert 'berrymon_pressure_millibars' not in m
+
+
+def test_alerts_firing(monkeypatch, tmp_path):
+    path = tmp_path / 'rules'
+    path.write_text('hot: temp > 75\nundervolt: state contains \'U\'\n')
+    monkeypatch.setattr(berrymon, 'rules', Rules(str(path)))
+    monkeypatch.setattr(berrymon, 'stats', None)
+    m = parse(render_metrics(sample(_alerts=['undervolt'])))
+    assert m['berrymon_alert_firing'] == {'alert="hot"': 0, 'alert="undervolt"': 1}
+
+
+def test_stage_histograms_are_cumulative(monkeypatch):
+    stats = Stats()
+    for seconds in (0.00002, 0.002, 0.002, 5.0, 50.0):
+        stats.observe('update', seconds)
+    stats.overruns = 2
+    monkeypatch.setattr(berrymon, 'rules', None)
+    monkeypatch.setattr(berrymon, 'stats', stats)
+    m = parse(render_metrics(sample()))
+    buckets = m['berrymon_stage_seconds_bucket']
+    assert buckets['stage="update",le="3e-05"'] == 1
+    assert buckets['stage="update",le="0.003"'] == 3
+    assert buckets['stage="update",le="10"'] == 4
+    assert buckets['stage="update",le="+Inf"'] == 5
+    assert m['berrymon_stage_seconds_count'] == {'stage="update"': 5}
+    assert m['berrymon_stage_seconds_sum']['stage="update"'] == sum((0.00002, 0.002, 0.002, 5.0, 50.0))
+    assert m['berrymon_tick_overruns_total'] == {'': 2}
+
+
+def test_route(berrymon_server, monkeypatch):
+    monkeypatch.setattr(berrymon, 'rules', None)
+    monkeypatch.setattr(berrymon, 'stats', None)
+    conn = http.client.HTTPConnection(berrymon_server(), timeout=5)
+    publish(sample())
+    conn.request('GET', '/metrics')
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert resp.getheader('Content-Type') == 'text/plain; version=0.0.4; charset=utf-8'
+    assert parse(resp.read().decode())['berrymon_temperature_celsius'] == {'': 48.3}
+    conn.close()
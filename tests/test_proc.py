@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from berrymon import ProcCollector
+
+from test_sysfs import write
+
+
+def stat(cores, btime=1000):
+    # cores: (user, system, idle, iowait) jiffies per core
+    lines = ['cpu  1 2 3 4 5 6 7 8 0 0']
+    for i, (user, system, idle, iowait) in enumerate(cores):
+        lines.append('cpu{0} {1} 0 {2} {3} {4} 0 0 0 0 0'.format(i, user, system, idle, iowait))
+    lines += ['intr 12345 0 0', 'ctxt 999', 'btime {0}'.format(btime), 'processes 42']
+    return '\n'.join(lines) + '\n'
+
+
+MEMINFO = 'MemTotal:        1000000 kB\nMemFree:          100000 kB\nMemAvailable:     750000 kB\nBuffers:           10000 kB\nCached:           200000 kB\n'
+
+
+def diskstats(read, written):
+    return ('   7       0 loop0 100 0 {0} 0 0 0 {1} 0 0 0 0\n'
+            ' 179       0 mmcblk0 100 0 {0} 0 0 0 {1} 0 0 0 0\n'
+            ' 179       1 mmcblk0p1 100 0 {0} 0 0 0 {1} 0 0 0 0\n').format(read, written)
+
+
+def netdev(rx, tx):
+    return ('Inter-|   Receive                                                |  Transmit\n'
+            ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed\n'
+            '    lo: 5000000 10 0 0 0 0 0 0 5000000 10 0 0 0 0 0 0\n'
+            '  eth0: {0} 10 0 0 0 0 0 0 {1} 10 0 0 0 0 0 0\n').format(rx, tx)
+
+
+@pytest.fixture
+def proc(tmp_path):
+    write(tmp_path, 'proc/stat', stat([(100, 100, 800, 0), (0, 0, 1000, 0)], btime=int(time.time()) - 3600))
+    write(tmp_path, 'proc/meminfo', MEMINFO)
+    write(tmp_path, 'proc/diskstats', diskstats(0, 0))
+    write(tmp_path, 'proc/net/dev', netdev(0, 0))
+    for name in ('mmcblk0', 'loop0', 'ram0'):
+        (tmp_path / 'sys' / 'block' / name).mkdir(parents=True)
+    c = ProcCollector(str(tmp_path))
+    yield tmp_path, c
+    c.close()
+
+
+def test_load_is_a_delta_between_ticks(proc):
+    root, c = proc
+    first = c.collect()
+    assert first['load'] == [20.0, 0.0]
+    # core 0: 50 busy of 100; core 1: iowait counts as idle
+    write(root, 'proc/stat', stat([(140, 110, 850, 0), (0, 0, 1050, 50)]))
+    assert c.collect()['load'] == [50.0, 0.0]
+
+
+def test_memory_and_uptime(proc):
+    root, c = proc
+    data = c.collect()
+    assert data['mem'] == 25.0
+    assert 3599 <= data['uptime'] <= 3700
+
+
+def test_memory_without_memavailable(tmp_path):
+    write(tmp_path, 'proc/stat', stat([(0, 0, 1, 0)]))
+    write(tmp_path, 'proc/meminfo', 'MemTotal: 1000 kB\nMemFree: 100 kB\nBuffers: 100 kB\nCached: 300 kB\n')
+    c = ProcCollector(str(tmp_path))
+    data = c.collect()
+    assert data['mem'] == 50.0
+    # no diskstats or net/dev: no rates at all
+    c.collect()
+    assert 'disk_read' not in c.collect()
+    c.close()
+
+
+def test_rates_count_whole_disks_and_skip_loopback(proc):
+    root, c = proc
+    assert 'disk_read' not in c.collect()
+    c.io_time = time.monotonic() - 2.0
+    write(root, 'proc/diskstats', diskstats(2000, 4000))
+    write(root, 'proc/net/dev', netdev(10000, 20000))
+    data = c.collect()
+    # only mmcblk0: not loop0, and not the mmcblk0p1 partition
+    assert data['disk_read'] == pytest.approx(2000 * 512 / 2.0, rel=0.01)
+    assert data['disk_write'] == pytest.approx(4000 * 512 / 2.0, rel=0.01)
+    assert data['net_rx'] == pytest.approx(5000, rel=0.01)
+    assert data['net_tx'] == pytest.approx(10000, rel=0.01)
+
+
+def test_counter_going_backwards_reads_as_idle(proc):
+    root, c = proc
+    write(root, 'proc/net/dev', netdev(10000, 10000))
+    c.collect()
+    write(root, 'proc/net/dev', netdev(10, 20000))
+    c.io_time = time.monotonic() - 1.0
+    data = c.collect()
+    assert data['net_rx'] == 0
+    assert data['net_tx'] == pytest.approx(10000, rel=0.01)
+
+
+def test_large_files_are_read_whole(proc):
+    root, c = proc
+    cores = [(i, i, 100, 0) for i in range(300)]
+    write(root, 'proc/stat', stat(cores))
+    assert len(c.collect()['load']) == 300
+
+
+def test_missing_proc_stat_raises(tmp_path):
+    with pytest.raises(OSError):
+        ProcCollector(str(tmp_path))
@@ -0,0 +1,120 @@
+import functools
+import os
+import subprocess
+import sys
+import time
+
+import psutil
+import pytest
+
+from conftest import wait_for
+
+from berrymon import ProcessCollector
+
+
+@pytest.fixture
+def busy():
+    p = subprocess.Popen([sys.executable, '-c', 'while True: pass'])
+    yield p.pid
+    p.kill()
+    p.wait()
+
+
+def ticks(pc, n):
+    # runs n samples to completion; collect() itself returns without waiting
+    for _ in range(n):
+        before = pc.top
+        pc.collect()
+        assert wait_for(lambda: pc.top is not before)
+    return pc.top
+
+
+def test_busy_process_tops_the_cpu_list(busy):
+    pc = ProcessCollector(3, 5)
+    ticks(pc, 2)
+    time.sleep(0.3)
+    top = ticks(pc, 1)
+    assert top['cpu'][0][0] == busy
+    assert top['cpu'][0][2] > 50
+    assert len(top['rss']) == 3
+    assert top['rss'][0][2] >= top['rss'][1][2] >= top['rss'][2][2]
+
+
+def count_calls(monkeypatch):
+    calls = {'name': 0, 'memory_info': 0, 'cpu_percent': 0, 'stat': 0}
+    for attr in ('name', 'memory_info', 'cpu_percent'):
+        orig = getattr(psutil.Process, attr)
+
+        # wraps() keeps the hooks oneshot() expects on these methods
+        @functools.wraps(orig)
+        def counted(self, *a, attr=attr, orig=orig):
+            calls[attr] = calls[attr] + 1
+            return orig(self, *a)
+        monkeypatch.setattr(psutil.Process, attr, counted)
+    stat = ProcessCollector._stat
+
+    def counted_stat(fd):
+        calls['stat'] = calls['stat'] + 1
+        return stat(fd)
+    monkeypatch.setattr(ProcessCollector, '_stat', staticmethod(counted_stat))
+    return calls
+
+
+def test_only_stat_files_are_read_between_refreshes(monkeypatch):
+    calls = count_calls(monkeypatch)
+    pc = ProcessCollector(3, 4)
+    ticks(pc, 1)
+    procs = len(pc.procs)
+    first = dict(calls)
+    assert first['name'] >= procs
+
+    ticks(pc, 3)
+    # one stat read per process per tick gives both CPU and RSS; psutil
+    # isn't called at all while the stat files are open
+    assert calls['stat'] >= first['stat'] + 3 * procs - 3
+    assert calls['name'] == first['name']
+    assert calls['memory_info'] == first['memory_info']
+    assert calls['cpu_percent'] == 0
+
+    ticks(pc, 1)
+    # names only for processes that weren't there before
+    assert calls['name'] - first['name'] < procs
+
+
+def test_falls_back_to_psutil_without_a_stat_file(busy, monkeypatch):
+    calls = count_calls(monkeypatch)
+    monkeypatch.setattr(ProcessCollector, '_open_stat', staticmethod(lambda pid: None))
+    pc = ProcessCollector(3, 3)
+    ticks(pc, 2)
+    time.sleep(0.3)
+    top = ticks(pc, 1)
+    assert pc.procs[busy][3] is None
+    assert top['cpu'][0][0] == busy
+    assert top['cpu'][0][2] > 50
+    assert calls['stat'] == 0
+    # memory is re-read for every process, but only on refresh
+    before = calls['memory_info']
+    ticks(pc, 1)
+    assert calls['memory_info'] >= before + len(pc.procs)
+
+
+def test_exited_processes_are_dropped(busy):
+    pc = ProcessCollector(5, 1)
+    ticks(pc, 1)
+    assert busy in pc.procs
+    fd = pc.procs[busy][3]
+    os.kill(busy, 9)
+    os.waitpid(busy, 0)
+    ticks(pc, 1)
+    assert busy not in pc.procs
+    # and its stat file is closed (the number may have been reused since)
+    try:
+        assert os.readlink('/proc/self/fd/{0}'.format(fd)) != '/proc/{0}/stat'.format(busy)
+    except FileNotFoundError:
+        pass
+
+
+def test_collect_returns_without_waiting():
+    pc = ProcessCollector(3, 1)
+    # the first tick has nothing finished yet
+    assert pc.collect() == {'cpu': [], 'rss': []}
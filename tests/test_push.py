@@ -0,0 +1,112 @@
+import socket
+import struct
+import time
+
+import pytest
+
+from conftest import free_port, wait_for
+
+import berrymon
+from berrymon import Pusher, pack_push, push_capacity, unpack_push
+from berryspy import FleetCollector, PushReceiver
+
+
+def sample(i, cores=4):
+    return {'uptime': 100.0 + i, 'temp': 40.5 + i, 'freq': 600000000 + i, 'throttled': 0x50005 if i % 2 else 0,
+            'mem': 12.5, 'load': [float(i + c) for c in range(cores)]}
+
+
+def test_pack_unpack_round_trip():
+    frame = pack_push('pi-7', [(1000.0 + i, sample(i)) for i in range(3)])
+    name, records = unpack_push(frame)
+    assert name == 'pi-7'
+    assert len(records) == 3
+    assert records[1] == (1001.0, 101.0, 41.5, 600000001, 0x50005, 12.5, [1.0, 2.0, 3.0, 4.0])
+
+
+@pytest.mark.parametrize('frame', [
+    b'',
+    b'BMP1',
+    b'XXXX' + pack_push('pi', [(1.0, sample(0))])[4:],
+    pack_push('pi', [(1.0, sample(0))])[:-1],
+    # name longer than the frame
+    berrymon.PUSH_HEADER.pack(berrymon.PUSH_MAGIC, 1, berrymon.record_struct(1).size, 200) + b'pi',
+])
+def test_unpack_rejects_malformed_frames(frame):
+    with pytest.raises((ValueError, struct.error)):
+        unpack_push(frame)
+
+
+@pytest.fixture
+def receiver():
+    fleet = FleetCollector(1.0, 5.0, 2, 0.5, 60.0, 30.0)
+    addr = '127.0.0.1:{0}'.format(free_port())
+    rx = PushReceiver(fleet, addr)
+    yield fleet, rx, addr
+    rx.loop.call_soon_threadsafe(rx.loop.stop)
+
+
+@pytest.mark.parametrize('proto', ['udp', 'tcp'])
+def test_pusher_to_receiver_over_loopback(receiver, proto):
+    fleet, rx, addr = receiver
+    pusher = Pusher(addr, proto, 3, 'board-' + proto)
+    now = time.time()
+    for i in range(7):
+        pusher.add(now + i, sample(i))
+    pusher.flush()
+
+    host = 'board-' + proto
+    assert wait_for(lambda: rx.frames == 3)
+    assert fleet.fed_hosts() == [host]
+    report = fleet.collect([host])[host]
+    assert report['stale'] is False
+    assert report['data']['temp'] == 46.5
+    assert report['data']['state'] == berrymon.throttle_state(0)
+    assert report['data']['load'] == [6.0, 7.0, 8.0, 9.0]
+    assert pusher.failures == 0
+
+
+def test_receiver_counts_bad_frames(receiver):
+    fleet, rx, addr = receiver
+    host, port = addr.split(':')
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.sendto(b'garbage', (host, int(port)))
+        s.sendto(pack_push('ok', [(time.time(), sample(0))]), (host, int(port)))
+    assert wait_for(lambda: rx.frames == 1 and rx.bad == 1)
+    assert fleet.fed_hosts() == ['ok']
+
+
+def test_tcp_stream_reassembles_split_writes(receiver):
+    fleet, rx, addr = receiver
+    frames = b''.join(berrymon.PUSH_LENGTH.pack(len(f)) + f
+                      for f in (pack_push('split', [(time.time() + i, sample(i))]) for i in range(2)))
+    host, port = addr.split(':')
+    with socket.create_connection((host, int(port))) as s:
+        for i in range(0, len(frames), 7):
+            s.sendall(frames[i:i + 7])
+            time.sleep(0.005)
+        assert wait_for(lambda: rx.frames == 2)
+    assert fleet.collect(['split'])['split']['data']['uptime'] == 101.0
+
+
+def test_push_capacity_keeps_frames_under_push_max():
+    for name, cores in (('pi', 4), ('a' * 300, 1), ('raspberrypi-kitchen', 64)):
+        per = push_capacity(name, cores)
+        samples = [(1000.0 + i, sample(i, cores)) for i in range(per + 1)]
+        assert len(pack_push(name, samples[:per])) <= berrymon.PUSH_MAX
+        assert len(pack_push(name, samples)) > berrymon.PUSH_MAX
+
+
+@pytest.mark.parametrize('proto', ['udp', 'tcp'])
+def test_large_batch_is_split_across_frames(receiver, proto):
+    fleet, rx, addr = receiver
+    per = push_capacity('big', 4)
+    pusher = Pusher(addr, proto, 2 * per + 10, 'big')
+    now = time.time()
+    for i in range(2 * per + 10):
+        pusher.add(now + i, sample(i))
+
+    assert pusher.sent == 3
+    assert wait_for(lambda: rx.frames == 3)
+    assert rx.bad == 0
+    assert fleet.collect(['big'])['big']['data']['uptime'] == 100.0 + 2 * per + 9
@@ -0,0 +1,67 @@
+import os
+import time
+
+from berrymon import RECORD_HEADER, Recorder, read_records, record_struct
+
+
+def sample(i, cores=4):
+    return {'uptime': 10.0 + i, 'temp': 50.0, 'freq': 1500000000, 'throttled': 0, 'mem': 20.0,
+            'load': [float(i)] * cores}
+
+
+def record(path, times, cores=4):
+    r = Recorder(str(path), 0, 30)
+    for i, t in enumerate(times):
+        r.add(t, sample(i, cores))
+    r.close()
+
+
+def day_files(path):
+    return sorted(n for n in os.listdir(str(path)) if n.endswith('.bmr'))
+
+
+def test_records_read_back(tmp_path):
+    now = time.time()
+    record(tmp_path, [now + i for i in range(5)])
+    got = list(read_records(str(tmp_path)))
+    assert [r[0] for r in got] == [now + i for i in range(5)]
+    assert got[3][1] == 13.0
+    assert got[3][6] == [3.0] * 4
+    assert [r[0] for r in read_records(str(tmp_path), now + 1, now + 3)] == [now + 1, now + 2, now + 3]
+
+
+def test_partial_record_is_dropped_on_reopen(tmp_path):
+    now = time.time()
+    record(tmp_path, [now, now + 1])
+    name = tmp_path / day_files(tmp_path)[0]
+    # power lost halfway through the third record
+    with open(str(name), 'ab') as f:
+        f.write(b'\x01' * (record_struct(4).size // 2))
+
+    record(tmp_path, [now + 2, now + 3])
+    assert os.path.getsize(str(name)) == RECORD_HEADER.size + 4 * record_struct(4).size
+    got = list(read_records(str(tmp_path)))
+    assert [r[0] for r in got] == [now, now + 1, now + 2, now + 3]
+    assert got[2][1] == 10.0
+
+
+def test_cut_short_header_is_rewritten(tmp_path):
+    now = time.time()
+    record(tmp_path, [now])
+    name = tmp_path / day_files(tmp_path)[0]
+    with open(str(name), 'r+b') as f:
+        f.truncate(3)
+    record(tmp_path, [now + 1])
+    assert day_files(tmp_path) == [name.name]
+    assert [r[0] for r in read_records(str(tmp_path))] == [now + 1]
+
+
+def test_other_layout_on_the_same_day_gets_its_own_file(tmp_path):
+    now = time.time()
+    record(tmp_path, [now], cores=4)
+    record(tmp_path, [now + 1], cores=2)
+    names = day_files(tmp_path)
+    assert len(names) == 2
+    assert names[0].endswith('.1.bmr')
+    got = list(read_records(str(tmp_path)))
+    assert sorted(len(r[6]) for r in got) == [2, 4]
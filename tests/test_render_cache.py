@@ -0,0 +1,98 @@
+import gzip
+import http.client
+import json
+
+from conftest import publish
+
+import berrymon
+from berrymon import RenderCache
+
+
+def sample(temp=45.0):
+    return {'temp': temp, 'freq': 600000000, 'throttled': 0, 'state': '------', 'note': 'x' * 500}
+
+
+def test_renders_once_per_snapshot():
+    cache = RenderCache()
+    calls = []
+
+    def render(data):
+        calls.append(data)
+        return json.dumps(data)
+    s1 = berrymon.Snapshot(1, None, sample(), {})
+    assert cache.get(s1, 'json', render) == cache.get(s1, 'json', render)
+    assert len(calls) == 1
+    # a new snapshot drops the old bodies
+    s2 = berrymon.Snapshot(2, None, sample(50.0), {})
+    body, gz = cache.get(s2, 'json', render)
+    assert len(calls) == 2
+    assert json.loads(body.decode())['temp'] == 50.0 and not gz
+
+
+def test_gzips_once_and_only_large_bodies():
+    cache = RenderCache()
+    s = berrymon.Snapshot(1, None, sample(), {})
+    body, gz = cache.get(s, 'json', json.dumps, gz=True)
+    assert gz
+    assert json.loads(gzip.decompress(body).decode()) == sample()
+    assert cache.get(s, 'json', json.dumps, gz=True)[0] is body
+    small, gz = cache.get(s, 'small', lambda d: 'tiny', gz=True)
+    assert (small, gz) == (b'tiny', False)
+
+
+def test_etags_change_per_snapshot_and_encoding():
+    cache = RenderCache()
+    s1 = berrymon.Snapshot(1, None, {}, {})
+    s2 = berrymon.Snapshot(2, None, {}, {})
+    tags = {cache.etag(s1, 'json', False), cache.etag(s1, 'json', True), cache.etag(s2, 'json', False),
+            cache.etag(s1, 'html', False)}
+    assert len(tags) == 4
+    # seqs restart with the process, tags don't
+    restarted = RenderCache()
+    restarted.epoch = '{0:x}'.format(int(cache.epoch, 16) + 1)
+    assert restarted.etag(s1, 'json', False) != cache.etag(s1, 'json', False)
+
+
+def get(conn, path, headers=None):
+    conn.request('GET', path, headers=headers or {})
+    resp = conn.getresponse()
+    return resp, resp.read()
+
+
+def test_route_serves_304_until_the_next_sample(berrymon_server):
+    conn = http.client.HTTPConnection(berrymon_server(), timeout=5)
+    publish(sample())
+    resp, body = get(conn, '/?format=json')
+    assert resp.status == 200
+    assert resp.getheader('Content-Type') == 'application/json'
+    assert json.loads(body.decode())['temp'] == 45.0
+    etag = resp.getheader('ETag')
+
+    resp, body = get(conn, '/?format=json', {'If-None-Match': etag})
+    assert (resp.status, body) == (304, b'')
+    assert resp.getheader('ETag') == etag
+    # the html rendering has its own tag
+    resp, _ = get(conn, '/', {'If-None-Match': etag})
+    assert resp.status == 200 and resp.getheader('ETag') != etag
+
+    publish(sample(50.0))
+    resp, body = get(conn, '/?format=json', {'If-None-Match': etag})
+    assert resp.status == 200
+    assert json.loads(body.decode())['temp'] == 50.0
+    conn.close()
+
+
+def test_route_gzips_for_clients_that_accept_it(berrymon_server):
+    conn = http.client.HTTPConnection(berrymon_server(), timeout=5)
+    publish(sample())
+    resp, body = get(conn, '/?format=json', {'Accept-Encoding': 'gzip, deflate'})
+    assert resp.getheader('Content-Encoding') == 'gzip'
+    assert resp.getheader('Vary') == 'Accept-Encoding'
+    assert json.loads(gzip.decompress(body).decode()) == sample()
+    gz_etag = resp.getheader('ETag')
+
+    resp, body = get(conn, '/?format=json')
+    assert resp.getheader('Content-Encoding') is None
+    assert json.loads(body.decode()) == sample()
+    assert resp.getheader('ETag') != gz_etag
+    conn.close()
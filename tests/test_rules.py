@@ -0,0 +1,125 @@
+import pytest
+
+from berrymon import Rule, Rules
+
+
+@pytest.mark.parametrize('text', [
+    'temp > 75',
+    'hot: temp >= 75.5 for 30s -> log,led',
+    "state contains 'U'",
+    "state not contains \"u\" -> webhook",
+    "state == '------'",
+    'load > 90 avg 5m',
+    'mem < 1e1 min 10',
+    'freqs <= 600000000 max 1h',
+    'vc_measure_volts_core < 0.8',
+    "top_cpu contains 'ffmpeg'",
+    "~name != 'pi'",
+])
+def test_parser_accepts(text):
+    Rule(text)
+
+
+@pytest.mark.parametrize('text, error', [
+    ('temp >', 'bad rule'),
+    ('temp > 75 for', 'bad rule'),
+    ('temp > 75 for 5y', 'bad rule'),
+    ('temp > 75 -> pager', 'unknown alert sink'),
+    # metrics that don't exist, or can't be compared at all
+    ('tmp > 75', 'unknown metric tmp'),
+    ('env > 1 avg 1m', 'unknown metric env'),
+    ('_stats > 1', 'unknown metric _stats'),
+    # text metrics take strings, numeric ones numbers
+    ('state > 1', 'state is text'),
+    ('state == 1', 'state is text'),
+    ("temp == 'hot'", 'temp is a number'),
+    ("temp contains 'x'", 'temp is a number'),
+    ("state > 'U'", 'contains takes a quoted string'),
+    ("state contains 'U' avg 1m", 'avg/min/max need a numeric value'),
+    ('temp > 75 avg 0s', 'avg/min/max need a numeric value'),
+])
+def test_parser_rejects(text, error):
+    with pytest.raises(ValueError) as e:
+        Rule(text)
+    assert error in str(e.value)
+
+
+def run(rule, samples):
+    # samples: (t, value) for rule.metric; returns the changes as (t, firing)
+    changes = []
+    for t, v in samples:
+        firing, changed = rule.evaluate(t, {rule.metric: v})
+        if changed:
+            changes.append((t, firing))
+    return changes
+
+
+def test_plain_comparison_fires_and_resolves():
+    assert run(Rule('temp > 75'), [(0, 70), (1, 76), (2, 80), (3, 75), (4, 76)]) == [(1, True), (3, False), (4, True)]
+
+
+def test_for_needs_the_condition_held_for_the_whole_duration():
+    r = Rule('temp > 75 for 10s')
+    # true at 0..8, broken at 9: never fires; true from 10 onward fires at 20
+    samples = [(t, 80) for t in range(9)] + [(9, 70)] + [(t, 80) for t in range(10, 25)] + [(25, 70)]
+    assert run(r, samples) == [(20, True), (25, False)]
+
+
+def test_avg_waits_for_a_full_window_and_slides():
+    r = Rule('temp > 50 avg 10s')
+    # a high start can't fire a 10s average before the window has filled
+    assert run(r, [(0, 100), (5, 80)]) == []
+    # window (0, 10]: 80 and 60
+    assert r.evaluate(10, {'temp': 60}) == (True, True)
+    assert r.last == pytest.approx(70.0)
+    # window (1, 11]: 80, 60 and 0
+    assert r.evaluate(11, {'temp': 0}) == (False, True)
+    assert r.last == pytest.approx(140 / 3)
+
+
+def test_min_and_max_windows():
+    lo = Rule('temp < 40 min 3')
+    hi = Rule('temp > 90 max 3')
+    temps = [50, 30, 50, 50, 50, 95, 50, 50, 50]
+    assert run(lo, list(enumerate(temps))) == [(3, True), (4, False)]
+    assert run(hi, list(enumerate(temps))) == [(5, True), (8, False)]
+
+
+def test_lists_compare_by_greatest_and_text_lists_are_searched():
+    load = Rule('load > 90')
+    assert load.evaluate(0, {'load': [10.0, 95.0]}) == (True, True)
+    freqs = Rule('freqs < 700000000')
+    # a core that failed to read doesn't stop the others being compared
+    assert freqs.evaluate(0, {'freqs': [None, 600000000]}) == (True, True)
+    top = Rule("top_cpu contains 'ffmpeg'")
+    assert top.evaluate(0, {'top_cpu': [[12, 'ffmpeg', 97.0]]}) == (True, True)
+
+
+def test_missing_metric_keeps_the_current_state():
+    r = Rule('disk_read > 1000')
+    assert r.evaluate(0, {'disk_read': 5000}) == (True, True)
+    assert r.evaluate(1, {}) == (True, False)
+
+
+def test_rules_file_reports_the_failing_line(tmp_path):
+    path = tmp_path / 'rules'
+    path.write_text('# comment\n\ntemp > 75\nstate > 1\n')
+    with pytest.raises(ValueError) as e:
+        Rules(str(path))
+    assert str(e.value).startswith('{0}:4: state is text'.format(path))
+
+    path.write_text('hot: temp > 75\nhot: temp > 80\n')
+    with pytest.raises(ValueError) as e:
+        Rules(str(path))
+    assert 'duplicate rule name hot' in str(e.value)
+
+
+def test_rules_report_changes_and_firing_names(tmp_path, capsys):
+    path = tmp_path / 'rules'
+    path.write_text("hot: temp > 75 -> log,led\nundervolt: state contains 'U' -> log\n")
+    rules = Rules(str(path))
+    assert rules.evaluate(0, {'temp': 80.0, 'state': '-U----'}) == ['hot', 'undervolt']
+    assert rules.led(['hot']) and not rules.led(['undervolt'])
+    assert rules.evaluate(1, {'temp': 70.0, 'state': '------'}) == []
+    out = capsys.readouterr().out
+    assert 'Alert hot firing' in out and 'Alert undervolt resolved' in out
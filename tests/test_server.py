@@ -0,0 +1,67 @@
+import http.client
+import socket
+import threading
+
+import pytest
+from conftest import wait_for
+
+from berrymon import BoundedThreadingWSGIServer
+
+
+def app(env, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '2')])
+    return [b'ok']
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(workers, connections=None):
+        s = BoundedThreadingWSGIServer(('127.0.0.1', 0), app, workers, connections=connections)
+        servers.append(s)
+        threading.Thread(target=s.serve_forever, daemon=True).start()
+        return s
+    yield start
+    for s in servers:
+        s.shutdown()
+        s.server_close()
+
+
+def get(s):
+    c = http.client.HTTPConnection('127.0.0.1', s.server_address[1], timeout=3)
+    c.request('GET', '/')
+    r = c.getresponse()
+    return c, r.status, r.read()
+
+
+def test_keeps_connections_alive(server):
+    s = server(2)
+    c, status, body = get(s)
+    assert (status, body) == (200, b'ok')
+    c.request('GET', '/')
+    assert c.getresponse().read() == b'ok'
+    c.close()
+
+
+def test_connections_past_the_cap_are_refused(server):
+    s = server(1, connections=2)
+    idle = [socket.create_connection(s.server_address) for _ in range(2)]
+    assert wait_for(lambda: s.connections == 2)
+    c, status, _ = get(s)
+    assert status == 503
+    c.close()
+    # the refused connection never got a thread or a count
+    assert s.connections == 2
+    for sock in idle:
+        sock.close()
+    assert wait_for(lambda: s.connections == 0)
+    c, status, body = get(s)
+    assert (status, body) == (200, b'ok')
+    c.close()
+
+
+def test_default_cap_leaves_room_for_workers_and_streams():
+    s = BoundedThreadingWSGIServer(('127.0.0.1', 0), app, 4, streams=10)
+    assert s.max_connections == 18
+    s.server_close()
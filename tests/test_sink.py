@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+from conftest import publish, wait_for
+
+import berrymon
+from berrymon import Sink
+
+
+@pytest.fixture(autouse=True)
+def period(monkeypatch):
+    monkeypatch.setattr(berrymon, 'args', berrymon.parser.parse_args(['--period', '1']))
+    monkeypatch.setattr(berrymon, 'scheduler', None)
+    monkeypatch.setattr(berrymon, 'stats', None)
+    monkeypatch.setattr(berrymon, 'snapshot', berrymon.Snapshot(0, None, {'_now': 0}, {}))
+
+
+def snap(seq):
+    return berrymon.Snapshot(seq, None, {'n': seq}, {})
+
+
+def test_oneshot_hands_the_same_snapshot_to_every_sink(monkeypatch):
+    got = {'a': [], 'b': []}
+    sinks = [Sink(name, got[name].append, 4) for name in ('a', 'b')]
+    monkeypatch.setattr(berrymon, 'sinks', sinks)
+    monkeypatch.setattr(berrymon, 'update', lambda: publish({'temp': 45.0}))
+    berrymon.oneshot()
+    berrymon.oneshot()
+    assert wait_for(lambda: len(got['a']) == len(got['b']) == 2)
+    assert [s.seq for s in got['a']] == [1, 2]
+    assert all(a is b for a, b in zip(got['a'], got['b']))
+
+
+def test_slow_sink_drops_the_oldest_without_blocking():
+    gate = threading.Event()
+    got = []
+
+    def slow(s):
+        gate.wait()
+        got.append(s.seq)
+    sink = Sink('slow', slow, 3)
+    start = time.time()
+    sink.publish(snap(1))
+    assert wait_for(lambda: not sink.queue)
+    for seq in range(2, 11):
+        sink.publish(snap(seq))
+    assert time.time() - start < 1
+    # 1 is being handled; of 2..10 only the newest 3 still wait
+    assert sink.stats()['dropped'] == 6
+    gate.set()
+    assert wait_for(lambda: len(got) == 4)
+    assert got == [1, 8, 9, 10]
+
+
+def test_samples_handled_after_a_period_are_late(monkeypatch):
+    monkeypatch.setattr(berrymon.args, 'period', 0.05)
+    sink = Sink('slow', lambda s: time.sleep(0.1), 10)
+    for seq in range(3):
+        sink.publish(snap(seq))
+    sink.stop(2)
+    # the first was taken at once; the others waited behind it
+    assert sink.stats() == {'dropped': 0, 'late': 2}
+
+
+def test_failures_are_logged_and_the_sink_carries_on(capsys):
+    got = []
+
+    def flaky(s):
+        if s.seq == 1:
+            raise RuntimeError('boom')
+        got.append(s.seq)
+    sink = Sink('flaky', flaky, 4)
+    sink.publish(snap(1))
+    sink.publish(snap(2))
+    assert wait_for(lambda: got == [2])
+    assert 'Sink flaky failed' in capsys.readouterr().out
+
+
+def test_stop_finishes_what_is_queued():
+    got = []
+    sink = Sink('slowish', lambda s: (time.sleep(0.02), got.append(s.seq)), 10)
+    for seq in range(5):
+        sink.publish(snap(seq))
+    sink.stop(2)
+    assert got == [0, 1, 2, 3, 4]
+    assert not sink.thread.is_alive()
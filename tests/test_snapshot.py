@@ -0,0 +1,35 @@
+import argparse
+
+import berrymon
+from berrymon import Snapshot, changed
+
+
+def data(temp, stats_n):
+    return {'temp': temp, 'freq': 1500000000, '_now': 'now', '~name': 'pi',
+            '_stats': {'stages': {'update': {'n': stats_n}}}, '_sinks': {'log': {'late': stats_n}}}
+
+
+def test_delta_leaves_out_self_stats():
+    prev = data(50.0, 1)
+    assert changed(prev, data(50.0, 2)) == {}
+    assert changed(prev, data(51.0, 2)) == {'temp': 51.0}
+    # a first snapshot has everything but the self stats
+    assert set(changed({}, data(50.0, 1))) == {'temp', 'freq', '_now', '~name'}
+
+
+class Recording:
+    def __init__(self):
+        self.posts = []
+
+    def post(self, item):
+        self.posts.append(item)
+
+
+def test_webhook_posts_leave_out_platform_and_self_stats(monkeypatch):
+    hook = Recording()
+    monkeypatch.setattr(berrymon, 'args', argparse.Namespace(webhook_period=2), raising=False)
+    monkeypatch.setattr(berrymon, 'webhook_delivery', hook)
+    for seq in range(1, 5):
+        berrymon.webhook_sample(Snapshot(seq, None, data(50.0 + seq, seq), {}))
+    assert hook.posts == [{'temp': 52.0, 'freq': 1500000000, '_now': 'now'},
+                          {'temp': 54.0, 'freq': 1500000000, '_now': 'now'}]
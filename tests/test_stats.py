@@ -0,0 +1,86 @@
+import http.client
+import json
+import os
+
+import pytest
+from conftest import publish
+
+import berrymon
+from berrymon import Sink, Stats
+
+
+def test_observe_fills_buckets_by_upper_bound():
+    s = Stats()
+    # bounds are inclusive; past the last bound is its own bucket
+    for seconds in (0.000005, 0.00001, 0.00002, 0.5, 11.0):
+        s.observe('x', seconds)
+    r = s.report()
+    counts = r['stages']['x']['counts']
+    assert len(counts) == len(r['buckets']) + 1
+    assert counts[0] == 2
+    assert counts[r['buckets'].index(0.00003)] == 1
+    assert counts[r['buckets'].index(1)] == 1
+    assert counts[-1] == 1
+    assert r['stages']['x']['n'] == 5
+    assert r['stages']['x']['max'] == 11.0
+    assert r['stages']['x']['sum'] == pytest.approx(11.500035)
+
+
+def test_summary_has_means_and_counters():
+    s = Stats()
+    s.observe('update', 0.002)
+    s.observe('update', 0.004)
+    s.overruns, s.skipped = 1, 3
+    summary = s.summary()
+    assert summary['stages'] == {'update': {'n': 2, 'mean': pytest.approx(0.003), 'max': 0.004}}
+    assert (summary['overruns'], summary['skipped']) == (1, 3)
+    assert 'counts' not in str(summary)
+
+
+def test_sample_self_reads_rss_and_cpu():
+    s = Stats()
+    # burn a little CPU so there is something to see
+    sum(i * i for i in range(200000))
+    s.sample_self()
+    if os.path.exists('/proc/self/statm'):
+        assert s.rss > 1000000
+    assert s.cpu is not None and s.cpu >= 0
+
+
+def test_timed_records_even_when_the_call_fails(monkeypatch):
+    s = Stats()
+    monkeypatch.setattr(berrymon, 'stats', s)
+    assert berrymon.timed('ok', lambda a, b=0: a + b, 1, b=2) == 3
+
+    def fail():
+        raise RuntimeError('boom')
+    with pytest.raises(RuntimeError):
+        berrymon.timed('fail', fail)
+    assert set(s.report()['stages']) == {'ok', 'fail'}
+
+
+def test_timed_without_stats_just_calls(monkeypatch):
+    monkeypatch.setattr(berrymon, 'stats', None)
+    assert berrymon.timed('ok', lambda: 5) == 5
+
+
+def test_route_reports_stages_and_sinks(berrymon_server, monkeypatch):
+    s = Stats()
+    s.observe('update', 0.001)
+    monkeypatch.setattr(berrymon, 'stats', s)
+    sink = Sink('log', lambda snap: None, 4)
+    sink.dropped = 2
+    monkeypatch.setattr(berrymon, 'sinks', [sink])
+    server = berrymon_server()
+    publish({'temp': 45.0})
+    conn = http.client.HTTPConnection(server, timeout=5)
+    conn.request('GET', '/?format=json')
+    conn.getresponse().read()
+    conn.request('GET', '/debug/stats')
+    ret = json.loads(conn.getresponse().read().decode())
+    assert ret['buckets'] == list(Stats.BUCKETS)
+    assert ret['stages']['update']['n'] == 1
+    # handlers are timed as http.<name>
+    assert ret['stages']['http.main']['n'] == 1
+    assert ret['sinks'] == {'log': {'dropped': 2, 'late': 0}}
+    conn.close()
@@ -0,0 +1,133 @@
+import http.client
+import json
+import threading
+
+import pytest
+from conftest import publish
+
+import berrymon
+
+
+def sample(temp=45.0, state='------'):
+    return {'temp': temp, 'freq': 600000000, 'throttled': 0, 'state': state}
+
+
+@pytest.fixture
+def short_polls(monkeypatch):
+    # a poll or stream with nothing new gives up after 0.2s, not 30s/15s
+    wait = berrymon.wait_snapshot
+    monkeypatch.setattr(berrymon, 'wait_snapshot', lambda after, timeout: wait(after, min(timeout, 0.2)))
+
+
+def get(server, path, headers=None):
+    conn = http.client.HTTPConnection(server, timeout=5)
+    conn.request('GET', path, headers=headers or {})
+    resp = conn.getresponse()
+    return resp, resp.read()
+
+
+def events(resp):
+    # yields (id, data) per event, skipping keepalive comments
+    fields = {}
+    while True:
+        line = resp.readline().decode()
+        if not line:
+            return
+        line = line.rstrip('\n')
+        if line.startswith(':'):
+            continue
+        if line:
+            k, _, v = line.partition(': ')
+            fields[k] = v
+        elif fields:
+            yield int(fields['id']), json.loads(fields['data'])
+            fields = {}
+
+
+@pytest.mark.parametrize('path, headers', [
+    ('/poll?after=abc', {}),
+    ('/poll?after=1.5', {}),
+    ('/stream?after=abc', {}),
+    ('/stream', {'Last-Event-ID': 'abc'}),
+])
+def test_bad_positions_are_rejected(berrymon_server, path, headers):
+    resp, _ = get(berrymon_server(), path, headers)
+    assert resp.status == 400
+
+
+def test_poll_returns_everything_then_waits_for_a_delta(berrymon_server, short_polls):
+    server = berrymon_server()
+    publish(sample())
+    resp, body = get(server, '/poll')
+    first = json.loads(body.decode())
+    assert first['delta'] is False
+    assert first['data'] == sample()
+
+    results = []
+    t = threading.Thread(target=lambda: results.append(get(server, '/poll?after={0}'.format(first['seq']))))
+    t.start()
+    publish(sample(50.0))
+    t.join()
+    resp, body = results[0]
+    ret = json.loads(body.decode())
+    assert ret['seq'] == first['seq'] + 1
+    assert ret['delta'] is True
+    assert ret['data'] == {'temp': 50.0}
+
+
+def test_poll_with_nothing_new_is_204(berrymon_server, short_polls):
+    server = berrymon_server()
+    s = publish(sample())
+    resp, body = get(server, '/poll?after={0}'.format(s.seq))
+    assert (resp.status, body) == (204, b'')
+
+
+def test_poll_that_missed_a_sample_gets_everything(berrymon_server):
+    server = berrymon_server()
+    s = publish(sample())
+    publish(sample(50.0))
+    publish(sample(55.0))
+    ret = json.loads(get(server, '/poll?after={0}'.format(s.seq))[1].decode())
+    assert ret['delta'] is False
+    assert ret['data'] == sample(55.0)
+
+
+def test_stream_sends_a_full_event_then_deltas(berrymon_server):
+    server = berrymon_server()
+    first = publish(sample())
+    conn = http.client.HTTPConnection(server, timeout=5)
+    conn.request('GET', '/stream')
+    resp = conn.getresponse()
+    assert resp.getheader('Content-Type') == 'text/event-stream'
+    it = events(resp)
+    assert next(it) == (first.seq, sample())
+    publish(sample(50.0))
+    assert next(it) == (first.seq + 1, {'temp': 50.0})
+    publish(sample(50.0, '-U----'))
+    assert next(it) == (first.seq + 2, {'state': '-U----'})
+    conn.close()
+
+
+def test_stream_resumes_from_last_event_id(berrymon_server):
+    server = berrymon_server()
+    s = publish(sample())
+    publish(sample(50.0))
+    conn = http.client.HTTPConnection(server, timeout=5)
+    # resuming right after the previous event needs only the delta
+    conn.request('GET', '/stream', headers={'Last-Event-ID': str(s.seq)})
+    assert next(events(conn.getresponse())) == (s.seq + 1, {'temp': 50.0})
+    conn.close()
+
+
+def test_streams_past_the_cap_are_refused(berrymon_server):
+    server = berrymon_server('--server_streams', '1')
+    publish(sample())
+    conn = http.client.HTTPConnection(server, timeout=5)
+    conn.request('GET', '/stream')
+    next(events(conn.getresponse()))
+    resp, _ = get(server, '/poll')
+    assert resp.status == 503
+    # other requests still have their own slots
+    resp, _ = get(server, '/?format=json')
+    assert resp.status == 200
+    conn.close()
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import berrymon
+from berrymon import SysfsSampler
+
+
+def write(root, path, text):
+    p = root.joinpath(*path.split('/'))
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_text(text)
+    return p
+
+
+def pi_tree(root, cores=4):
+    write(root, 'sys/class/thermal/thermal_zone0/temp', '48312\n')
+    # numeric order, not glob order: cpu10 comes after cpu2
+    for i in range(cores):
+        write(root, 'sys/devices/system/cpu/cpu{0}/cpufreq/scaling_cur_freq'.format(i), '{0}\n'.format(600000 + i * 100000))
+    return root
+
+
+def test_reads_temperature_and_frequencies(tmp_path):
+    s = SysfsSampler(str(pi_tree(tmp_path, cores=12)))
+    assert s.temperature() == 48.312
+    assert s.arm_freq() == 600000000
+    freqs = s.core_freqs()
+    assert len(freqs) == 12
+    assert freqs[2] == 800000000
+    assert freqs[10] == 1600000000
+    s.close()
+
+
+def test_rereads_open_files_each_call(tmp_path):
+    pi_tree(tmp_path)
+    s = SysfsSampler(str(tmp_path))
+    assert s.temperature() == 48.312
+    write(tmp_path, 'sys/class/thermal/thermal_zone0/temp', '71000\n')
+    write(tmp_path, 'sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq', '1400000\n')
+    assert s.temperature() == 71.0
+    assert s.arm_freq() == 1400000000
+    s.close()
+
+
+def test_missing_sources_read_as_none(tmp_path):
+    s = SysfsSampler(str(tmp_path))
+    assert s.temperature() is None
+    assert s.arm_freq() is None
+    assert s.core_freqs() == []
+    assert s.throttled() is None
+    s.close()
+
+
+def test_unreadable_values_read_as_none(tmp_path):
+    pi_tree(tmp_path, cores=2)
+    write(tmp_path, 'sys/class/thermal/thermal_zone0/temp', 'garbage\n')
+    write(tmp_path, 'sys/devices/system/cpu/cpu1/cpufreq/scaling_cur_freq', '\n')
+    s = SysfsSampler(str(tmp_path))
+    assert s.temperature() is None
+    assert s.core_freqs() == [600000000, None]
+    s.close()
+
+
+def test_vcio_that_rejects_the_ioctl_reads_as_none(tmp_path):
+    # a plain file opens fine but the mailbox ioctl fails (ENOTTY)
+    write(tmp_path, 'dev/vcio', '')
+    s = SysfsSampler(str(tmp_path))
+    assert s.vcio_fd is not None
+    assert s.throttled() is None
+    assert s.mbox_property(0x00030047, 3) is None
+    s.close()
+
+
+def test_concurrent_mailbox_calls_get_their_own_replies(tmp_path, monkeypatch):
+    write(tmp_path, 'dev/vcio', '')
+    s = SysfsSampler(str(tmp_path))
+
+    def firmware(fd, request, m, mutate):
+        tag, value = m[2], m[5]
+        # let another thread in between reading the request and answering
+        time.sleep(0)
+        m[1] = berrymon.MBOX_RESPONSE_OK
+        m[4] = berrymon.MBOX_RESPONSE_OK | 8
+        if tag == berrymon.MBOX_TAG_GET_THROTTLED:
+            m[5] = 0x50005
+        else:
+            m[5], m[6] = value, 1000000 * value
+        # and between answering and the caller reading the reply
+        time.sleep(0)
+        return 0
+    monkeypatch.setattr(berrymon.fcntl, 'ioctl', firmware)
+
+    stop = threading.Event()
+    wrong = []
+
+    def burst():
+        while not stop.is_set():
+            if s.measured_clock(3) != 3000000:
+                wrong.append('clock')
+    t = threading.Thread(target=burst)
+    t.start()
+    try:
+        for _ in range(5000):
+            if s.throttled() != 0x50005:
+                wrong.append('throttled')
+    finally:
+        stop.set()
+        t.join()
+    assert wrong == []
+    s.close()
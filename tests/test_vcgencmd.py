@@ -0,0 +1,119 @@
+import time
+
+import pytest
+
+import berrymon
+from berrymon import VcgencmdBatch, vc_counter_value
+
+STUB = '''#!/bin/sh
+echo "$*" >> {log}
+case "$*" in
+  "measure_clock core") echo "frequency(1)=400000000" ;;
+  "measure_volts core") echo "volt=1.2000V" ;;
+  "get_mem gpu") echo "gpu=76M" ;;
+  "get_config arm_freq") echo "arm_freq=1500" ;;
+  "hang") sleep 30 ;;
+  *) echo "error=1 error_msg=\\"Command not registered\\"" ;;
+esac
+'''
+
+
+@pytest.fixture
+def vcgencmd(tmp_path):
+    log = tmp_path / 'calls'
+    path = tmp_path / 'vcgencmd'
+    path.write_text(STUB.format(log=log))
+    path.chmod(0o755)
+
+    def calls():
+        return log.read_text().splitlines() if log.exists() else []
+    return str(path), calls
+
+
+class FakeMailbox:
+    """Stands in for SysfsSampler's mailbox with fixed firmware replies."""
+
+    def __init__(self, fail=()):
+        self.vcio_fd = -1
+        self.fail = set(fail)
+        self.reads = 0
+
+    def mbox_property(self, tag, value=0, word=0):
+        self.reads = self.reads + 1
+        if tag in self.fail:
+            return None
+        replies = {
+            berrymon.MBOX_TAG_GET_CLOCK_RATE_MEASURED: [value, 1000000 * value],
+            berrymon.MBOX_TAG_GET_VOLTAGE: [value, 835000],
+            berrymon.MBOX_TAG_GET_ARM_MEMORY: [0, 948 * 1024 * 1024],
+            berrymon.MBOX_TAG_GET_VC_MEMORY: [0x3b400000, 76 * 1024 * 1024],
+        }
+        return replies[tag][word]
+
+    def measured_clock(self, clock):
+        return self.mbox_property(berrymon.MBOX_TAG_GET_CLOCK_RATE_MEASURED, clock, 1)
+
+    def voltage(self, id):
+        return self.mbox_property(berrymon.MBOX_TAG_GET_VOLTAGE, id, 1)
+
+
+def values(batch):
+    got = batch.collect()
+    return dict((' '.join(q), vc_counter_value(q, got)) for q in batch.queries)
+
+
+def test_shell_batch_parses_each_reply(vcgencmd):
+    path, calls = vcgencmd
+    batch = VcgencmdBatch(path, ['measure_clock core', 'measure_volts core', 'get_mem gpu', 'bogus'])
+    for _ in range(3):
+        assert values(batch) == {'measure_clock core': 400000000, 'measure_volts core': 1.2,
+                                 'get_mem gpu': 76, 'bogus': None}
+    assert len(calls()) == 12
+    # one helper shell for all ticks
+    assert batch.proc.poll() is None
+    batch.close()
+
+
+def test_mailbox_answers_clocks_volts_and_memory_without_the_shell(vcgencmd):
+    path, calls = vcgencmd
+    mbox = FakeMailbox()
+    batch = VcgencmdBatch(path, ['measure_clock arm', 'measure_clock h264', 'measure_volts', 'measure_volts sdram_i',
+                                 'get_mem arm', 'get_mem gpu'], mbox)
+    assert values(batch) == {'measure_clock arm': 3000000, 'measure_clock h264': 6000000, 'measure_volts': 0.835,
+                             'measure_volts sdram_i': 0.835, 'get_mem arm': 948, 'get_mem gpu': 76}
+    assert mbox.reads == 6
+    assert calls() == []
+    assert batch.proc is None
+
+
+def test_shell_answers_what_the_mailbox_cannot(vcgencmd):
+    path, calls = vcgencmd
+    mbox = FakeMailbox(fail=[berrymon.MBOX_TAG_GET_VOLTAGE])
+    batch = VcgencmdBatch(path, ['measure_clock core', 'measure_volts core', 'get_config arm_freq'], mbox)
+    assert values(batch) == {'measure_clock core': 4000000, 'measure_volts core': 1.2, 'get_config arm_freq': 1500}
+    assert calls() == ['measure_volts core', 'get_config arm_freq']
+    batch.close()
+
+
+def test_hung_helper_is_killed_at_the_deadline(vcgencmd):
+    path, calls = vcgencmd
+    batch = VcgencmdBatch(path, ['get_config arm_freq', 'hang'], timeout=0.5)
+    start = time.monotonic()
+    assert batch.collect() == {}
+    assert time.monotonic() - start < 2
+    assert batch.proc is None
+    # a fresh helper next tick
+    batch.queries = [['get_config arm_freq']]
+    batch.readers = [None]
+    assert values(batch) == {'get_config arm_freq': 1500}
+    batch.close()
+
+
+def test_helper_that_exits_is_restarted(vcgencmd):
+    path, _ = vcgencmd
+    batch = VcgencmdBatch(path, ['get_config arm_freq'])
+    assert values(batch) == {'get_config arm_freq': 1500}
+    batch.proc.kill()
+    batch.proc.wait()
+    assert values(batch) == {'get_config arm_freq': 1500}
+    batch.close()
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+import urllib.parse
+
+from conftest import reply, wait_for
+
+from berrymon import WebhookDelivery
+
+
+def receiver(http_stub, statuses=(), delay=0):
+    """An endpoint recording each POST body; answers with `statuses` in turn, then 200."""
+    posts = []
+    statuses = list(statuses)
+    gate = threading.Event()
+    gate.set()
+
+    def handle(h):
+        body = h.rfile.read(int(h.headers['Content-Length']))
+        gate.wait()
+        time.sleep(delay)
+        status = statuses.pop(0) if statuses else 200
+        if status == 200:
+            posts.append((h.headers['Content-Type'], body))
+        reply(h, status, b'')
+    return 'http://{0}/hook?x=1'.format(http_stub(handle)), posts, gate
+
+
+def test_posts_batch_while_a_request_is_in_flight(http_stub):
+    url, posts, gate = receiver(http_stub)
+    d = WebhookDelivery(url)
+    gate.clear()
+    d.post({'n': 0})
+    time.sleep(0.2)
+    for i in range(1, 5):
+        d.post({'n': i})
+    gate.set()
+    assert wait_for(lambda: d.sent == 5)
+    assert [json.loads(b.decode())['samples'] for _, b in posts] == [[{'n': 0}], [{'n': i} for i in range(1, 5)]]
+    assert posts[0][0] == 'application/json'
+
+
+def test_failed_posts_are_retried_in_order(http_stub):
+    url, posts, _ = receiver(http_stub, statuses=[503])
+    d = WebhookDelivery(url, key='alerts')
+    d.post({'n': 0})
+    assert wait_for(lambda: d.failures == 1)
+    d.post({'n': 1})
+    # the first retry waits about a second
+    assert wait_for(lambda: d.sent == 2, timeout=3)
+    assert json.loads(posts[0][1].decode()) == {'alerts': [{'n': 0}, {'n': 1}]}
+    assert d.dropped == 0
+
+
+def test_client_errors_are_not_retried(http_stub):
+    url, posts, _ = receiver(http_stub, statuses=[400])
+    d = WebhookDelivery(url)
+    d.post({'n': 0})
+    assert wait_for(lambda: d.sent == 1)
+    assert d.failures == 0
+    assert posts == []
+
+
+def test_ifttt_gets_only_the_latest(http_stub):
+    url, posts, gate = receiver(http_stub)
+    d = WebhookDelivery(url, ifttt=True)
+    gate.clear()
+    d.post({'value1': 'a'})
+    time.sleep(0.2)
+    d.post({'value1': 'b'})
+    d.post({'value1': 'c', 'value2': '2'})
+    gate.set()
+    assert wait_for(lambda: d.sent == 3)
+    assert posts[0] == ('application/x-www-form-urlencoded', b'value1=a')
+    assert urllib.parse.parse_qs(posts[1][1].decode()) == {'value1': ['c'], 'value2': ['2']}
+
+
+def test_queue_drops_the_oldest_beyond_its_cap(http_stub):
+    url, posts, gate = receiver(http_stub)
+    d = WebhookDelivery(url, cap=3)
+    gate.clear()
+    d.post({'n': 0})
+    time.sleep(0.2)
+    for i in range(1, 7):
+        d.post({'n': i})
+    gate.set()
+    assert wait_for(lambda: len(posts) == 2)
+    assert json.loads(posts[1][1].decode())['samples'] == [{'n': 4}, {'n': 5}, {'n': 6}]
+    assert d.dropped == 3
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 by Advay Mengle - https://github.com/madvay/berrymon
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark for berryspy's FleetStore: ingest rate, and /fleet/query times
+# for a fleet of --hosts boards scraped every --interval seconds, over
+# --hours of raw history.
+#
+#   python3 tools/bench_fleetstore.py --hosts 500 --interval 5 --hours 1
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from berryspy import FleetStore
+
+parser = argparse.ArgumentParser(description='Benchmark berryspy FleetStore ingest and queries',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--hosts', help='boards in the fleet', type=int, default=500)
+parser.add_argument('--interval', help='seconds between samples per board', type=float, default=5)
+parser.add_argument('--hours', help='hours of raw history to query over', type=float, default=1)
+parser.add_argument('--repeat', help='runs of each query; the best is reported', type=int, default=5)
+
+
+def best(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    rnd = random.Random(1)
+    hosts = ['pi{0:03d}'.format(i) for i in range(args.hosts)]
+    ticks = int(args.hours * 3600 / args.interval)
+    now = time.time()
+    start = now - ticks * args.interval
+
+    with tempfile.TemporaryDirectory() as d:
+        store = FleetStore(d, args.hours + 1, 7)
+        t0 = time.perf_counter()
+        for i in range(ticks):
+            t = start + i * args.interval
+            for h in hosts:
+                store.add(h, t, {'temp': 40 + rnd.random() * 30, 'freq': 1500000000, 'mem': 20.0,
+                                 'uptime': 100.0, 'load': [rnd.random() * 100] * 4, 'throttled': 0})
+            if i % 12 == 0:
+                store.flush()
+        store.flush()
+        ingest = time.perf_counter() - t0
+        records = ticks * len(hosts)
+        print('{0} hosts every {1}s for {2}h: {3} samples per metric'.format(len(hosts), args.interval, args.hours, records))
+        print('ingest: {0:.1f}s, {1:.0f} samples/s (the fleet produces {2:.0f}/s)'.format(
+            ingest, records / ingest, len(hosts) / args.interval))
+
+        window = args.hours * 3600
+        for agg, by_host in (('max', False), ('mean', False), ('p95', False), ('max', True), ('p95', True)):
+            s = best(lambda: store.query('temp', agg, window, by_host, now=now), args.repeat)
+            print('query temp {0}{1} over {2}h: {3:.3f}s ({4:.0f} records/s)'.format(
+                agg, ' by host' if by_host else '', args.hours, s, records / s))
+        s = best(lambda: store.query('temp', 'max', 600, now=now), args.repeat)
+        print('query temp max over the last 10m: {0:.3f}s'.format(s))
+
+
+if __name__ == '__main__':
+    main()
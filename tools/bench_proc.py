@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 by Advay Mengle - https://github.com/madvay/berrymon
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark for berrymon's /proc collector against the psutil path it
+# replaces: wall time, CPU time and peak bytes allocated per tick.  psutil
+# runs twice: as update() used it (load, memory, uptime), and with its
+# disk and network counters too, which ProcCollector also reads.
+#
+#   python3 tools/bench_proc.py --ticks 2000
+
+import argparse
+import importlib.util
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from berrymon import ProcCollector, psutil_counters
+
+parser = argparse.ArgumentParser(description='Benchmark berrymon ProcCollector against psutil',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--ticks', help='collections to time each way', type=int, default=2000)
+parser.add_argument('--root', help='root to find proc/ and sys/ under', default='/')
+
+
+def psutil_all():
+    import psutil
+    ret = psutil_counters()
+    disk = psutil.disk_io_counters()
+    net = psutil.net_io_counters()
+    ret['io'] = (disk.read_bytes, disk.write_bytes, net.bytes_recv, net.bytes_sent)
+    return ret
+
+
+def run(name, collect, ticks):
+    collect()
+    wall, used = time.perf_counter(), time.process_time()
+    for _ in range(ticks):
+        collect()
+    wall, used = time.perf_counter() - wall, time.process_time() - used
+    # separately, so tracing doesn't slow the timed ticks
+    peak = 0
+    for _ in range(min(ticks, 100)):
+        tracemalloc.start()
+        collect()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    print('{0:<20} {1:8.1f}us wall {2:8.1f}us cpu {3:8d} B peak per tick'.format(
+        name, wall * 1e6 / ticks, used * 1e6 / ticks, peak))
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    print('{0} cores, {1} ticks each'.format(os.cpu_count(), args.ticks))
+    proc = ProcCollector(args.root)
+    run('ProcCollector', proc.collect, args.ticks)
+    proc.close()
+    if importlib.util.find_spec('psutil') is None:
+        print('psutil               skipped: not installed')
+        return
+    run('psutil', psutil_counters, args.ticks)
+    run('psutil + disk/net', psutil_all, args.ticks)
+
+
+if __name__ == '__main__':
+    main()
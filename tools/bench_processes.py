@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 by Advay Mengle - https://github.com/madvay/berrymon
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark for berrymon's --processes collector: CPU used sampling the
+# top processes once per --period, with at least --procs processes
+# running (idle sleepers are started to make up the number).  The target
+# is under 1% of one core on a Pi 3 at 300 processes.
+#
+#   python3 tools/bench_processes.py --procs 300 --seconds 60
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from berrymon import ProcessCollector
+
+parser = argparse.ArgumentParser(description='Benchmark berrymon --processes overhead',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--procs', help='processes to have running', type=int, default=300)
+parser.add_argument('--top', help='top N tracked, as --processes', type=int, default=5)
+parser.add_argument('--refresh', help='ticks between process list refreshes, as --processes_refresh', type=int, default=10)
+parser.add_argument('--period', help='seconds between ticks', type=float, default=1)
+parser.add_argument('--seconds', help='length of the measurement', type=float, default=60)
+
+
+def cpu():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    import psutil
+    extra = max(0, args.procs - len(psutil.pids()))
+    sleepers = [subprocess.Popen(['sleep', str(int(args.seconds) + 600)]) for _ in range(extra)]
+    try:
+        pc = ProcessCollector(args.top, args.refresh)
+        # the first tick reads every process from scratch; time it apart
+        t0, c0 = time.perf_counter(), cpu()
+        before = pc.top
+        pc.collect()
+        while pc.top is before:
+            time.sleep(0.001)
+        print('{0} processes; first tick {1:.1f}ms wall {2:.1f}ms cpu'.format(
+            len(pc.procs), (time.perf_counter() - t0) * 1000, (cpu() - c0) * 1000))
+
+        ticks = int(args.seconds / args.period)
+        c0 = cpu()
+        start = time.time()
+        for i in range(ticks):
+            pc.collect()
+            time.sleep(max(0, start + (i + 1) * args.period - time.time()))
+        # let the last tick finish before reading the clock
+        time.sleep(min(args.period, 1))
+        used = cpu() - c0
+        print('{0} ticks every {1}s: {2:.1f}ms cpu per tick, {3:.2f}% of one core (target: under 1% on a Pi 3)'.format(
+            ticks, args.period, used * 1000 / ticks, 100 * used / (time.time() - start)))
+    finally:
+        for p in sleepers:
+            p.kill()
+            p.wait()
+
+
+if __name__ == '__main__':
+    main()
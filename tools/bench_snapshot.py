@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 by Advay Mengle - https://github.com/madvay/berrymon
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark for berrymon's snapshot publishing: bytes allocated per tick
+# (update()) and per GET / request, as the peak traced by tracemalloc,
+# next to what the copy.deepcopy of the sample that update() and the /
+# route each used to make would add.  berrymon is set up by its own main()
+# from the flags after --, then ticks back to back instead of looping.
+#
+#   python3 tools/bench_snapshot.py --ticks 100 -- --sampler sysfs --collector proc
+
+import argparse
+import copy
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import berrymon
+
+parser = argparse.ArgumentParser(description='Benchmark berrymon allocations per tick and per request',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--ticks', help='samples to take', type=int, default=100)
+parser.add_argument('--no_requests', help="don't start the webserver or time GET /", action='store_true')
+parser.add_argument('berrymon', help='berrymon flags, after --', nargs=argparse.REMAINDER)
+
+
+def traced(fn, *args):
+    # (bytes still held afterwards, peak bytes held during) by fn
+    tracemalloc.start()
+    ret = fn(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del ret
+    return current, peak
+
+
+def get(app):
+    env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'QUERY_STRING': '', 'SERVER_NAME': 'bench',
+           'SERVER_PORT': '0', 'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.url_scheme': 'http'}
+    return b''.join(app(env, lambda status, headers, exc_info=None: None))
+
+
+def report(name, samples):
+    current = sum(c for c, _ in samples) / len(samples)
+    peak = sum(p for _, p in samples) / len(samples)
+    # what a tick holds afterwards is mostly the new snapshot, which stays live by design
+    print('{0:<28} {1:>10.0f} B peak {2:>10.0f} B still held (mean of {3})'.format(name, peak, current, len(samples)))
+
+
+def bench(args):
+    app = None if args.no_requests else sys.modules['bottle'].default_app()
+    rows = {'tick: update()': [], 'tick: old deepcopy': []}
+    if app:
+        rows.update({'GET /: first after a tick': [], 'GET /: repeat': [], 'GET /: old deepcopy': []})
+    for _ in range(args.ticks):
+        rows['tick: update()'].append(traced(berrymon.update))
+        rows['tick: old deepcopy'].append(traced(copy.deepcopy, berrymon.snapshot.data))
+        if app:
+            rows['GET /: first after a tick'].append(traced(get, app))
+            rows['GET /: repeat'].append(traced(get, app))
+            rows['GET /: old deepcopy'].append(traced(copy.deepcopy, berrymon.snapshot.data))
+    for name, samples in rows.items():
+        report(name, samples)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    flags = args.berrymon[1:] if args.berrymon[:1] == ['--'] else args.berrymon
+    if not args.no_requests:
+        flags = flags + ['--server', '127.0.0.1', '--server_port', '0']
+    # main() sets everything up, then calls loop() last
+    berrymon.loop = lambda: bench(args)
+    berrymon.main(flags)
+    sys.stdout.flush()
+    # the webserver's thread isn't a daemon, so it would keep us running
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
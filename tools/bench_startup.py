@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 by Advay Mengle - https://github.com/madvay/berrymon
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark for berrymon's startup: time from launching the process to its
+# first sample, and to the first answered GET /, over --runs launches.
+# Flags after -- go to berrymon, which always gets --server on a free port.
+#
+#   python3 tools/bench_startup.py --runs 5 -- --sensehat --sampler sysfs
+
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+from berryspy import percentile
+
+parser = argparse.ArgumentParser(description='Benchmark berrymon time to first sample and first HTTP response',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--runs', help='launches to time', type=int, default=5)
+parser.add_argument('--script', help='berrymon script to launch', default=os.path.join(ROOT, 'berrymon.py'))
+parser.add_argument('--timeout', help='seconds to wait for each launch to answer', type=float, default=60)
+parser.add_argument('berrymon', help='berrymon flags, after --', nargs=argparse.REMAINDER)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch(args, flags):
+    # seconds from launch to the first sample, and to the first 200 for GET /;
+    # both include interpreter startup and imports, which berrymon's own
+    # 'First sample' figure doesn't
+    port = free_port()
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, args.script] + flags + ['--server', '127.0.0.1', '--server_port', str(port)],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, env=env)
+    try:
+        first = None
+        for line in proc.stdout:
+            if line.startswith('First sample'):
+                first = time.time() - start
+                break
+            if time.time() - start > args.timeout:
+                break
+        while time.time() - start < args.timeout:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+                conn.request('GET', '/')
+                if conn.getresponse().status == 200:
+                    return first, time.time() - start
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError('berrymon did not answer within {0}s'.format(args.timeout))
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    flags = args.berrymon[1:] if args.berrymon[:1] == ['--'] else args.berrymon
+    samples, responses = [], []
+    for i in range(args.runs):
+        first, response = launch(args, flags)
+        print('run {0}: first sample {1}s, first response {2:.3f}s'.format(
+            i + 1, 'unreported' if first is None else '{0:.3f}'.format(first), response))
+        if first is not None:
+            samples.append(first)
+        responses.append(response)
+    for name, values in (('first sample', samples), ('first response', responses)):
+        if values:
+            values.sort()
+            print('{0:<16} min {1:.3f}s  median {2:.3f}s  max {3:.3f}s'.format(
+                name, values[0], percentile(values, 50), values[-1]))
+
+
+if __name__ == '__main__':
+    main()
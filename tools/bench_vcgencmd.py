@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 by Advay Mengle - https://github.com/madvay/berrymon
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark for berrymon's --vc_counters collection: wall and CPU time per
+# tick, children included, for the same queries run three ways: one
+# vcgencmd fork per query (as before), VcgencmdBatch's long-lived helper
+# shell, and VcgencmdBatch answering through the VideoCore mailbox.  The
+# mailbox run needs /dev/vcio, so on anything but a Pi it is skipped.
+#
+#   python3 tools/bench_vcgencmd.py --ticks 50 --queries 'measure_clock core' 'measure_volts core' 'get_mem gpu'
+
+import argparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import berrymon
+from berrymon import SysfsSampler, VcgencmdBatch
+
+parser = argparse.ArgumentParser(description='Benchmark berrymon vcgencmd counter collection',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--vcgencmd', help='path to the vcgencmd executable', default='/opt/vc/bin/vcgencmd')
+parser.add_argument('--queries', help='vcgencmd queries collected each tick', nargs='+',
+                    default=['measure_clock core', 'measure_clock arm', 'measure_volts core', 'get_mem gpu'])
+parser.add_argument('--ticks', help='ticks to run each way', type=int, default=50)
+parser.add_argument('--sysfs_root', help='root to find /dev/vcio under', default='/')
+
+
+def cpu():
+    # seconds of CPU used by us and our reaped children
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + kids.ru_utime + kids.ru_stime
+
+
+def run(name, tick, ticks, close=None):
+    tick()
+    wall, used = time.perf_counter(), cpu()
+    for _ in range(ticks):
+        tick()
+    wall = time.perf_counter() - wall
+    # the helper shell's children only count once it has been reaped
+    if close:
+        close()
+    used = cpu() - used
+    print('{0:<16} {1:8.2f}ms wall {2:8.2f}ms cpu per tick'.format(name, wall * 1000 / ticks, used * 1000 / ticks))
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    berrymon.vcgencmd_path = args.vcgencmd
+    queries = [q.split() for q in args.queries]
+    print('{0} queries per tick, {1} ticks each'.format(len(queries), args.ticks))
+
+    run('fork per query', lambda: [berrymon.vcgencmd(q) for q in queries], args.ticks)
+
+    shell = VcgencmdBatch(args.vcgencmd, args.queries)
+    run('helper shell', shell.collect, args.ticks, shell.close)
+
+    sampler = SysfsSampler(args.sysfs_root)
+    if sampler.vcio_fd is None:
+        print('mailbox          skipped: no {0}'.format(os.path.join(args.sysfs_root, 'dev/vcio')))
+    else:
+        mailbox = VcgencmdBatch(args.vcgencmd, args.queries, sampler)
+        run('mailbox', mailbox.collect, args.ticks, mailbox.close)
+    sampler.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 by Advay Mengle - https://github.com/madvay/berrymon
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark for berrymon's webhook delivery during an endpoint outage:
+# threads alive and CPU used while posting at --rate to a local endpoint
+# that hangs (accepts, never answers), refuses connections, or answers
+# 500.  Runs WebhookDelivery's single pooled worker, then the thread per
+# post with urllib that ifttt_report() used to start, for comparison.
+#
+#   python3 tools/bench_webhook.py --outage hang --rate 10 --seconds 20
+
+import argparse
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from berrymon import WebhookDelivery
+
+parser = argparse.ArgumentParser(description='Benchmark berrymon webhook delivery while the endpoint is down',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--outage', help='how the endpoint fails', choices=['hang', 'refuse', '500'], default='hang')
+parser.add_argument('--rate', help='posts per second, as from a low --webhook_period', type=float, default=10)
+parser.add_argument('--seconds', help='length of each run', type=float, default=20)
+parser.add_argument('--timeout', help='socket timeout for the thread-per-post run; urlopen had none', type=float, default=60)
+
+
+def endpoint(outage):
+    # a listening socket standing in for the endpoint; returns (url, close)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    url = 'http://127.0.0.1:{0}/hook'.format(sock.getsockname()[1])
+    if outage == 'refuse':
+        sock.close()
+        return url, lambda: None
+    sock.listen(128)
+    held = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            if outage == 'hang':
+                held.append(conn)
+                continue
+            threading.Thread(target=fail, args=(conn,), name='endpoint', daemon=True).start()
+
+    def fail(conn):
+        with conn:
+            f = conn.makefile('rb')
+            try:
+                while True:
+                    length = 0
+                    line = f.readline()
+                    while line not in (b'\r\n', b''):
+                        if line.lower().startswith(b'content-length:'):
+                            length = int(line.split(b':')[1])
+                        line = f.readline()
+                    if not line:
+                        return
+                    f.read(length)
+                    conn.sendall(b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n')
+            except OSError:
+                return
+
+    def close():
+        sock.close()
+        for conn in held:
+            conn.close()
+    threading.Thread(target=serve, name='endpoint', daemon=True).start()
+    return url, close
+
+
+def cpu():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+def threads():
+    # ours, not the stand-in endpoint's
+    return sum(1 for t in threading.enumerate() if t.name != 'endpoint')
+
+
+def run(name, start_posting, seconds, rate):
+    baseline = threads()
+    post = start_posting()
+    used = cpu()
+    start = time.time()
+    n = 0
+    peak = 0
+    while time.time() - start < seconds:
+        post({'value1': n, 'value2': 1500000000, 'value3': '------'})
+        n = n + 1
+        peak = max(peak, threads() - baseline)
+        time.sleep(max(0, start + n / rate - time.time()))
+    used = cpu() - used
+    print('{0:<16} {1} posts: {2} threads at the end, {3} at most; {4:.2f}s cpu ({5:.1f}%)'.format(
+        name, n, threads() - baseline, peak, used, 100 * used / seconds))
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    print('endpoint {0} for {1}s at {2} posts/s'.format(args.outage, args.seconds, args.rate))
+
+    url, close = endpoint(args.outage)
+    deliveries = []
+
+    def pooled():
+        deliveries.append(WebhookDelivery(url, cap=100))
+        return deliveries[0].post
+    run('pooled', pooled, args.seconds, args.rate)
+    d = deliveries[0]
+    print('{0:<16} {1} sent, {2} queued, {3} dropped, {4} failed requests'.format(
+        '', d.sent, len(d.queue), d.dropped, d.failures))
+    close()
+
+    url, close = endpoint(args.outage)
+
+    def post(item):
+        def impl():
+            req = urllib.request.Request(url, urllib.parse.urlencode(item).encode('utf-8'))
+            try:
+                with urllib.request.urlopen(req, timeout=args.timeout) as resp:
+                    resp.read()
+            except OSError:
+                pass
+        threading.Thread(target=impl, daemon=True).start()
+    run('thread per post', lambda: post, args.seconds, args.rate)
+    close()
+
+
+if __name__ == '__main__':
+    main()
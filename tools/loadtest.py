@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 by Advay Mengle - https://github.com/madvay/berrymon
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Load test for a running berrymon --server: requests/sec and latency
+# percentiles per path, from concurrent keep-alive clients, optionally
+# while other clients hold idle keep-alive connections or SSE streams.
+#
+#   python3 tools/loadtest.py localhost:8080 --clients 16 --seconds 10 --idle 8
+
+import argparse
+import http.client
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from berryspy import percentile
+
+parser = argparse.ArgumentParser(description='Load test a berrymon webserver',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('server', help='host:port of a running berrymon --server')
+parser.add_argument('--paths', help='paths to request, round-robin per client', nargs='+', default=['/', '/?format=json'])
+parser.add_argument('--clients', help='concurrent keep-alive clients', type=int, default=8)
+parser.add_argument('--seconds', help='length of the test', type=float, default=10)
+parser.add_argument('--idle', help='extra keep-alive connections opened first and left idle', type=int, default=0)
+parser.add_argument('--streams', help='extra /stream viewers held open during the test', type=int, default=0)
+parser.add_argument('--timeout', help='seconds before a request counts as failed', type=float, default=30)
+
+
+def client(args, until, results, errors, offset):
+    conn = None
+    i = offset
+    while time.time() < until:
+        path = args.paths[i % len(args.paths)]
+        i = i + 1
+        start = time.time()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(args.server, timeout=args.timeout)
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                raise http.client.HTTPException('HTTP {0}'.format(resp.status))
+            if resp.getheader('Connection', '').lower() == 'close':
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e) or type(e).__name__)
+            if conn:
+                conn.close()
+            conn = None
+            continue
+        results.setdefault(path, []).append(time.time() - start)
+    if conn:
+        conn.close()
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    held = []
+    for _ in range(args.idle):
+        # a served request leaves the connection open and idle
+        conn = http.client.HTTPConnection(args.server, timeout=args.timeout)
+        conn.request('GET', '/?format=json')
+        conn.getresponse().read()
+        held.append(conn)
+    for _ in range(args.streams):
+        conn = http.client.HTTPConnection(args.server, timeout=args.timeout)
+        conn.request('GET', '/stream')
+        resp = conn.getresponse()
+        if resp.status != 200:
+            print('stream rejected: HTTP {0}'.format(resp.status))
+        held.append(conn)
+
+    results = {}
+    errors = []
+    until = time.time() + args.seconds
+    threads = [threading.Thread(target=client, args=(args, until, results, errors, i)) for i in range(args.clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    print('{0} clients for {1:.1f}s, {2} idle connections, {3} streams'.format(args.clients, elapsed, args.idle, args.streams))
+    print('{0:<20} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}'.format('path', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'max ms'))
+    for path in args.paths:
+        lat = sorted(results.get(path, []))
+        if not lat:
+            print('{0:<20} {1:>8}'.format(path, 0))
+            continue
+        print('{0:<20} {1:>8} {2:>10.1f} {3:>10.2f} {4:>10.2f} {5:>10.2f}'.format(
+            path, len(lat), len(lat) / elapsed, percentile(lat, 50) * 1000, percentile(lat, 99) * 1000, lat[-1] * 1000))
+    if errors:
+        print('{0} failed requests, e.g. {1}'.format(len(errors), errors[0]))
+    for conn in held:
+        conn.close()
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())